@@ -0,0 +1,540 @@
+"""
+Measures what restware costs per request. A bottle app is driven through the Restware middleware and the
+RestwarePlugin directly via WSGI environ dicts, with no network or webserver involved, and every scenario is run
+against the same app without restware as a baseline.
+
+Usage:
+    python benchmark.py [-n ITERATIONS] [-s SCENARIO ...] [--json FILE] [--compare FILE] [--formats]
+
+--json writes the results as JSON ("-" for stdout), and --compare prints how requests/sec changed against such a
+file, e.g. one written on another commit.
+
+The big-* scenarios move a payload of a few megabytes each way, to show how much memory a request takes relative to
+its payload: peakPerPayload is how far one request raises the peak resident set size of a process forked for it
+(resource.getrusage's ru_maxrss) over the payload's uncompressed size, the lowest of a few runs along with their
+range. Copying bodies around shows up there as multiples of 1x, as do the objects decoded from a request body.
+Memory the process already had and reuses doesn't show up, so it is a lower bound; it needs os.fork and the
+resource module (Unix). allocatedObjects (gc in the report) is by how much each request grows gc's count of
+tracked objects, the garbage it leaves for the collector, and leakedObjects, the number of those objects that
+survive a collection, should be 0.
+
+--formats also times encoding and decoding the large payloads as JSON, gzipped JSON and each binary format that is
+installed (MessagePack, CBOR), and prints the size of each on the wire. The *-msgpack scenarios show the same
+through the plugin, on routes that turn binary formats on (binary_formats=True); large-dict-binary-json is what
+turning them on costs the clients that still want JSON. Without msgpack's C extension (its pure Python fallback
+is all there is for some interpreters), packing is an order of magnitude slower than encoding JSON.
+
+.. codeauthor:: Trevor Tonn <smthmlk@gmail.com>
+
+Released under the BSD 2-Clause license, http://opensource.org/licenses/BSD-2-Clause
+"""
+import StringIO
+import argparse
+import gc
+import gzip
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import timeit
+import zlib
+
+import bottle
+
+import restware
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# the shape of the records in the corpus, for the routes that declare their response schema
+RECORD_SCHEMA = {"id": int, "name": str, "score": float, "active": bool, "tags": [str], "parent": None}
+
+
+def makeCorpus(seed=1):
+    """
+    Returns the payloads the routes serve, generated from a fixed seed so every run sees the same data
+    """
+    rand = random.Random(seed)
+    words = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel", "india", "juliet"]
+
+    def record(i):
+        return {"id": i, "name": " ".join(rand.choice(words) for _ in range(3)), "score": rand.random() * 100,
+                "active": rand.random() < 0.5, "tags": rand.sample(words, 3), "parent": None}
+
+    return {
+        "small": {"status": "ok", "count": 3, "items": [1, 2, 3]},
+        "large": dict(("key%d" % i, record(i)) for i in range(2000)),
+        "list": [record(i) for i in range(2000)],
+        "body": json.dumps([record(i) for i in range(500)]),
+        "big": [record(i) for i in range(40000)],
+    }
+
+
+def gzipped(data):
+    sio = StringIO.StringIO()
+    gzFile = gzip.GzipFile(fileobj=sio, mode='wb', compresslevel=6)
+    gzFile.write(data)
+    gzFile.close()
+    return sio.getvalue()
+
+
+def quietLogger():
+    """
+    A logger that drops everything, so error scenarios don't flood stdout
+    """
+    logger = logging.getLogger("restware.benchmark")
+    logger.addHandler(logging.NullHandler())
+    logger.setLevel(logging.WARNING)
+    logger.propagate = False
+    return logger
+
+
+def buildApp(corpus, restwared=True):
+    """
+    Returns the WSGI app to benchmark: a bottle app with the RestwarePlugin installed, wrapped in the Restware
+    middleware, or, with restwared=False, the same routes in a bare bottle app. Bare bottle can't serialize lists,
+    pretty-print, compress responses, inflate request bodies or speak MessagePack, so the baseline does that
+    itself, the way an app without restware would have to: its routes decode request bodies, and a plugin (see
+    baselineEncoder) encodes and gzips what they return. Successful scenarios do the same work against both; error
+    responses differ, as bottle's are HTML pages that aren't compressed
+    """
+    app = bottle.Bottle()
+    msgpackFormat = (restware.loadBinaryFormats(["msgpack"]) or [None])[0]
+
+    def requestBody():
+        """
+        The decoded request body: request.jsonData, or in the baseline, the body inflated and decoded in one go
+        """
+        if restwared:
+            return bottle.request.jsonData
+        body = bottle.request.body.read()
+        if bottle.request.headers.get("Content-Encoding") == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        if bottle.request.content_type == "application/msgpack":
+            return msgpackFormat.loads(body)
+        return json.loads(body)
+
+    @app.get('/api/small')
+    def small():
+        return corpus["small"]
+
+    @app.get('/api/large')
+    def large():
+        return corpus["large"]
+
+    # the same dict, on a route that also speaks the binary formats
+    @app.get('/api/large-binary', binary_formats=True)
+    def largeBinary():
+        if not restwared and msgpackFormat and "application/msgpack" in bottle.request.headers.get("Accept", ""):
+            bottle.response.content_type = msgpackFormat.mediaType
+            return msgpackFormat.dumps(corpus["large"], None)
+        return corpus["large"]
+
+    @app.get('/api/list')
+    def items():
+        return corpus["list"]
+
+    # the same list, for comparing the pretty-printing of a compiled response schema with the codec's, as it picks
+    # its backend and with the stdlib's pure Python one
+    stdlibCodec = restware.JSONCodec(["json"])
+
+    @app.get('/api/list-schema', schema=[RECORD_SCHEMA])
+    def itemsWithSchema():
+        return corpus["list"]
+
+    @app.get('/api/list-stdlib', codec=stdlibCodec)
+    def itemsWithStdlib():
+        return corpus["list"]
+
+    @app.get('/api/list-stdlib-schema', codec=stdlibCodec, schema=[RECORD_SCHEMA])
+    def itemsWithStdlibSchema():
+        return corpus["list"]
+
+    @app.get('/api/big')
+    def big():
+        return corpus["big"]
+
+    @app.post('/api/echo')
+    def echo():
+        return {"received": len(requestBody() or [])}
+
+    @app.post('/api/echo-binary', binary_formats=True)
+    def echoBinary():
+        return {"received": len(requestBody() or [])}
+
+    @app.post('/api/ingest', stream_body=True)
+    def ingest():
+        return {"received": sum(1 for item in requestBody() or ())}
+
+    @app.get('/api/response')
+    def httpResponse():
+        return bottle.HTTPResponse(json.dumps(corpus["small"]), status=201, headers={"Content-Type": "application/json"})
+
+    @app.get('/api/error')
+    def httpError():
+        return bottle.HTTPError(409, "conflicting update")
+
+    @app.get('/api/abort')
+    def abort():
+        bottle.abort(403, "not allowed")
+
+    @app.get('/api/crash')
+    def crash():
+        raise ValueError("boom")
+
+    if not restwared:
+        app.install(baselineEncoder)
+        return app
+    logger = quietLogger()
+    app.install(restware.RestwarePlugin(logger=logger))
+    return restware.Restware(app, logger=logger)
+
+
+def baselineEncoder(callback):
+    """
+    The baseline's stand-in for the RestwarePlugin, as a bottle plugin: dicts and lists are encoded as JSON,
+    indented and with sorted keys for ?pretty=true, and bodies of at least 256 bytes (the plugin's default
+    compressionMinSize) are gzipped for clients that accept that
+    """
+    def wrapper(*args, **kwargs):
+        body = callback(*args, **kwargs)
+        if isinstance(body, (dict, list)):
+            if bottle.request.query.get("pretty") == "true":
+                body = json.dumps(body, indent=4, sort_keys=True)
+            else:
+                body = json.dumps(body)
+            bottle.response.content_type = "application/json"
+        if isinstance(body, str) and len(body) >= 256:
+            bottle.response.add_header("Vary", "Accept-Encoding")
+            if "gzip" in bottle.request.headers.get("Accept-Encoding", ""):
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                body = compressor.compress(body) + compressor.flush()
+                bottle.response.set_header("Content-Encoding", "gzip")
+        return body
+    return wrapper
+
+
+class Scenario(object):
+    """
+    One kind of request: what is sent, and where
+    """
+    def __init__(self, name, method, path, body="", headers=None, query="", payloadSize=None, maxIterations=None):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+        self.headers = headers or {}
+        self.query = query
+        # the uncompressed size of what the request is about, to relate its peak memory use to
+        self.payloadSize = payloadSize
+        # big payloads take long enough per request that a few dozen of them are plenty
+        self.maxIterations = maxIterations
+
+    def environ(self):
+        environ = {'REQUEST_METHOD': self.method, 'PATH_INFO': self.path, 'QUERY_STRING': self.query,
+                   'SERVER_NAME': 'localhost', 'SERVER_PORT': '8080', 'SERVER_PROTOCOL': 'HTTP/1.1',
+                   'CONTENT_LENGTH': str(len(self.body)), 'wsgi.input': StringIO.StringIO(self.body),
+                   'wsgi.url_scheme': 'http', 'wsgi.errors': StringIO.StringIO(), 'wsgi.multithread': False,
+                   'wsgi.multiprocess': False, 'wsgi.run_once': False, 'wsgi.version': (1, 0)}
+        environ.update(self.headers)
+        return environ
+
+
+def makeScenarios(corpus):
+    gzipAccepted = {'HTTP_ACCEPT_ENCODING': 'gzip'}
+    jsonBody = {'CONTENT_TYPE': 'application/json'}
+    gzipBody = {'CONTENT_TYPE': 'application/json', 'HTTP_CONTENT_ENCODING': 'gzip'}
+    bigBody = json.dumps(corpus["big"])
+    binaryFormats = dict((binaryFormat.name, binaryFormat) for binaryFormat in restware.loadBinaryFormats())
+    msgpackAccepted = {'HTTP_ACCEPT': 'application/msgpack'}
+    msgpackGzipAccepted = {'HTTP_ACCEPT': 'application/msgpack', 'HTTP_ACCEPT_ENCODING': 'gzip'}
+    msgpackScenarios = []
+    if "msgpack" in binaryFormats:
+        packed = binaryFormats["msgpack"].dumps(json.loads(corpus["body"]), None)
+        msgpackScenarios = [
+            Scenario("large-dict-binary-json", "GET", "/api/large-binary"),
+            Scenario("large-dict-msgpack", "GET", "/api/large-binary", headers=msgpackAccepted),
+            Scenario("large-dict-msgpack-gzip", "GET", "/api/large-binary", headers=msgpackGzipAccepted),
+            Scenario("post-msgpack", "POST", "/api/echo-binary", packed, {'CONTENT_TYPE': 'application/msgpack'}),
+        ]
+    return [
+        Scenario("small-dict", "GET", "/api/small"),
+        Scenario("small-dict-gzip", "GET", "/api/small", headers=gzipAccepted),
+        Scenario("large-dict", "GET", "/api/large"),
+        Scenario("large-dict-gzip", "GET", "/api/large", headers=gzipAccepted),
+        Scenario("list", "GET", "/api/list"),
+        Scenario("list-gzip", "GET", "/api/list", headers=gzipAccepted),
+        Scenario("list-pretty", "GET", "/api/list", query="pretty=true"),
+        Scenario("list-pretty-schema", "GET", "/api/list-schema", query="pretty=true"),
+        Scenario("list-pretty-stdlib", "GET", "/api/list-stdlib", query="pretty=true"),
+        Scenario("list-pretty-stdlib-schema", "GET", "/api/list-stdlib-schema", query="pretty=true"),
+        Scenario("post-plain", "POST", "/api/echo", corpus["body"], jsonBody),
+        Scenario("post-gzip", "POST", "/api/echo", gzipped(corpus["body"]), gzipBody),
+        Scenario("http-response", "GET", "/api/response", headers=gzipAccepted),
+        Scenario("http-error", "GET", "/api/error"),
+        Scenario("abort-403", "GET", "/api/abort"),
+        Scenario("not-found-404", "GET", "/api/missing"),
+        Scenario("exception-500", "GET", "/api/crash"),
+        Scenario("big-list-gzip", "GET", "/api/big", headers=gzipAccepted, payloadSize=len(bigBody), maxIterations=20),
+        Scenario("big-post-gzip", "POST", "/api/echo", gzipped(bigBody), gzipBody, payloadSize=len(bigBody),
+                 maxIterations=20),
+        Scenario("big-post-stream-gzip", "POST", "/api/ingest", gzipped(bigBody), gzipBody, payloadSize=len(bigBody),
+                 maxIterations=20),
+    ] + msgpackScenarios
+
+
+def request(app, scenario):
+    """
+    Makes one request, returning its status and the response body's size
+    """
+    status = []
+
+    def startResponse(statusLine, headers, excInfo=None):
+        status.append(statusLine)
+
+    result = app(scenario.environ(), startResponse)
+    try:
+        size = sum(len(chunk) for chunk in result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return status[0], size
+
+
+def percentile(sortedValues, fraction):
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * fraction))]
+
+
+def touch(data):
+    """
+    Visits every list, tuple, dict and value inside data, without allocating more than a stack of iterators. That
+    updates the reference count of each, so in a forked child its pages are copied there and then
+    """
+    stack = [iter([data])]
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, dict):
+                stack.append(itertools.chain(item.iterkeys(), item.itervalues()))
+                break
+            if isinstance(item, (list, tuple)):
+                stack.append(iter(item))
+                break
+        else:
+            stack.pop()
+
+
+def peakMemory(app, scenario, shared=None, runs=5):
+    """
+    Returns how many bytes one request raises the peak resident set size by, measured in a child process forked
+    for it, so earlier requests and scenarios don't leave their peaks behind: a (lowest, highest) tuple over a few
+    such runs, as the allocator and the garbage collector make it vary. None without os.fork or resource.
+
+    shared is the data the handlers return (the corpus). Merely reading it in the child copies every page of it
+    that the parent had, so that is done before the request, to keep it out of the request's peak
+    """
+    if resource is None or not hasattr(os, "fork"):
+        return None
+    peaks = [peakMemoryOnce(app, scenario, shared) for _ in xrange(runs)]
+    peaks = [peak for peak in peaks if peak is not None]
+    return (min(peaks), max(peaks)) if peaks else None
+
+
+def peakMemoryOnce(app, scenario, shared):
+    # ru_maxrss is in kilobytes, except on OS X
+    unit = 1 if sys.platform == "darwin" else 1024
+    readEnd, writeEnd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(readEnd)
+        try:
+            touch(shared)
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            request(app, scenario)
+            os.write(writeEnd, str((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) * unit))
+        finally:
+            os._exit(0)
+    os.close(writeEnd)
+    try:
+        output = os.read(readEnd, 64)
+    finally:
+        os.close(readEnd)
+        os.waitpid(pid, 0)
+    return int(output) if output else None
+
+
+def allocatedObjects(app, scenario, count=20):
+    """
+    Returns, on average, by how much one request grows the count of objects gc tracks (containers: lists, dicts,
+    instances and such), as gc.get_count() has it, with automatic collection turned off. Objects that reference
+    counting frees before the request is over cancel out, so this is the garbage the request leaves for the
+    collector, mostly reference cycles, plus whatever it keeps: the collections each request makes more likely
+    """
+    enabled = gc.isenabled()
+    gc.collect()
+    gc.disable()
+    try:
+        grown = 0
+        for _ in xrange(count):
+            before = gc.get_count()[0]
+            request(app, scenario)
+            grown += gc.get_count()[0] - before
+            gc.collect()
+    finally:
+        if enabled:
+            gc.enable()
+    return grown / float(count)
+
+
+def leakedObjects(app, scenario, count=20):
+    """
+    Returns how many objects tracked by gc each request leaves behind, which should be 0. This says nothing about
+    how much a request allocates along the way; see allocatedObjects and peakMemory for that
+    """
+    gc.collect()
+    before = len(gc.get_objects())
+    for _ in xrange(count):
+        request(app, scenario)
+    gc.collect()
+    return (len(gc.get_objects()) - before) / float(count)
+
+
+def measure(app, scenario, iterations, warmup=50, peaks=None):
+    """
+    Runs the scenario against the app, returning a dict of the results. peaks is what peakMemory measured for it
+    """
+    if scenario.maxIterations:
+        iterations = min(iterations, scenario.maxIterations)
+        warmup = min(warmup, 2)
+    for _ in xrange(warmup):
+        request(app, scenario)
+    latencies = []
+    timer = timeit.default_timer
+    for _ in xrange(iterations):
+        start = timer()
+        status, size = request(app, scenario)
+        latencies.append(timer() - start)
+    latencies.sort()
+    peakPerPayload = [float(peak) / scenario.payloadSize for peak in peaks] if peaks is not None else None
+    return {"status": status, "requestsPerSec": len(latencies) / sum(latencies),
+            "p50ms": percentile(latencies, 0.5) * 1000, "p99ms": percentile(latencies, 0.99) * 1000,
+            "bytesIn": len(scenario.body), "bytesOut": size, "peakRSSBytes": peaks and peaks[0],
+            "peakRSSRange": peaks, "peakPerPayload": peakPerPayload and peakPerPayload[0],
+            "peakPerPayloadRange": peakPerPayload, "allocatedObjects": allocatedObjects(app, scenario),
+            "leakedObjects": leakedObjects(app, scenario)}
+
+
+def run(iterations, names=None):
+    corpus = makeCorpus()
+    apps = {"restware": buildApp(corpus), "baseline": buildApp(corpus, restwared=False)}
+    scenarios = [scenario for scenario in makeScenarios(corpus) if not names or scenario.name in names]
+    # Peak memory is measured before anything else, from a process that has yet to handle a request: the memory
+    # earlier requests freed would be reused by the children without raising their resident set size
+    gc.collect()
+    peaks = dict(((scenario.name, label), peakMemory(app, scenario, corpus))
+                 for scenario in scenarios if scenario.payloadSize for label, app in apps.items())
+    results = []
+    for scenario in scenarios:
+        result = {"scenario": scenario.name}
+        for label, app in sorted(apps.items()):
+            result[label] = measure(app, scenario, iterations, peaks=peaks.get((scenario.name, label)))
+        # a baseline that answered differently (an error, say) did other work, and says nothing about the overhead
+        result["overheadMs"] = None
+        if result["restware"]["status"] == result["baseline"]["status"]:
+            result["overheadMs"] = result["restware"]["p50ms"] - result["baseline"]["p50ms"]
+        results.append(result)
+        report(result)
+    return results
+
+
+def report(result):
+    restwared, baseline = result["restware"], result["baseline"]
+    overhead = "no baseline" if result["overheadMs"] is None else "overhead %+.3fms" % result["overheadMs"]
+    print "%-16s %-26s %9.0f req/s  p50 %7.3fms  p99 %7.3fms  in %7dB  out %8dB  gc %6.0f  | baseline %9.0f req/s  p50 %7.3fms  gc %6.0f  %s  %s" % (
+        result["scenario"], restwared["status"], restwared["requestsPerSec"], restwared["p50ms"], restwared["p99ms"],
+        restwared["bytesIn"], restwared["bytesOut"], restwared["allocatedObjects"], baseline["requestsPerSec"],
+        baseline["p50ms"], baseline["allocatedObjects"], baseline["status"], overhead)
+    if restwared["peakPerPayload"] is not None:
+        print "%-16s peak memory %.2fx the payload (%.2fx-%.2fx), baseline %.2fx (%.2fx-%.2fx)" % (
+            (result["scenario"], restwared["peakPerPayload"]) + tuple(restwared["peakPerPayloadRange"]) +
+            (baseline["peakPerPayload"],) + tuple(baseline["peakPerPayloadRange"]))
+
+
+def compareFormats(corpus, iterations):
+    """
+    Prints how long encoding and decoding the large payloads takes as JSON, gzipped JSON and each binary format
+    that is installed, and how many bytes each comes to
+    """
+    codec = restware.JSONCodec()
+    formats = [("json", lambda data: codec.dumps(data), codec.loads),
+               ("json+gzip", lambda data: restware.compress(codec.dumps(data), "gzip", 6),
+                lambda data: codec.loads(restware.zlib.decompress(data, 16 + restware.zlib.MAX_WBITS)))]
+    for binaryFormat in restware.loadBinaryFormats():
+        formats.append((binaryFormat.name, lambda data, dumps=binaryFormat.dumps: dumps(data, codec.default),
+                        binaryFormat.loads))
+        formats.append((binaryFormat.name + "+gzip",
+                        lambda data, dumps=binaryFormat.dumps: restware.compress(dumps(data, codec.default), "gzip", 6),
+                        lambda data, loads=binaryFormat.loads: loads(restware.zlib.decompress(data, 16 + restware.zlib.MAX_WBITS))))
+    iterations = max(iterations // 100, 3)
+    for payloadName in ("large", "list"):
+        payload = corpus[payloadName]
+        for name, dumps, loads in formats:
+            encoded = dumps(payload)
+            encodeSeconds = timeit.timeit(lambda: dumps(payload), number=iterations) / iterations
+            decodeSeconds = timeit.timeit(lambda: loads(encoded), number=iterations) / iterations
+            print "%-6s %-13s encode %8.3fms  decode %8.3fms  size %8dB" % (
+                payloadName, name, encodeSeconds * 1000, decodeSeconds * 1000, len(encoded))
+
+
+def compare(results, previousFile):
+    """
+    Prints the change in requests/sec of every scenario against results saved with --json
+    """
+    with open(previousFile) as fileobj:
+        previous = dict((result["scenario"], result) for result in json.load(fileobj)["results"])
+    for result in results:
+        before = previous.get(result["scenario"])
+        if before is None:
+            continue
+        old, new = before["restware"]["requestsPerSec"], result["restware"]["requestsPerSec"]
+        print "%-16s %9.0f -> %9.0f req/s (%+.1f%%)" % (result["scenario"], old, new, (new - old) / old * 100)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the restware plugin and middleware over WSGI")
+    parser.add_argument("-n", "--iterations", type=int, default=1000, help="requests timed per scenario")
+    parser.add_argument("-s", "--scenario", action="append", help="only run this scenario (may be repeated)")
+    parser.add_argument("--json", help="write the results as JSON to this file, - for stdout")
+    parser.add_argument("--compare", help="compare requests/sec against results written earlier with --json")
+    parser.add_argument("--formats", action="store_true",
+                        help="also compare encoding and decoding JSON, gzipped JSON and the binary formats")
+    args = parser.parse_args(argv)
+
+    stdout = sys.stdout
+    if args.json == "-":
+        # keep the JSON document alone on stdout
+        sys.stdout = sys.stderr
+    try:
+        results = run(args.iterations, args.scenario)
+        if args.compare:
+            compare(results, args.compare)
+        if args.formats:
+            compareFormats(makeCorpus(), args.iterations)
+    finally:
+        sys.stdout = stdout
+    if args.json:
+        document = {"python": sys.version.split()[0], "bottle": bottle.__version__, "iterations": args.iterations,
+                    "peakMemory": resource is not None and hasattr(os, "fork"), "results": results}
+        if args.json == "-":
+            json.dump(document, sys.stdout, indent=2, sort_keys=True)
+        else:
+            with open(args.json, "w") as fileobj:
+                json.dump(document, fileobj, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -18,11 +18,12 @@ def root():
             """
 
 # The following three routes make up our actual example API
-@get("/api/v1/key/<keyName>")
+# Lookups are cached by the RestwarePlugin; the routes that change a key drop its cached response
+@get("/api/v1/key/<keyName>", cache=True)
 def getKey(keyName):
     return {keyName:keyStoreD.get(keyName, None)}
 
-@put("/api/v1/key/<keyName>/value/<value>")
+@put("/api/v1/key/<keyName>/value/<value>", invalidates=["/api/v1/key/<keyName>"])
 def storeKeyValue(keyName, value):
     try:
         keyStoreD[keyName] = value
@@ -30,7 +31,7 @@ def storeKeyValue(keyName, value):
         return {"error":"failed to store value for key: %s" % e}
     return {keyName:value}
 
-@delete("/api/v1/key/<keyName>")
+@delete("/api/v1/key/<keyName>", invalidates=["/api/v1/key/<keyName>"])
 def deleteKey(keyName):
     if keyName in keyStoreD:
         del keyStoreD[keyName]
@@ -42,11 +43,14 @@ def deleteKey(keyName):
 app = bottle.app()
 
 # Install the RestwarePlugin into the app
-# All of our API operations will reside under /api/, so this plugin will only do its JSON magic for routes under that base-path
-app.install(restware.RestwarePlugin(apiBasePath="/api/"))
+# All of our API operations will reside under /api/, so this plugin will only do its JSON magic for routes under that base-path.
+# Clients may also POST several operations at once to /api/_batch
+app.install(restware.RestwarePlugin(apiBasePath="/api/", batchPath="/api/_batch"))
 
 # Wrap the app with our Restware middleware
 wrapped_app = restware.Restware(app)
 
-# Start the webserver. We'll use CherryPy
-bottle.run(app=wrapped_app, host="0.0.0.0", port=8080, debug=True, server='cherrypy')
+# Start the webserver. We'll use CherryPy, in one process: keyStoreD and the response cache live in this process, so
+# the prefork runner (python restware.py run) would give every worker its own, and a PUT would only be seen by one
+if __name__ == "__main__":
+    bottle.run(app=wrapped_app, host="0.0.0.0", port=8080, debug=True, server='cherrypy')
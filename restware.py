@@ -5,15 +5,2330 @@ Restware is a plugin for bottle and a piece of middleware (wsgi) to help develop
 
 Released under the BSD 2-Clause license, http://opensource.org/licenses/BSD-2-Clause
 """
+import Queue
+import SocketServer
 import StringIO
-import gzip
+import argparse
+import base64
+import bisect
+import cPickle
+import collections
+import errno
+import hashlib
+import itertools
 import json
 import logging
+import mmap
+import multiprocessing
+import os
+import random
+import re
+import select
+import signal
+import socket
+import stat
+import struct
 import sys
+import threading
+import time
+import timeit
+import types
+import urllib
+import wsgiref.simple_server
+import zlib
 
 import bottle
 from bottle import response, request
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Content-encodings we can produce and decode, most preferred first
+CONTENT_ENCODINGS = ("zstd", "gzip", "deflate") if zstandard is not None else ("gzip", "deflate")
+
+
+class RequestBodyError(bottle.HTTPError):
+    """
+    Raised while reading a request body that the Restware middleware refuses to decode: 413 when it inflates
+    past the configured limits, 400 when the compressed data is malformed. Bottle turns it into a normal error
+    response, which the RestwarePlugin then renders as JSON.
+    """
+    pass
+
+
+class BackgroundLogHandler(logging.Handler):
+    """
+    Hands log records to a daemon thread, which emits them through another handler (e.g. a StreamHandler), so
+    request threads never wait on stdout or a log file. Records are formatted by that thread too, which is why
+    the hot-path log calls pass their arguments separately instead of %-formatting them up front.
+
+    The queue is bounded: once it is full, records are dropped and counted in .dropped rather than slowing
+    requests down. Anything still queued is written out when logging shuts down at interpreter exit.
+    """
+    def __init__(self, target, maxQueue=10000):
+        """
+        Args:
+            target (logging.Handler, required): the handler that actually writes the records out
+            maxQueue (int, optional): how many records may be waiting to be written out
+        """
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = Queue.Queue(maxQueue)
+        self.dropped = 0
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        # (Re)started lazily: after a fork the child has the queue, but not the thread draining it
+        self.acquire()
+        try:
+            if self.pid != os.getpid():
+                self.queue = Queue.Queue(self.queue.maxsize)
+                self.thread = threading.Thread(target=self.drain, name="restware-logger")
+                self.thread.daemon = True
+                self.thread.start()
+                self.pid = os.getpid()
+        finally:
+            self.release()
+
+    def drain(self):
+        queue = self.queue
+        while True:
+            record = queue.get()
+            if record is None:
+                return
+            try:
+                self.target.handle(record)
+            except Exception:
+                self.target.handleError(record)
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.thread is not None and self.pid == os.getpid():
+            try:
+                self.queue.put(None, timeout=1)
+                self.thread.join(5)
+            except Queue.Full:
+                pass
+            self.thread = None
+            self.pid = None
+        self.target.close()
+        logging.Handler.close(self)
+
+
+def defaultLogger(name, format, level=logging.WARNING):
+    """
+    Returns the logger the plugin and middleware use when they aren't given one: records go to stdout via a
+    BackgroundLogHandler, and the level defaults to WARNING, which keeps the per-request DEBUG and INFO
+    messages from being produced at all. Asking for the same logger again doesn't add another handler.
+    """
+    logger = logging.getLogger(name)
+    if not [handler for handler in logger.handlers if isinstance(handler, BackgroundLogHandler)]:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter(format))
+        logger.addHandler(BackgroundLogHandler(handler))
+    logger.setLevel(level)
+    return logger
+
+
+# An ETag for a compressed representation is the ETag of the uncompressed one with the encoding tacked on
+ETAG_ENCODING_SUFFIX = re.compile(r'-(?:gzip|deflate|zstd)"$')
+
+
+def representationETag(etag, encoding):
+    """
+    Returns the ETag for the given content-encoding of a response whose uncompressed body has the given ETag,
+    e.g. '"abc"' becomes '"abc-gzip"'. Strong ETags have to differ between representations.
+    """
+    if not encoding or not etag.endswith('"') or ETAG_ENCODING_SUFFIX.search(etag):
+        return etag
+    return '%s-%s"' % (etag[:-1], encoding)
+
+
+def etagMatches(ifNoneMatch, etag):
+    """
+    Returns True if an If-None-Match request header matches the given ETag. The comparison is weak, as RFC 7232
+    asks for If-None-Match, and ignores content-encoding suffixes: a client that has either representation has an
+    up to date copy.
+    """
+    if not ifNoneMatch:
+        return False
+    if ifNoneMatch.strip() == '*':
+        return True
+
+    def opaque(tag):
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        return ETAG_ENCODING_SUFFIX.sub('"', tag)
+
+    target = opaque(etag)
+    return any(opaque(tag) == target for tag in re.findall(r'(?:W/)?"[^"]*"', ifNoneMatch))
+
+
+def notModified(etag, target=None):
+    """
+    Turns bottle's response (or target, an HTTPResponse) into an empty 304 for the given ETag, and returns the
+    (empty) body
+    """
+    target = target if target is not None else response
+    target.status = 304
+    target.set_header('ETag', etag)
+    for name in ('Content-Length', 'Content-Encoding', 'Content-Type'):
+        if name in target.headers:
+            del target.headers[name]
+    return ""
+
+
+def declareETag(version, weak=False):
+    """
+    Lets a handler declare the version of the resource it is about to produce before doing any expensive work.
+    If the client already has that version, this raises a 304 response straight away, so neither the rest of the
+    handler nor the JSON encoding and compression ever run. Otherwise the ETag is sent along with the response.
+
+    Args:
+        version (str, required): anything that changes whenever the resource does, e.g. a row's revision number
+        weak (bool, optional): declare a weak validator (the response is equivalent, not byte-identical)
+    """
+    etag = '%s"%s"' % ('W/' if weak else '', str(version).replace('"', ''))
+    response.set_header('ETag', etag)
+    if request.method in ('GET', 'HEAD') and etagMatches(request.headers.get('If-None-Match'), etag):
+        raise bottle.HTTPResponse(status=304, headers={'ETag': etag})
+
+
+class JSONBackend(object):
+    """
+    Adapts one JSON library to the three operations JSONCodec needs. Each backend is made to produce exactly what the
+    stdlib json module produces; JSONCodec checks that it really does before using it.
+    """
+    def __init__(self, name, dumpsCompact, dumpsPretty, loads, acceptsDefault=True, rawDecode=None):
+        """
+        Args:
+            name (str, required): the module name, e.g. "simplejson"
+            dumpsCompact (callable, required): dumpsCompact(obj, default) returns the compact JSON for obj
+            dumpsPretty (callable, required): dumpsPretty(obj, default) returns the indented, key-sorted JSON for obj
+            loads (callable, required): loads(text) decodes JSON
+            acceptsDefault (bool, optional): False if the library can't call a default() hook for unknown types,
+            in which case objects it refuses are encoded with the stdlib instead
+            rawDecode (callable, optional): rawDecode(text, pos) decodes the JSON value at pos in text, returning it
+            and where it ends. Backends without one leave it to the stdlib
+        """
+        self.name = name
+        self.dumpsCompact = dumpsCompact
+        self.dumpsPretty = dumpsPretty
+        self.loads = loads
+        self.acceptsDefault = acceptsDefault
+        self.rawDecode = rawDecode
+
+
+def _cachedEncoder(make):
+    """
+    Returns dumps(obj, default), which encodes with the encoder make(default) returns, made once per default hook.
+    json.dumps and simplejson.dumps make a new encoder on every call they're given options, which costs more than
+    encoding a small response does
+    """
+    encoders = {}
+
+    def dumps(obj, default):
+        encoder = encoders.get(default)
+        if encoder is None:
+            encoder = encoders[default] = make(default)
+        return encoder.encode(obj)
+    return dumps
+
+
+def _stdlibBackend():
+    return JSONBackend("json",
+                       _cachedEncoder(lambda default: json.JSONEncoder(separators=(',', ':'), default=default)),
+                       _cachedEncoder(lambda default: json.JSONEncoder(indent=4, sort_keys=True, default=default)),
+                       json.loads, rawDecode=json.JSONDecoder().raw_decode)
+
+
+def _simplejsonBackend():
+    import simplejson
+    # simplejson is a superset of json; switch off everything it does differently by default (NaN and Infinity
+    # are refused, both ways, by default since simplejson 4)
+    options = dict(use_decimal=False, namedtuple_as_object=False, tuple_as_array=True, bigint_as_string=False,
+                   for_json=False, iterable_as_array=False, allow_nan=True)
+    prettySeparators = (json.JSONEncoder(indent=4).item_separator, ': ')
+    decoder = simplejson.JSONDecoder(allow_nan=True)
+    return JSONBackend("simplejson",
+                       _cachedEncoder(lambda default: simplejson.JSONEncoder(separators=(',', ':'), default=default,
+                                                                             **options)),
+                       _cachedEncoder(lambda default: simplejson.JSONEncoder(indent=4, sort_keys=True,
+                                                                             separators=prettySeparators,
+                                                                             default=default, **options)),
+                       decoder.decode, rawDecode=decoder.raw_decode)
+
+
+def _ujsonBackend():
+    import ujson
+    return JSONBackend("ujson",
+                       lambda obj, default: ujson.dumps(obj, ensure_ascii=True, escape_forward_slashes=False),
+                       lambda obj, default: ujson.dumps(obj, ensure_ascii=True, escape_forward_slashes=False, indent=4,
+                                                        sort_keys=True),
+                       lambda text: ujson.loads(text, precise_float=True),
+                       acceptsDefault=False)
+
+
+class BinaryFormat(object):
+    """
+    A compact binary encoding of the same data JSON carries, which clients can ask for instead (see
+    RestwarePlugin's binaryFormats): responses in it when they name one of its media types in Accept, and
+    request bodies in it when their Content-Type is one of them.
+    """
+    def __init__(self, name, mediaTypes, dumps, loads, native=True):
+        """
+        Args:
+            name (str, required): what the format is called in binaryFormats, e.g. "msgpack"
+            mediaTypes (sequence of str, required): the media types it goes by, the one responses are labeled with
+            first
+            dumps (callable, required): dumps(obj, default) encodes obj, calling default() (see JSONCodec.default)
+            for types it can't represent itself
+            loads (callable, required): loads(data) decodes, with text as unicode, like json.loads
+            native (bool, optional): False when the library is running without its C extension, which makes it many
+            times slower than the JSON codec
+        """
+        self.name = name
+        self.mediaTypes = tuple(mediaTypes)
+        self.mediaType = self.mediaTypes[0]
+        self.dumps = dumps
+        self.loads = loads
+        self.native = native
+
+
+def _msgpackFormat():
+    import msgpack
+    # str and unicode both go out as text (msgpack's raw type), as they would in JSON. Without its C extension
+    # (e.g. a wheel built for another interpreter), msgpack falls back to a pure Python packer
+    return BinaryFormat("msgpack", ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack"),
+                        lambda obj, default: msgpack.packb(obj, use_bin_type=False, default=default),
+                        lambda data: msgpack.unpackb(data, raw=False),
+                        native=msgpack.Packer.__module__ != "msgpack.fallback")
+
+
+def jsonTypesOnly(obj, default):
+    """
+    Returns a copy of obj made only of the types JSON has: dicts, lists, text, numbers, booleans and None. str
+    becomes unicode, tuples become lists, and anything else is replaced by what default() (see JSONCodec.default)
+    makes of it, as it would be when encoding JSON
+    """
+    if isinstance(obj, unicode) or isinstance(obj, (bool, int, long, float)) or obj is None:
+        return obj
+    if isinstance(obj, str):
+        return obj.decode("utf-8")
+    if isinstance(obj, dict):
+        return dict((key.decode("utf-8") if isinstance(key, str) else key, jsonTypesOnly(value, default))
+                    for key, value in obj.iteritems())
+    if isinstance(obj, (list, tuple)):
+        return [jsonTypesOnly(item, default) for item in obj]
+    return jsonTypesOnly(default(obj), default)
+
+
+def _cborFormat():
+    import cbor2
+
+    # cbor2 has its own encodings for datetimes, Decimals, sets and so on, and takes str for bytes under Python 2.
+    # Handing it nothing but the types JSON has sends everything else through the codec's default(), and str out
+    # as text, exactly as for JSON (and msgpack)
+    def dumps(obj, default):
+        return cbor2.dumps(jsonTypesOnly(obj, default))
+
+    # without its C extension, cbor2 is pure Python; with it, copying to JSON types first still is
+    return BinaryFormat("cbor", ("application/cbor",), dumps, cbor2.loads, native=False)
+
+
+# name -> factory of every BinaryFormat we know; each needs its library installed
+BINARY_FORMAT_FACTORIES = collections.OrderedDict([("msgpack", _msgpackFormat), ("cbor", _cborFormat)])
+
+
+def loadBinaryFormats(names=None, logger=None):
+    """
+    Returns the BinaryFormats of the given names (True or None for all of them) whose library is installed. False
+    or an empty sequence loads none. A library that is installed but fails to load (e.g. a version we don't know)
+    is left out too, with a warning on the given logger
+    """
+    if names is False:
+        return []
+    formats = []
+    for name in (BINARY_FORMAT_FACTORIES.keys() if names in (None, True) else names):
+        try:
+            formats.append(BINARY_FORMAT_FACTORIES[name]())
+        except ImportError:
+            pass
+        except Exception, e:
+            if logger is not None:
+                logger.warn("Can't load the %s binary format (%s); leaving it out", name, e)
+    return formats
+
+
+def nestingDepth(data):
+    """
+    How deeply the dicts and lists of decoded data nest: 0 for a scalar, 1 for a flat list, and so on
+    """
+    deepest = 0
+    pending = [(data, 1)]
+    while pending:
+        value, depth = pending.pop()
+        if isinstance(value, dict):
+            value = value.values()
+        elif not isinstance(value, (list, tuple)):
+            continue
+        deepest = max(deepest, depth)
+        pending.extend((item, depth + 1) for item in value if isinstance(item, (dict, list, tuple)))
+    return deepest
+
+
+class JSONCodec(object):
+    """
+    Encodes and decodes JSON with the fastest library installed (ujson, simplejson, or the stdlib json module).
+
+    When the codec is created (and again whenever a type encoder is registered) it runs a self-check: every
+    available backend encodes and decodes a probe document, compact and pretty, and only backends whose output is
+    byte-identical to the stdlib's are considered. The fastest of those is then picked separately for compact
+    encoding, pretty encoding and decoding, so output never depends on which libraries happen to be installed.
+    Backends are only timed once, when the codec is created; registering a type re-runs the self-check alone.
+
+    Types JSON can't represent natively (datetime, Decimal, UUID, ...) can be given an encoder with register().
+    """
+    backendFactories = (("ujson", _ujsonBackend), ("simplejson", _simplejsonBackend), ("json", _stdlibBackend))
+
+    # Exercises escaping, unicode, big ints, float repr, NaN and Infinity, keys that aren't strings, key sorting and
+    # nesting
+    probe = {
+        "ascii": "plain text / with a slash",
+        "unicode": u"\u00e9\u2603 \"quoted\" \\ back\\slash \n\t\u0001",
+        "ints": [0, -1, 2 ** 31, -2 ** 63, 2 ** 64, 2 ** 100],
+        "floats": [0.1, -0.0, 1e-07, 3.141592653589793, 1e+300, 123456789.125, 2.5e-300],
+        "literals": [True, False, None],
+        "nonfinite": [float("nan"), float("inf"), -float("inf")],
+        "keys": {True: "bool", 2: "int", None: "none", 1.5: "float", 2 ** 64: "long"},
+        "nested": {"z": [], "a": {}, "m": [[1, [2, {"k": "v", "K": [1.5]}]]], "": ""},
+        u"\u00fcnicode key": {"b": 1, "a": 2, "B": 3},
+    }
+
+    # Typical API payloads, a large one and a small one, for timing the backends that pass the self-check
+    smallSample = {"status": "ok", "count": 3, "items": [1, 2, 3]}
+    sample = [{"id": i, "name": "item %d" % i, "price": i * 1.25, "tags": ["a", "b"], "active": i % 2 == 0, "parent": None}
+              for i in range(100)]
+
+    def __init__(self, backends=None, logger=None):
+        """
+        Args:
+            backends (list of str, optional): the libraries to consider, by module name. Defaults to all of them;
+            pass ["json"] to always use the stdlib
+            logger (logging.Logger, optional): where to report which backends were picked
+        """
+        self.backendNames = backends
+        self.logger = logger
+        self.typeEncoders = {}
+        # (backend name, operation) -> (seconds on the large sample, on the small one); see select()
+        self.timings = {}
+        self.select()
+
+    def register(self, cls, encoder):
+        """
+        Teaches the codec to encode instances of cls (and its subclasses).
+
+        Args:
+            cls (type, required): e.g. datetime.datetime
+            encoder (callable, required): given an instance, returns something JSON can represent, e.g. a string
+        """
+        self.typeEncoders[cls] = encoder
+        # a backend may handle cls natively, and differently; make sure it still agrees with the stdlib
+        self.select()
+
+    def default(self, obj):
+        """
+        The default() hook handed to the JSON libraries for objects they can't encode themselves
+        """
+        for cls in getattr(type(obj), "__mro__", (type(obj),)):
+            encoder = self.typeEncoders.get(cls)
+            if encoder is not None:
+                return encoder(obj)
+        raise TypeError("%r is not JSON serializable" % (obj,))
+
+    def _dumps(self, backend, obj, pretty):
+        dumps = backend.dumpsPretty if pretty else backend.dumpsCompact
+        if backend.acceptsDefault or backend is self.stdlib:
+            return dumps(obj, self.default)
+        try:
+            return dumps(obj, None)
+        except (TypeError, ValueError, OverflowError):
+            # something only the stdlib (or one of our registered encoders) can deal with
+            dumps = self.stdlib.dumpsPretty if pretty else self.stdlib.dumpsCompact
+            return dumps(obj, self.default)
+
+    def dumps(self, obj, pretty=False):
+        """
+        Returns obj as JSON: as compact as possible, or indented by 4 with sorted keys when pretty is True
+        """
+        return self._dumps(self.prettyEncoder if pretty else self.compactEncoder, obj, pretty)
+
+    def loads(self, text):
+        return self.decoder.loads(text)
+
+    def load(self, fp):
+        return self.decoder.loads(fp.read())
+
+    def rawDecode(self, text, pos=0):
+        """
+        Decodes the JSON value that starts at pos in text, which may go on after it. Returns the value and where it
+        ends; raises a ValueError if there's no valid JSON at pos
+        """
+        return (self.decoder.rawDecode or self.stdlib.rawDecode)(text, pos)
+
+    def _agrees(self, backend):
+        """
+        Returns which of ("compact", "pretty", "decode") the backend does exactly like the stdlib
+        """
+        class Unknown(object):
+            pass
+
+        agreed = set()
+        probe = dict(self.probe)
+        for cls in self.typeEncoders:
+            example = self._example(cls)
+            if example is not None:
+                probe["registered %s" % cls.__name__] = [example]
+        for mode, pretty in (("compact", False), ("pretty", True)):
+            dumps = backend.dumpsPretty if pretty else backend.dumpsCompact
+            # One entry at a time: a value the backend refuses (and the stdlib then encodes instead) must not hide
+            # a disagreement elsewhere in the document. Backends that take our default() hook are never second-
+            # guessed by the stdlib, so for them a refusal is a disagreement
+            for key, value in probe.items():
+                try:
+                    text = dumps({key: value}, self.default if backend.acceptsDefault else None)
+                except (TypeError, ValueError, OverflowError):
+                    if backend.acceptsDefault:
+                        break
+                    continue
+                if text != self._dumps(self.stdlib, {key: value}, pretty):
+                    break
+            else:
+                # objects nobody knows how to encode must still be refused rather than silently mangled
+                try:
+                    self._dumps(backend, [Unknown()], pretty)
+                except TypeError:
+                    agreed.add(mode)
+        try:
+            text = self._dumps(self.stdlib, self.probe, False)
+            # compared as JSON again, since NaN isn't equal to itself
+            if self._dumps(self.stdlib, backend.loads(text), False) == self._dumps(self.stdlib, json.loads(text), False):
+                agreed.add("decode")
+        except Exception:
+            pass
+        return agreed
+
+    def _example(self, cls):
+        """
+        Returns an instance of a registered type to check backends against, or None if we can't make one
+        """
+        import datetime
+        import decimal
+        import uuid
+        examples = {datetime.datetime: datetime.datetime(2001, 2, 3, 4, 5, 6, 7), datetime.date: datetime.date(2001, 2, 3),
+                    datetime.time: datetime.time(4, 5, 6, 7), decimal.Decimal: decimal.Decimal("3.14159265358979323846"),
+                    uuid.UUID: uuid.UUID(int=12345)}
+        return examples.get(cls)
+
+    def select(self):
+        """
+        Runs the self-check and picks the fastest agreeing backend for each operation. A backend is only picked
+        over the stdlib if it is faster on both a large and a small payload, since most responses are small
+        """
+        self.stdlib = _stdlibBackend()
+        candidates = []
+        for name, factory in self.backendFactories:
+            if self.backendNames is not None and name not in self.backendNames:
+                continue
+            try:
+                backend = self.stdlib if name == "json" else factory()
+            except ImportError:
+                continue
+            candidates.append((backend, self._agrees(backend) if backend is not self.stdlib else set(["compact", "pretty", "decode"])))
+
+        texts = dict((id(sample), json.dumps(sample)) for sample in (self.sample, self.smallSample))
+        operations = {
+            "compact": lambda backend, sample: self._dumps(backend, sample, False),
+            "pretty": lambda backend, sample: self._dumps(backend, sample, True),
+            "decode": lambda backend, sample: backend.loads(texts[id(sample)]),
+        }
+        chosen = {}
+        for mode, operation in operations.items():
+            agreeing = [backend for backend, agreed in candidates if mode in agreed]
+            if len(agreeing) < 2:
+                chosen[mode] = agreeing[0] if agreeing else self.stdlib
+                continue
+            # (seconds on the large sample, on the small one) for each backend; the samples hold no registered
+            # types, so registering one doesn't change them
+            for backend in agreeing:
+                if (backend.name, mode) not in self.timings:
+                    self.timings[(backend.name, mode)] = tuple(
+                        min(timeit.repeat(lambda: operation(backend, sample), number=number, repeat=3))
+                        for sample, number in ((self.sample, 5), (self.smallSample, 500)))
+            timings = dict((backend, self.timings[(backend.name, mode)]) for backend in agreeing)
+            stdlib = timings.get(self.stdlib)
+            faster = [backend for backend in agreeing if stdlib is None or backend is self.stdlib or
+                      (timings[backend][0] < stdlib[0] and timings[backend][1] < stdlib[1])]
+            chosen[mode] = min(faster, key=lambda backend: timings[backend][0])
+        self.compactEncoder, self.prettyEncoder, self.decoder = chosen["compact"], chosen["pretty"], chosen["decode"]
+        if self.logger:
+            self.logger.info("JSON backends: compact=%s pretty=%s decode=%s", self.compactEncoder.name, self.prettyEncoder.name, self.decoder.name)
+
+    @property
+    def name(self):
+        return self.compactEncoder.name
+
+
+class SchemaMismatch(Exception):
+    """
+    Raised by the encoders ResponseSchema compiles when a value doesn't have the shape the schema declares
+    """
+
+
+class ResponseSchema(object):
+    """
+    The shape of a route's responses, declared with schema=... in its route config, compiled into an encoder for
+    pretty-printed JSON. The generic path looks up how to encode every value, and sorts the keys of every dict, on
+    every request; the compiled one knows the keys, in order and already escaped, and the type of each value, so it
+    only checks that they are what the schema says and formats them into a template.
+
+    A schema is written with Python types: int, float, bool, str (any string), None (always null) and object
+    (anything, encoded by the codec); a list of one schema, e.g. [int], for lists of it; and a dict of schemas,
+    e.g. {"id": int, "tags": [str], "owner": {"email": str}}, for dicts with exactly those keys.
+
+    Like JSONCodec, the compiled encoder is checked against the codec on a sample built from the schema, and only
+    used if its output is identical. A response that doesn't fit the schema is encoded by the codec instead (see
+    encodeJSON), so the output never changes. Schemas are compiled when their route is added (see
+    RestwarePlugin.compileSchema), not on its first request. Compact JSON is always left to the codec: its
+    backends encode in C, which a Python encoder doesn't beat, and they write keys in the dicts' own order.
+    """
+    indent = 4
+    # the types of items a list of each scalar schema may hold, and how the list's items are encoded
+    listItems = {int: ("_INTS", "map(str, o)"), float: ("_FLOATS", "map(repr, o)"),
+                 bool: ("_BOOL_TYPES", "[_BOOLS[v] for v in o]"), str: ("_STRS", "map(_escape, o)")}
+
+    def __init__(self, schema, codec, logger=None):
+        """
+        Args:
+            schema (dict or list, required): the shape of the route's responses, see above
+            codec (JSONCodec, required): the route's codec, which encodes whatever doesn't fit
+            logger (logging.Logger, optional): where to report whether the compiled encoder is used
+
+        Raises a ValueError if the schema isn't one
+        """
+        if type(schema) not in (dict, list):
+            raise ValueError("A response schema must be a dict or a list, not %r" % (schema,))
+        self.schema = schema
+        self.codec = codec
+        self.logger = logger
+        self.counters = collections.defaultdict(int)
+        self.itemSeparator = json.JSONEncoder(indent=self.indent).item_separator
+        self.keySeparator = json.JSONEncoder(indent=self.indent).key_separator
+        self.functions = []
+        self.source = self.compile()
+        namespace = {"_INTS": frozenset([int, long]), "_FLOATS": frozenset([float]), "_BOOL_TYPES": frozenset([bool]),
+                     "_STRS": frozenset([str, unicode]), "_LISTS": frozenset([list, tuple]),
+                     "_DICTS": frozenset([dict]), "_BOOLS": {True: "true", False: "false"},
+                     "_escape": json.encoder.encode_basestring_ascii, "_pretty": lambda value: codec.dumps(value, True),
+                     "_Mismatch": SchemaMismatch}
+        exec self.source in namespace
+        self.prettyEncoder = self.select(namespace["encode"])
+
+    def newline(self, level):
+        return "\n" + " " * (self.indent * level)
+
+    def node(self, schema, level):
+        """
+        How a value of the given schema, nested level deep, is checked and encoded: returns (a function giving the
+        condition under which the variable of the given name doesn't fit, or None; its format in the enclosing
+        template; a function giving the expression that fills it in, or None)
+        """
+        if schema is int:
+            return lambda v: "type(%s) not in _INTS" % v, "%d", lambda v: v
+        if schema is float:
+            # v - v is nan, which is true, for nan and infinity, which JSON can't represent
+            return lambda v: "type(%s) is not float or %s - %s" % (v, v, v), "%r", lambda v: v
+        if schema is bool:
+            return lambda v: "type(%s) is not bool" % v, "%s", lambda v: "_BOOLS[%s]" % v
+        if schema in (str, unicode, basestring):
+            return lambda v: "type(%s) not in _STRS" % v, "%s", lambda v: "_escape(%s)" % v
+        if schema is None:
+            return lambda v: "%s is not None" % v, "null", None
+        if schema is object:
+            return None, "%s", lambda v: "_pretty(%s).replace('\\n', %r)" % (v, self.newline(level))
+        if type(schema) is list and len(schema) == 1:
+            name = self.listFunction(schema[0], level)
+            return lambda v: "type(%s) not in _LISTS" % v, "%s", lambda v: "%s(%s)" % (name, v)
+        if type(schema) is dict:
+            name = self.dictFunction(schema, level)
+            return lambda v: "type(%s) is not dict" % v, "%s", lambda v: "%s(%s)" % (name, v)
+        raise ValueError("Unsupported response schema: %r" % (schema,))
+
+    def listFunction(self, schema, level):
+        """
+        Generates the function that encodes a list of the given schema, nested level deep. Returns its name
+        """
+        index = len(self.functions)
+        name = "_list%d" % index
+        self.functions.append(None)
+        inner = self.newline(level + 1)
+        lines = ["def %s(o):" % name, "    if not o:", "        return '[]'"]
+        if schema is None:
+            lines += ["    if o.count(None) != len(o):", "        raise _Mismatch"]
+            items = "['null'] * len(o)"
+        elif schema is object:
+            items = "[_pretty(v).replace('\\n', %r) for v in o]" % inner
+        else:
+            if type(schema) is list and len(schema) == 1:
+                types, items = "_LISTS", "map(%s, o)" % self.listFunction(schema[0], level + 1)
+            elif type(schema) is dict:
+                types, items = "_DICTS", "map(%s, o)" % self.dictFunction(schema, level + 1)
+            elif schema in (str, unicode, basestring):
+                types, items = self.listItems[str]
+            elif schema in self.listItems:
+                types, items = self.listItems[schema]
+            else:
+                raise ValueError("Unsupported response schema: %r" % (schema,))
+            lines += ["    if not %s.issuperset(map(type, o)):" % types, "        raise _Mismatch"]
+        lines.append("    text = %r.join(%s)" % (self.itemSeparator + inner, items))
+        if schema is float:
+            lines += ["    if 'n' in text:", "        raise _Mismatch"]
+        lines.append("    return %r + text + %r" % ("[" + inner, self.newline(level) + "]"))
+        self.functions[index] = "\n".join(lines)
+        return name
+
+    def dictFunction(self, schema, level):
+        """
+        Generates the function that encodes a dict of the given schema, nested level deep. Returns its name
+        """
+        index = len(self.functions)
+        name = "_dict%d" % index
+        self.functions.append(None)
+        inner = self.newline(level + 1)
+        lines = ["def %s(o):" % name, "    if len(o) != %d:" % len(schema), "        raise _Mismatch"]
+        fragments = []
+        args = []
+        for i, key in enumerate(sorted(schema)):
+            if not isinstance(key, basestring):
+                raise ValueError("Response schema keys must be strings, not %r" % (key,))
+            check, placeholder, expression = self.node(schema[key], level + 1)
+            variable = "v%d" % i
+            lines.append("    %s = o[%r]" % (variable, key))
+            if check is not None:
+                lines += ["    if %s:" % check(variable), "        raise _Mismatch"]
+            fragments.append(json.encoder.encode_basestring_ascii(key).replace("%", "%%") + self.keySeparator + placeholder)
+            if expression is not None:
+                args.append(expression(variable))
+        if fragments:
+            template = "{" + inner + (self.itemSeparator + inner).join(fragments) + self.newline(level) + "}"
+        else:
+            template = "{}"
+        lines.append("    return %r %% (%s)" % (template, "".join(arg + ", " for arg in args)))
+        self.functions[index] = "\n".join(lines)
+        return name
+
+    def compile(self):
+        """
+        Returns the source of the encoder: a function per list and dict of the schema, and encode(), which takes
+        the whole response
+        """
+        check, _, expression = self.node(self.schema, 0)
+        root = ["def encode(o):", "    if %s:" % check("o"), "        raise _Mismatch", "    return %s" % expression("o")]
+        return "\n\n".join(self.functions + ["\n".join(root)]) + "\n"
+
+    def sample(self, schema, count=100, text="sample text"):
+        """
+        Returns a value of the given schema, with count items in each list (fewer in nested ones) and text in each
+        string
+        """
+        if schema is int:
+            return 1234567
+        if schema is float:
+            return 1234.5678
+        if schema is bool:
+            return True
+        if schema in (str, unicode, basestring):
+            return text
+        if schema is None:
+            return None
+        if schema is object:
+            return {"b": [1, 2.5, None], "a": {"c": "d"}}
+        if type(schema) is list:
+            return [self.sample(schema[0], 3, text) for _ in range(count)]
+        return dict((key, self.sample(value, 3, text)) for key, value in schema.items())
+
+    def select(self, encode):
+        """
+        Returns the compiled encoder if it produces exactly what the codec does for a sample of the schema; None
+        otherwise. It isn't timed against the codec: the choice would then depend on the machine's load, and
+        the compiled encoder falls back to the codec for whatever it doesn't handle anyway
+        """
+        # with strings that need escaping
+        sample = self.sample(self.schema, 3, u"sample \u00e9 \"text\"\n")
+        try:
+            agrees = encode(sample) == self.codec.dumps(sample, True)
+        except (SchemaMismatch, KeyError):
+            agrees = False
+        if not agrees:
+            if self.logger:
+                self.logger.warn("compiled encoder of response schema %r disagrees with the codec; not using it", self.schema)
+            return None
+        return encode
+
+    def dumpsPretty(self, obj):
+        """
+        Returns obj as pretty-printed JSON, or None if it doesn't fit the schema (or the compiled encoder isn't used)
+        """
+        if self.prettyEncoder is None:
+            return None
+        try:
+            text = self.prettyEncoder(obj)
+        except (SchemaMismatch, KeyError):
+            self.counters["mismatched"] += 1
+            return None
+        self.counters["encoded"] += 1
+        return text
+
+    def stats(self):
+        """
+        Returns whether the compiled encoder is used (compiled), and how many responses it encoded and how many
+        didn't fit the schema
+        """
+        stats = dict(self.counters)
+        stats["compiled"] = self.prettyEncoder is not None
+        return stats
+
+
+class JSONArrayStream(object):
+    """
+    A WSGI response iterable that serializes a list, generator or iterator as a JSON array a batch of items at a
+    time, optionally compressing it as it goes. Memory use stays proportional to one chunk rather than the whole
+    document, and the first bytes reach the client as soon as the first batch is encoded.
+
+    The output is byte-for-byte what json.dumps would have produced for the equivalent list, both for the compact
+    and the pretty-printed representations. Given one of RECORD_STREAM_TYPES as its format, it writes one compact
+    JSON text per item instead: newline-delimited JSON, or an RFC 7464 JSON text sequence.
+    """
+    # how many items are handed to the JSON encoder at once
+    batchSize = 256
+    # roughly how much text is accumulated before it is compressed and handed to the webserver
+    chunkSize = 64 * 1024
+
+    def __init__(self, items, pretty=False, encoding=None, compresslevel=6, logger=None, codec=None, format=None):
+        """
+        Args:
+            items (iterable, required): the list, generator or iterator to serialize
+            pretty (bool, optional): indent and sort keys, as for the "pretty" query parameter
+            encoding (str, optional): compress the output with this content-encoding, e.g. "gzip"
+            compresslevel (int, optional): the compression level (see compressor())
+            logger (logging.Logger, optional): where to report errors that occur mid-stream
+            codec (JSONCodec, optional): what to encode the items with. Defaults to the stdlib json module
+            format (str, optional): "application/x-ndjson" or "application/json-seq" to write one record per item
+                rather than a JSON array. Records are never pretty-printed, as each has to fit on one line
+        """
+        self.items = items
+        self.format = format
+        self.recordPrefix = "\x1e" if format == "application/json-seq" else ""
+        self.pretty = pretty
+        self.logger = logger
+        self.compressor = compressor(encoding, compresslevel) if encoding else None
+        self.codec = codec or JSONCodec(backends=["json"])
+        if pretty:
+            self.prefix, self.suffix, self.separator = "[\n", "\n]", json.JSONEncoder(indent=4).item_separator + "\n"
+        else:
+            self.prefix, self.suffix, self.separator = "[", "]", ","
+
+    def encodeBatch(self, batch):
+        """
+        Returns the items in ``batch`` serialized and joined as they would appear inside a JSON array
+        """
+        text = self.codec.dumps(batch, self.pretty)
+        # strip the brackets (and, when pretty, the newlines next to them) that wrap this batch on its own
+        return text[len(self.prefix):-len(self.suffix)]
+
+    def iterText(self):
+        """
+        Yields the uncompressed JSON text in pieces of roughly chunkSize characters
+        """
+        pieces, size, wroteItem = [], 0, False
+        batch = []
+        for item in self.items:
+            batch.append(item)
+            if len(batch) < self.batchSize:
+                continue
+            text = self.encodeBatch(batch)
+            batch = []
+            pieces.append((self.separator if wroteItem else self.prefix) + text)
+            wroteItem = True
+            size += len(pieces[-1])
+            if size >= self.chunkSize:
+                yield "".join(pieces)
+                pieces, size = [], 0
+        if batch:
+            pieces.append((self.separator if wroteItem else self.prefix) + self.encodeBatch(batch))
+            wroteItem = True
+        pieces.append(self.suffix if wroteItem else "[]")
+        yield "".join(pieces)
+
+    def iterRecords(self):
+        """
+        Yields the uncompressed records, one JSON text per item, in pieces of roughly chunkSize characters
+        """
+        pieces, size = [], 0
+        dumps, prefix = self.codec.dumps, self.recordPrefix
+        for item in self.items:
+            pieces.append(prefix + dumps(item) + "\n")
+            size += len(pieces[-1])
+            if size >= self.chunkSize:
+                yield "".join(pieces)
+                pieces, size = [], 0
+        if pieces:
+            yield "".join(pieces)
+
+    def __iter__(self):
+        try:
+            for text in (self.iterRecords() if self.format else self.iterText()):
+                if self.compressor is None:
+                    yield text
+                    continue
+                data = self.compressor.compress(text)
+                if data:
+                    yield data
+            if self.compressor is not None:
+                yield self.compressor.flush()
+        except Exception, e:
+            # the status line and headers are long gone; all we can do is cut the response short
+            if self.logger:
+                self.logger.error("failed to stream JSON response, truncating it: %s", e)
+            raise
+
+    def close(self):
+        if hasattr(self.items, "close"):
+            self.items.close()
+
+
+class CachedResponse(object):
+    """
+    A fully encoded (and possibly compressed) response body, with the status and headers that go with it. A
+    compressed variant of a static document also keeps the document it was made from, its source
+    """
+    def __init__(self, status, headers, body, expires, source=None):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.expires = expires
+        self.source = source
+        # what it counts for in a ResponseCache's memory budget
+        self.size = len(body) + (len(source) if source is not None else 0)
+
+    def replay(self):
+        """
+        Sets up bottle's response exactly as it was when this was cached, and returns the body (or answers with
+        a 304 if the client already has it)
+        """
+        response.status = self.status
+        seen = set()
+        for name, value in self.headers:
+            if name in seen:
+                response.add_header(name, value)
+            else:
+                response.set_header(name, value)
+                seen.add(name)
+        etag = response.headers.get('ETag')
+        if etag and etagMatches(request.headers.get('If-None-Match'), etag):
+            return notModified(etag)
+        return self.body
+
+
+class ResponseCache(object):
+    """
+    A thread-safe cache of serialized responses with a per-entry TTL, evicting the least recently used entries once
+    the cached bodies (and sources, see CachedResponse) exceed a memory budget.
+
+    Keys are tuples that start with the route rule and its URL arguments (see RestwarePlugin.cacheKey), which is
+    what invalidate() matches on.
+    """
+    def __init__(self, maxBytes=32 * 1024 * 1024):
+        """
+        Args:
+            maxBytes (int, optional): how many bytes of response bodies to keep, at most. Defaults to 32MiB
+        """
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def afterFork(self):
+        """
+        Makes the cache safe to use in a newly forked process. The entries the parent had are kept, so the child
+        starts warm, but the lock is replaced: another thread may have been holding it at the fork
+        """
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, source=None):
+        """
+        Returns the CachedResponse stored under key, or None if there is none, it has expired, or a source is given
+        and the entry wasn't made from it
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry.expires < time.time() or (source is not None and entry.source != source):
+                if entry is not None:
+                    self.size -= entry.size
+                self.misses += 1
+                return None
+            # re-inserting makes it the most recently used
+            self.entries[key] = entry
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        if entry.size > self.maxBytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous.size
+            self.entries[key] = entry
+            self.size += entry.size
+            while self.size > self.maxBytes:
+                oldKey, oldEntry = self.entries.popitem(last=False)
+                self.size -= oldEntry.size
+                self.evictions += 1
+
+    def invalidate(self, rule=None, **urlArgs):
+        """
+        Drops cached responses. With no arguments, everything goes; otherwise only entries for the given route rule,
+        and among those only the ones whose URL arguments include all of urlArgs.
+
+        Args:
+            rule (str, optional): e.g. "/api/v1/key/<keyName>"
+            urlArgs (optional): e.g. keyName="foo"
+        """
+        with self.lock:
+            for key in self.entries.keys():
+                if rule is not None and key[0] != rule:
+                    continue
+                if urlArgs and not set(urlArgs.items()).issubset(key[1]):
+                    continue
+                self.size -= self.entries.pop(key).size
+
+
+class Flight(object):
+    """
+    One request in progress on behalf of several identical ones; see SingleFlight
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.outcome = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces identical concurrent requests: the first (the leader) is handled as usual, while the ones that arrive
+    before it finishes (the followers) wait for its outcome and share it, for at most ``timeout`` seconds each.
+
+    The outcome is whatever the leader's response can be replayed as: a ("replay", CachedResponse) for a serialized
+    body, a ("return", HTTPResponse) or ("raise", HTTPResponse) for one the handler returned or raised, or None
+    when it can't be shared (a streamed body, a Set-Cookie, an exception). Followers that get None, or give up
+    waiting, handle the request themselves.
+    """
+    def __init__(self, timeout=5.0):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.flights = {}
+        # leaders, coalesced (followers that shared an outcome), unshared (followers of an outcome that couldn't
+        # be shared) and expired (followers that gave up waiting)
+        self.counters = collections.defaultdict(int)
+
+    def join(self, key):
+        """
+        Returns (the Flight for key, whether the caller is its leader). The leader must call land() when it is done
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self.flights[key] = Flight()
+            self.counters["leaders"] += 1
+            return flight, True
+
+    def land(self, key, flight, outcome):
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+        flight.outcome = outcome
+        flight.done.set()
+
+    def wait(self, flight):
+        """
+        Returns the leader's outcome, or None if there is none to share or it didn't come within the timeout
+        """
+        if not flight.done.wait(self.timeout):
+            counter = "expired"
+        elif flight.outcome is None:
+            counter = "unshared"
+        else:
+            counter = "coalesced"
+        with self.lock:
+            self.counters[counter] += 1
+        return flight.outcome if counter == "coalesced" else None
+
+    def afterFork(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.counters = collections.defaultdict(int)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["inFlight"] = len(self.flights)
+        return stats
+
+
+def setsCookies(resp):
+    """
+    Whether a response sets cookies, either as Set-Cookie headers or through set_cookie() (which keeps them apart
+    until its headerlist is built)
+    """
+    return any(name == "Set-Cookie" for name, value in resp.headerlist)
+
+
+def regularFileStat(fileobj):
+    """
+    Returns os.fstat() of a file-like object backed by a regular file (like the ones bottle.static_file opens),
+    or None for anything else
+    """
+    try:
+        stats = os.fstat(fileobj.fileno())
+    except (AttributeError, EnvironmentError, ValueError):
+        return None
+    return stats if stat.S_ISREG(stats.st_mode) else None
+
+
+class CountingReader(object):
+    """
+    Reads at most ``length`` bytes (if given) from a file-like object, keeping count of how many it has read
+    """
+    def __init__(self, fileobj, length=None):
+        self.fileobj = fileobj
+        self.remaining = length
+        self.count = 0
+
+    def read(self, size):
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+            if size <= 0:
+                return ""
+        data = self.fileobj.read(size)
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        self.count += len(data)
+        return data
+
+
+class ChunkedReader(object):
+    """
+    Reads a request body sent with Transfer-Encoding: chunked from a wsgi.input that still holds the chunked
+    framing, as bottle expects it to when that header is set. chunks() yields the data of each chunk as it arrives
+    (in pieces of at most readSize bytes), and count is how many bytes of data have been read so far. Malformed
+    framing raises a RequestBodyError (400), with bottle's own message.
+    """
+    readSize = 64 * 1024
+    maxHeaderSize = 1024
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def fail(self):
+        raise RequestBodyError(400, "Error while parsing chunked transfer body.")
+
+    def chunks(self):
+        read = self.fileobj.read
+        while True:
+            # the chunk size in hex, maybe followed by extensions, which are ignored
+            header = read(1)
+            while header[-2:] != "\r\n":
+                c = read(1)
+                if not c or len(header) > self.maxHeaderSize:
+                    self.fail()
+                header += c
+            try:
+                size = int(header.partition(";")[0].strip(), 16)
+            except ValueError:
+                self.fail()
+            if size < 0:
+                self.fail()
+            if size == 0:
+                # the last chunk. Like bottle, leave any trailer fields unread
+                return
+            while size > 0:
+                data = read(min(size, self.readSize))
+                if not data:
+                    self.fail()
+                size -= len(data)
+                self.count += len(data)
+                yield data
+            if read(2) != "\r\n":
+                self.fail()
+
+
+def zlibDecompressor(encoding, head):
+    """
+    Returns a zlib decompressobj for "gzip" or "deflate" data starting with the bytes in head (at least two of
+    them, for deflate): zlib-wrapped deflate if it has a valid zlib header, raw deflate otherwise
+    """
+    if encoding == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    header = bytearray(head[:2])
+    if len(header) == 2 and header[0] & 0x0f == 8 and ((header[0] << 8) | header[1]) % 31 == 0:
+        return zlib.decompressobj(zlib.MAX_WBITS)
+    return zlib.decompressobj(-zlib.MAX_WBITS)
+
+
+def malformedBodyMessage(encoding, error):
+    """
+    The message a request body that can't be inflated is refused with. zstandard's errors name the API that raised
+    them ("zstd decompress error: ...", "zstd decompressor error: ..."), which is dropped so the message is the same
+    however the body was read
+    """
+    detail = re.sub(r"^zstd decompress(?:or)? error: ", "", str(error))
+    return "Malformed %s data in request body: %s" % (encoding, detail)
+
+
+def zlibStreamEnded(inflater):
+    """
+    Whether a zlib decompressobj has seen the whole stream, trailer included. Python 2's decompressobj has no eof
+    attribute, so a copy of it is given one more byte: once the stream is over, zlib sets that aside as unused_data
+    instead of inflating it. Must be asked before flush(), after which the decompressobj can't be copied
+    """
+    eof = getattr(inflater, "eof", None)
+    if eof is not None:
+        return eof
+    if inflater.unused_data:
+        return True
+    probe = inflater.copy()
+    try:
+        probe.decompress("\x00")
+    except zlib.error:
+        return False
+    return bool(probe.unused_data)
+
+
+class ZlibDecoder(object):
+    """
+    Inflates gzip (one or more concatenated members) or deflate data read from a source, never producing more than
+    the caller asks for at once. "deflate" is supposed to be zlib-wrapped, but plenty of clients send raw deflate
+    data; the header tells us which it is.
+    """
+    readSize = 64 * 1024
+
+    def __init__(self, source, encoding):
+        """
+        Args:
+            source (file-like, required): where the compressed data comes from
+            encoding (str, required): "gzip" or "deflate"
+        """
+        self.source = source
+        self.encoding = encoding
+        self.inflater = None
+        self.pending = ""
+
+    def newInflater(self):
+        return zlibDecompressor(self.encoding, self.pending[:2])
+
+    def read(self, wanted):
+        """
+        Returns up to ``wanted`` bytes of newly inflated data, or an empty string once the data is exhausted
+        """
+        while True:
+            if not self.pending:
+                self.pending = self.source.read(self.readSize)
+                if not self.pending:
+                    if self.inflater is None:
+                        return ""
+                    ended = zlibStreamEnded(self.inflater)
+                    data = self.inflater.flush()
+                    if not ended:
+                        raise zlib.error("truncated data")
+                    self.inflater = None
+                    return data
+            if self.inflater is None:
+                self.inflater = self.newInflater()
+            data = self.inflater.decompress(self.pending, wanted)
+            self.pending = self.inflater.unconsumed_tail
+            if self.inflater.unused_data:
+                if self.encoding == "gzip":
+                    # one gzip member finished and another follows it. unused_data is all the input left over:
+                    # Python 2 leaves a copy of it in unconsumed_tail as well
+                    self.pending = self.inflater.unused_data
+                    self.inflater = self.newInflater()
+                else:
+                    # anything after the end of a deflate stream is junk
+                    self.pending = ""
+            if data:
+                return data
+
+
+class ZstdFrames(object):
+    """
+    Follows the frame and block headers of zstd data as it goes by, without decompressing it, to tell where each
+    frame ends and whether the data stopped partway through one. zstandard's decompressors report neither: a
+    truncated frame just inflates to less. Given a source, it can stand in for it, following what is read through it.
+    """
+    MAGIC = 0xFD2FB528
+    # frame content size field sizes, by flag, when the frame isn't single segment and when it is
+    contentSizeLengths = ((0, 2, 4, 8), (1, 2, 4, 8))
+    dictionaryIdLengths = (0, 1, 2, 4)
+
+    def __init__(self, source=None):
+        self.source = source
+        self.position = 0
+        # the header being collected ("magic", "descriptor", "block" or "skippable") and how long it is
+        self.expect = "magic"
+        self.needed = 4
+        self.header = ""
+        # bytes of frame header or block content still to pass over, and whether the frame ends after them
+        self.skip = 0
+        self.frameEnding = False
+        self.checksum = False
+        self.invalid = False
+
+    def read(self, size):
+        data = self.source.read(size)
+        self.feed(data)
+        return data
+
+    def feed(self, data):
+        """
+        Follows the next piece of the data. Returns the positions, counted from the start of the data, at which
+        frames end within it
+        """
+        ends = []
+        start = self.position
+        pos = 0
+        while not self.invalid:
+            if self.skip:
+                step = min(self.skip, len(data) - pos)
+                self.skip -= step
+                pos += step
+                if self.skip:
+                    break
+            if self.frameEnding:
+                self.frameEnding = False
+                ends.append(start + pos)
+            if pos == len(data):
+                break
+            take = min(self.needed - len(self.header), len(data) - pos)
+            self.header += data[pos:pos + take]
+            pos += take
+            if len(self.header) < self.needed:
+                break
+            self.advance()
+            self.header = ""
+        self.position += len(data)
+        return ends
+
+    def advance(self):
+        """
+        Interprets the header just collected, and works out what comes after it
+        """
+        if self.expect == "magic":
+            magic = struct.unpack("<I", self.header)[0]
+            if magic == self.MAGIC:
+                self.expect, self.needed = "descriptor", 1
+            elif magic & 0xFFFFFFF0 == 0x184D2A50:
+                self.expect, self.needed = "skippable", 4
+            else:
+                self.invalid = True
+        elif self.expect == "descriptor":
+            descriptor = ord(self.header)
+            singleSegment = descriptor >> 5 & 1
+            self.checksum = bool(descriptor >> 2 & 1)
+            self.skip = (1 - singleSegment) + self.dictionaryIdLengths[descriptor & 3] + \
+                self.contentSizeLengths[singleSegment][descriptor >> 6]
+            self.expect, self.needed = "block", 3
+        elif self.expect == "block":
+            value = struct.unpack("<I", self.header + "\x00")[0]
+            blockType = value >> 1 & 3
+            if blockType == 3:
+                self.invalid = True
+                return
+            # an RLE block holds the one byte it repeats
+            self.skip = 1 if blockType == 1 else value >> 3
+            if value & 1:
+                self.skip += 4 if self.checksum else 0
+                self.frameEnding = True
+                self.expect, self.needed = "magic", 4
+        else:
+            self.skip = struct.unpack("<I", self.header)[0]
+            self.frameEnding = True
+            self.expect, self.needed = "magic", 4
+
+    @property
+    def complete(self):
+        """
+        Whether the data so far ends with a whole frame (or is empty)
+        """
+        return self.expect == "magic" and not self.header and not self.skip and not self.frameEnding
+
+
+class ZstdDecoder(object):
+    """
+    Decompresses zstd data (one or more frames) read from a source, never producing more than the caller asks for
+    at once. Requires the zstandard package.
+    """
+    def __init__(self, source):
+        self.frames = ZstdFrames(source)
+        self.reader = zstandard.ZstdDecompressor().stream_reader(self.frames, read_size=64 * 1024,
+                                                                 read_across_frames=True)
+
+    def read(self, wanted):
+        data = self.reader.read(wanted)
+        if not data:
+            if self.frames.invalid:
+                raise zstandard.ZstdError("unknown frame descriptor")
+            if not self.frames.complete:
+                raise zstandard.ZstdError("truncated data")
+        return data
+
+
+def compressor(encoding, level):
+    """
+    Returns an object with compress(data) and flush() methods that produces the given content-encoding.
+
+    Args:
+        encoding (str, required): "gzip", "deflate" or "zstd" (see CONTENT_ENCODINGS)
+        level (int, required): the compression level, on the scale of the library behind the encoding (1-9 for
+        gzip and deflate, 1-22 for zstd)
+    """
+    if encoding == "gzip":
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    raise ValueError("unsupported content-encoding %r" % encoding)
+
+
+def compress(data, encoding, level):
+    """
+    Returns data compressed with the given content-encoding in one go. See compressor().
+    """
+    return "".join(compressChunks(data, encoding, level))
+
+
+def compressChunks(data, encoding, level):
+    """
+    Like compress(), but returns the compressed data as a BodyChunks rather than joining its pieces into one string
+    """
+    compressobj = compressor(encoding, level)
+    return BodyChunks([compressobj.compress(data), compressobj.flush()])
+
+
+class BodyChunks(object):
+    """
+    A response body kept as the pieces it was produced in, e.g. the output of a compressor, rather than copied
+    into one string. It has a len() and can be iterated any number of times, so it can be cached and replayed.
+
+    Bottle joins lists of strings into one before sending them, but passes other iterables to the webserver a
+    piece at a time, which is why this isn't simply a list.
+    """
+    def __init__(self, chunks):
+        self.chunks = [chunk for chunk in chunks if chunk]
+        self.size = sum(len(chunk) for chunk in self.chunks)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def __str__(self):
+        return "".join(self.chunks)
+
+
+class LazyBodyChunks(object):
+    """
+    A response body that is still being produced, e.g. a long list being encoded as JSON a batch of items at a time
+    (see JSONArrayStream.iterText). Pieces are only pulled from the iterator as they are needed, and iterating the
+    body hands each piece over once and lets go of it, so a body that is compressed as it is iterated is never held
+    whole, neither as one string nor as pieces. size counts the bytes pulled so far.
+    """
+    def __init__(self, pieces):
+        self.pieces = iter(pieces)
+        self.pulled = []
+        self.size = 0
+
+    def reaches(self, size):
+        """
+        True if the body is at least size bytes long, pulling no more pieces than it takes to tell
+        """
+        while self.size < size:
+            piece = next(self.pieces, None)
+            if piece is None:
+                return False
+            self.pulled.append(piece)
+            self.size += len(piece)
+        return True
+
+    def __iter__(self):
+        pulled, self.pulled = self.pulled[::-1], []
+        while pulled:
+            yield pulled.pop()
+        for piece in self.pieces:
+            self.size += len(piece)
+            yield piece
+
+    def collect(self):
+        """
+        Returns the rest of the body as a BodyChunks
+        """
+        return BodyChunks(self)
+
+
+class PoolTask(object):
+    """
+    A unit of work submitted to a WorkerPool; result() waits for it and returns its result (or raises its exception)
+    """
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.done = threading.Event()
+        self.value = self.error = None
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args)
+        except Exception:
+            self.error = sys.exc_info()
+        finally:
+            self.done.set()
+
+    def result(self):
+        self.done.wait()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+
+class WorkerPool(object):
+    """
+    A fixed number of daemon threads working through a bounded queue. Threads are only started on first use.
+
+    This is meant for work that releases the GIL, like zlib compression: request threads hand it chunks to compress
+    and wait for them, so one huge response is compressed on several cores while other requests keep being served.
+    """
+    def __init__(self, size, maxQueue):
+        """
+        Args:
+            size (int, required): how many threads to run
+            maxQueue (int, required): how many tasks may wait for a thread; submit() refuses any more
+        """
+        self.size = size
+        self.queue = Queue.Queue(maxQueue)
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def afterFork(self):
+        """
+        Forgets the parent process's threads and queued tasks after a fork; threads don't survive one. New threads
+        start on first use, as usual
+        """
+        self.queue = Queue.Queue(self.queue.maxsize)
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, func, *args):
+        """
+        Queues func(*args). Returns a PoolTask, or None if the queue is full and the caller should do it itself.
+        """
+        if not self.threads:
+            with self.lock:
+                while len(self.threads) < self.size:
+                    thread = threading.Thread(target=self.work, name="restware-worker-%d" % len(self.threads))
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+        task = PoolTask(func, args)
+        try:
+            self.queue.put_nowait(task)
+        except Queue.Full:
+            return None
+        return task
+
+    def work(self):
+        while True:
+            self.queue.get().run()
+
+
+def deflateChunk(data, start, end, level, last):
+    """
+    Compresses data[start:end] into a piece of a raw deflate stream. Pieces are byte-aligned (each ends with a
+    sync flush) and only the last one closes the stream, so compressing them separately and concatenating them
+    gives one valid stream.
+    """
+    compressobj = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressobj.compress(buffer(data, start, end - start)), compressobj.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def compressInParallel(data, encoding, level, pool, chunkSize):
+    """
+    Compresses data as gzip or deflate (the zlib-wrapped kind), deflating chunkSize pieces of it concurrently on
+    the given WorkerPool. Pieces the pool has no room for are compressed by the calling thread.
+
+    Returns:
+        a (compressed data as a BodyChunks, number of pieces offloaded to the pool) tuple
+    """
+    ranges = [(start, min(start + chunkSize, len(data))) for start in xrange(0, len(data), chunkSize)]
+    tasks = [pool.submit(deflateChunk, data, start, end, level, end == len(data)) for start, end in ranges]
+    # the checksum is cheap next to deflating; work it out while the pool is busy
+    if encoding == "gzip":
+        header = struct.pack("<BBBBIBB", 0x1f, 0x8b, 8, 0, 0, 0, 255)
+        trailer = struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+    else:
+        header = "\x78\x9c"
+        trailer = struct.pack(">I", zlib.adler32(data) & 0xffffffff)
+    pieces = [header]
+    for (start, end), task in zip(ranges, tasks):
+        pieces.extend(task.result() if task is not None else deflateChunk(data, start, end, level, end == len(data)))
+    pieces.append(trailer)
+    return BodyChunks(pieces), len(tasks) - tasks.count(None)
+
+
+def estimateJSONSize(data, samples=16):
+    """
+    Roughly how many bytes data comes to as compact JSON, without encoding it: strings count their length and other
+    scalars a few bytes, and lists and dicts the estimate of a sample of their items (spread over a list, the first
+    ones of a dict) scaled up to how many they hold. Each level of nesting samples half as many items as the one
+    above it, so this costs next to nothing however large data is.
+    """
+    if isinstance(data, basestring):
+        return len(data) + 2
+    if isinstance(data, dict):
+        if not data:
+            return 2
+        sample = list(itertools.islice(data.iteritems(), samples))
+        size = sum(len(key if isinstance(key, basestring) else str(key)) + 4 + estimateJSONSize(value, max(samples // 2, 1))
+                   for key, value in sample)
+        return size * len(data) // len(sample) + 1
+    if isinstance(data, (list, tuple)):
+        if not data:
+            return 2
+        sample = data[::max(len(data) // samples, 1)][:samples]
+        size = sum(estimateJSONSize(item, max(samples // 2, 1)) + 1 for item in sample)
+        return size * len(data) // len(sample) + 1
+    return 8
+
+
+# these live in the processes of RestwarePlugin's JSON encoding pool
+_workerCodec = None
+
+
+def _initJSONWorker(codec):
+    global _workerCodec
+    _workerCodec = codec
+
+
+def _encodeJSONInWorker(payload, pretty):
+    # The payload arrives pickled by us rather than by the pool: if it can't be unpickled here, that is an ordinary
+    # exception returned to the caller instead of a dead worker and a pool that waits forever
+    return _workerCodec.dumps(cPickle.loads(payload), pretty)
+
+
+# Content types that are already compressed, so compressing them again only burns CPU
+INCOMPRESSIBLE_TYPES = ("image/png", "image/jpeg", "image/gif", "image/webp", "video/", "audio/", "font/woff",
+                        "application/zip", "application/gzip", "application/x-gzip", "application/zstd",
+                        "application/x-bzip2", "application/x-xz", "application/x-7z-compressed")
+
+
+def parseQualityList(header):
+    """
+    Parses an Accept-style header, e.g. "gzip;q=0.8, br, *;q=0", into a list of (lowercased value, q) tuples in the
+    order given. Parameters other than q are dropped.
+    """
+    result = []
+    for item in header.split(","):
+        parts = item.split(";")
+        value = parts[0].strip().lower()
+        if not value:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, number = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(number.strip())
+                except ValueError:
+                    quality = 0.0
+        result.append((value, quality))
+    return result
+
+
+def negotiateContentEncoding(acceptEncoding, available=CONTENT_ENCODINGS):
+    """
+    Picks the content-encoding for a response from the client's Accept-Encoding header.
+
+    Args:
+        acceptEncoding (str, required): the Accept-Encoding request header; may be empty
+        available (sequence of str, optional): the encodings we may use, most preferred first
+
+    Returns:
+        the encoding with the highest q-value (ties go to the first in ``available``), or None if the body should
+        be sent as-is: nothing acceptable is available, or the client prefers identity
+    """
+    if not acceptEncoding:
+        return None
+    qualities = {}
+    for value, quality in parseQualityList(acceptEncoding):
+        qualities.setdefault("gzip" if value == "x-gzip" else value, quality)
+    wildcard = qualities.get("*")
+    best, bestQuality = None, 0.0
+    for encoding in available:
+        quality = qualities.get(encoding, wildcard or 0.0)
+        if quality > bestQuality:
+            best, bestQuality = encoding, quality
+    # identity is always acceptable unless the client rules it out, but loses to anything it asked for explicitly
+    identityQuality = qualities.get("identity", wildcard if wildcard is not None else 0.001)
+    if best is None or bestQuality < identityQuality:
+        return None
+    return best
+
+
+# media types a list or iterator can be sent as, one JSON text per item, instead of as a single JSON array
+RECORD_STREAM_TYPES = ("application/x-ndjson", "application/json-seq")
+
+
+def negotiateRecordFormat(accept, available=RECORD_STREAM_TYPES):
+    """
+    Picks how a list or iterator should be sent from the client's Accept header. Also picks between JSON and the
+    media types of binary formats (see BinaryFormat).
+
+    Args:
+        accept (str, required): the Accept request header; may be empty
+        available (sequence of str, optional): the media types we may use instead of JSON, most preferred first
+
+    Returns:
+        the media type the client asked for by name, as long as it likes it at least as much as application/json,
+        or None to send JSON (a JSON array, for a list). Wildcards never select anything but JSON
+    """
+    if not accept:
+        return None
+    qualities = {}
+    for value, quality in parseQualityList(accept):
+        qualities.setdefault(value, quality)
+    jsonQuality = qualities.get("application/json", qualities.get("application/*", qualities.get("*/*", 0.0)))
+    best, bestQuality = None, 0.0
+    for recordFormat in available:
+        quality = qualities.get(recordFormat, 0.0)
+        if quality > bestQuality:
+            best, bestQuality = recordFormat, quality
+    if best is None or bestQuality < jsonQuality:
+        return None
+    return best
+
+
+def unflattenConfig(config, name):
+    """
+    Returns a route's config value, with the dicts in it put back together: bottle's ConfigDict splits a dict given
+    as config into one key per item, e.g. schema={"id": int} into "schema.id" (so keys with dots in them can't be
+    told apart from nested dicts)
+    """
+    value = config.get(name)
+    namespace = getattr(bottle.ConfigDict, "Namespace", None)
+    if value is not None and (namespace is None or not isinstance(value, namespace)):
+        return value
+    prefix = name + "."
+    unflattened = {}
+    for key in config:
+        if not key.startswith(prefix):
+            continue
+        parts = key[len(prefix):].split(".")
+        parent = unflattened
+        for part in parts[:-1]:
+            parent = parent.setdefault(part, {})
+        if namespace is not None and isinstance(config[key], namespace):
+            parent.setdefault(parts[-1], {})
+        else:
+            parent[parts[-1]] = config[key]
+    return unflattened if unflattened or value is not None else None
+
+
+def addVary(headers, name):
+    """
+    Adds a request header name to a response's Vary header, keeping whatever is already there
+    """
+    vary = [value.strip() for value in headers.get('Vary', '').split(',') if value.strip()]
+    if name.lower() not in [value.lower() for value in vary]:
+        headers['Vary'] = ", ".join(vary + [name])
+
+
+# the charset parameter of a Content-Type header
+JSON_CHARSET = re.compile(r';\s*charset\s*=\s*"?([\w.:-]+)', re.IGNORECASE)
+# JSON strings, and runs of anything that is neither a bracket nor a string
+JSON_NON_BRACKETS = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[^\[\]{}"]+')
+# the innermost arrays and objects once everything else has been removed
+JSON_EMPTY_PAIRS = re.compile(r'\[\]|\{\}')
+
+
+def jsonNestingExceeds(text, maxDepth):
+    """
+    True if the arrays and objects in a JSON text nest more than maxDepth levels deep. Works on the brackets
+    alone, peeling off one level per pass, so it costs a few regular expression passes rather than a parse, and
+    stops as soon as it gets past maxDepth. Malformed texts are left for the decoder to reject.
+    """
+    brackets = JSON_NON_BRACKETS.sub("", text)
+    depth = 0
+    while brackets:
+        if depth == maxDepth:
+            return True
+        peeled = JSON_EMPTY_PAIRS.sub("", brackets)
+        if len(peeled) == len(brackets):
+            return False
+        brackets = peeled
+        depth += 1
+    return False
+
+
+class LazyJSONBody(object):
+    """
+    What request.jsonData holds for JSON requests until it is read. Bottle resolves descriptors stored as request
+    attributes when they're accessed, so the first read of request.jsonData decodes the body (see
+    RestwarePlugin.decodeJSONBody) and later ones get the same result, or the same RequestBodyError, back. Handlers
+    that never read it never pay for decoding.
+    """
+    def __init__(self, plugin, policy, binaryFormat=None):
+        self.plugin = plugin
+        self.policy = policy
+        self.binaryFormat = binaryFormat
+        self.decoded = False
+        self.value = None
+        self.error = None
+
+    def __get__(self, instance, owner=None):
+        if not self.decoded:
+            try:
+                self.value = self.plugin.decodeJSONBody(self.policy, self.binaryFormat)
+            except RequestBodyError, e:
+                self.error = e
+            self.decoded = True
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def release(self):
+        """
+        Forgets the decoded body once the response is ready. Bottle's environ, which holds this, is part of a
+        reference cycle, so the decoded data would otherwise stay in memory until the garbage collector got to it.
+        Reading request.jsonData after that (e.g. from a generator the handler returned) decodes the body again
+        """
+        if self.error is None:
+            self.decoded = False
+            self.value = None
+
+
+# in a streamed JSON array, runs of anything but a string, bracket or comma, and whole strings; at the top level,
+# where commas separate items, and inside the items, where only the brackets matter
+JSON_ITEM_TEXT = re.compile(r'(?:[^"\[\]{},]+|"[^"\\]*(?:\\.[^"\\]*)*")*')
+JSON_NESTED_TEXT = re.compile(r'(?:[^"\[\]{}]+|"[^"\\]*(?:\\.[^"\\]*)*")*')
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# what separates the records of streamed request bodies, by their Content-Type
+RECORD_SEPARATORS = {"application/x-ndjson": "\n", "application/json-seq": "\x1e"}
+
+
+class JSONItemReader(object):
+    """
+    What request.jsonData holds on routes with stream_body=True: an iterator over the items of a JSON array body,
+    or the records of an NDJSON (or JSON text sequence) body, decoded one at a time as the handler asks for them.
+    The body is read from wsgi.input a chunk at a time (inflated on the fly if the middleware is decompressing it),
+    and only the item being decoded is held in memory, so bulk uploads of millions of records take about as much
+    memory as one of them.
+
+    The route's maxDepth applies to each item on its own. Items of more than its maxItemSize bytes are rejected
+    with a 413, and malformed ones with a 400 that gives their index, both raised as RequestBodyErrors from the
+    handler's loop; the items before them have already been handed out by then.
+    """
+    readSize = 64 * 1024
+
+    def __init__(self, plugin, policy, source, length=None, separator=None):
+        """
+        Args:
+            plugin (RestwarePlugin, required): the plugin, for its logger
+            policy (RoutePolicy, required): the route's policy, for its codec and limits
+            source (file-like, required): where the body is read from
+            length (int, optional): how many bytes to read from source, if known; otherwise it's read to the end
+            separator (str, optional): what separates the records of the body. None, the default, for a JSON array
+        """
+        self.logger = plugin.logger
+        self.codec = policy.codec
+        self.maxItemSize = policy.maxItemSize
+        self.maxBodySize = policy.maxBodySize
+        self.maxDepth = policy.maxDepth
+        self.source = source
+        self.remaining = length
+        self.separator = separator
+        self.bytesRead = 0
+        self.count = 0
+        # how much the next refill reads: see refill()
+        self.readAhead = self.readSize
+        self._items = self.iterRecords() if separator else self.iterArray()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self._items)
+
+    def readChunk(self, size=None):
+        """
+        Returns the next chunk of the body, of up to size bytes (readSize by default), or an empty string at its end
+        """
+        size = size or self.readSize
+        size = size if self.remaining is None else min(size, self.remaining)
+        chunk = self.source.read(size) if size else ""
+        if self.remaining is not None:
+            self.remaining -= len(chunk)
+        self.bytesRead += len(chunk)
+        if self.maxBodySize is not None and self.bytesRead > self.maxBodySize:
+            raise RequestBodyError(413, "Request body exceeds %d bytes" % self.maxBodySize)
+        return chunk
+
+    def tooLarge(self, size):
+        return self.maxItemSize is not None and size > self.maxItemSize
+
+    def decodeItem(self, text):
+        """
+        Decodes the text of the next item, under the route's limits
+        """
+        if self.tooLarge(len(text)):
+            raise RequestBodyError(413, "Request body item %d exceeds %d bytes" % (self.count, self.maxItemSize))
+        if self.maxDepth is not None and jsonNestingExceeds(text, self.maxDepth):
+            raise RequestBodyError(400, "Request body item %d nests arrays and objects deeper than %d levels" % (
+                self.count, self.maxDepth))
+        try:
+            item = self.codec.loads(text)
+        except Exception, e:
+            self.logger.debug("failed to decode JSON request body item %d (first 32 bytes %r): %s", self.count, text[:32], e)
+            raise RequestBodyError(400, "Request body item %d is not valid JSON: %s" % (self.count, e))
+        self.count += 1
+        self.readAhead = self.readSize
+        return item
+
+    def iterRecords(self):
+        buf = ""
+        start = searched = 0
+        while True:
+            # the part of the record read before has already been searched for the separator
+            end = buf.find(self.separator, max(start, searched))
+            if end < 0:
+                if self.tooLarge(len(buf) - start):
+                    raise RequestBodyError(413, "Request body item %d exceeds %d bytes" % (self.count, self.maxItemSize))
+                searched = len(buf) - start
+                buf, start, eof = self.refill(buf, start)
+                if not eof:
+                    continue
+                end = len(buf)
+            text = buf[start:end].strip()
+            start = end + 1
+            if text:
+                yield self.decodeItem(text)
+            if end == len(buf):
+                return
+
+    def refill(self, buf, pos):
+        """
+        Drops what's been consumed of buf, up to pos, and appends the next chunk. Returns (buf, 0, whether the body
+        has ended). Until the next item is decoded, each refill reads twice as much as the one before, so an item
+        of n bytes is copied into buf log(n) times rather than n / readSize times
+        """
+        chunk = self.readChunk(self.readAhead)
+        self.readAhead *= 2
+        return buf[pos:] + chunk, 0, not chunk
+
+    def itemEnd(self, buf, pos, depth=0):
+        """
+        Scans the array item in buf from pos, depth levels of arrays and objects into it, for where it ends. Only
+        looks at its strings, brackets and commas, so it can tell a malformed item from one that's been cut off.
+        Returns (where it ends or None if it doesn't yet, where to carry on scanning once more has been read, the
+        depth there)
+        """
+        while True:
+            pos = (JSON_ITEM_TEXT if depth == 0 else JSON_NESTED_TEXT).match(buf, pos).end()
+            if pos == len(buf) or buf[pos] == '"':
+                # a string that's been cut off is scanned again from its start
+                return None, pos, depth
+            char = buf[pos]
+            if char in "[{":
+                depth += 1
+            elif depth == 0:
+                return pos, pos, depth
+            elif char in "]}":
+                depth -= 1
+            pos += 1
+
+    def iterArray(self):
+        rawDecode = self.codec.rawDecode
+        skip = JSON_WHITESPACE.match
+        buf, pos, eof = "", 0, False
+        # where the scan for the end of the current item has got to, and how deep into it that is
+        scanned = depth = None
+        while True:
+            pos = skip(buf, pos).end()
+            if pos < len(buf) or eof:
+                break
+            buf, pos, eof = self.refill(buf, pos)
+        if pos == len(buf):
+            return
+        if buf[pos] != "[":
+            raise RequestBodyError(400, "Request body is not a JSON array")
+        pos += 1
+        while True:
+            # at the next item, or the end of an empty array
+            pos = skip(buf, pos).end()
+            if pos == len(buf):
+                if eof:
+                    raise RequestBodyError(400, "Request body item %d is not valid JSON: the array is truncated" % self.count)
+                buf, pos, eof = self.refill(buf, pos)
+                continue
+            if buf[pos] == "]" and not self.count:
+                pos += 1
+                break
+            # The item is only decoded once it's all been read. Until then, each chunk read only has its own part
+            # of the item scanned for its end, rather than all of it decoded again
+            if scanned is None:
+                scanned, depth = pos, 0
+            bound, scanned, depth = self.itemEnd(buf, scanned, depth)
+            if bound is None and not eof:
+                # the item runs past what's been read so far
+                if self.tooLarge(len(buf) - pos):
+                    raise RequestBodyError(413, "Request body item %d exceeds %d bytes" % (self.count, self.maxItemSize))
+                scanned -= pos
+                buf, pos, eof = self.refill(buf, pos)
+                continue
+            scanned = None
+            try:
+                item, end = rawDecode(buf, pos)
+            except ValueError:
+                item = end = None
+            if end is not None:
+                if self.tooLarge(end - pos):
+                    raise RequestBodyError(413, "Request body item %d exceeds %d bytes" % (self.count, self.maxItemSize))
+                if self.maxDepth is not None and jsonNestingExceeds(buf[pos:end], self.maxDepth):
+                    raise RequestBodyError(400, "Request body item %d nests arrays and objects deeper than %d levels" % (
+                        self.count, self.maxDepth))
+                self.count += 1
+                self.readAhead = self.readSize
+                yield item
+                pos = end
+            else:
+                # decoding the item on its own gives an error that points into it rather than into the buffer
+                self.decodeItem(buf[pos:bound].strip())
+                raise RequestBodyError(400, "Request body item %d is not valid JSON" % (self.count - 1))
+
+            # between items
+            pos = skip(buf, pos).end()
+            while pos == len(buf) and not eof:
+                buf, pos, eof = self.refill(buf, pos)
+                pos = skip(buf, pos).end()
+            if pos == len(buf):
+                raise RequestBodyError(400, "Request body item %d is not valid JSON: the array is truncated" % self.count)
+            pos += 1
+            if buf[pos - 1] == "]":
+                break
+            if buf[pos - 1] != ",":
+                raise RequestBodyError(400, "Request body item %d is not followed by a comma" % (self.count - 1))
+
+        while True:
+            pos = skip(buf, pos).end()
+            if pos < len(buf):
+                raise RequestBodyError(400, "Request body has data after its JSON array")
+            if eof:
+                return
+            buf, pos, eof = self.refill(buf, pos)
+
+
+def projectFields(data, tree):
+    """
+    Returns data with only the keys named in tree, a dict of key -> None (keep the whole value) or a subtree for
+    the keys of the value. Lists have each of their items projected; anything else is returned as it is
+    """
+    if isinstance(data, dict):
+        return dict((key, data[key] if subtree is None else projectFields(data[key], subtree))
+                    for key, subtree in tree.iteritems() if key in data)
+    if isinstance(data, (list, tuple)):
+        return [projectFields(item, tree) for item in data]
+    return data
+
+
+class FieldProjection(object):
+    """
+    The fields a client asked for with ?fields=id,name,owner.email: the dicts of the response keep only those keys,
+    nested ones by their dotted path, and lists have each of their items projected. See RestwarePlugin.shapeResponse.
+
+    Handlers see it as request.projection (None if the client didn't ask, or the route doesn't allow it), so they
+    can fetch only what it names. A handler that projects its data itself sets applied = True, and it is left alone.
+    """
+    def __init__(self, fields):
+        """
+        Args:
+            fields (list of str, required): the dotted paths of the fields to keep
+        """
+        self.fields = fields
+        self.applied = False
+        # key -> None to keep the whole value, or the subtree of what to keep of it
+        self.tree = {}
+        for field in fields:
+            parts = field.split(".")
+            node = self.tree
+            for part in parts[:-1]:
+                if part in node and node[part] is None:
+                    # an ancestor is kept whole already
+                    break
+                node = node.setdefault(part, {})
+            else:
+                node[parts[-1]] = None
+
+    def includes(self, field):
+        """
+        True if the dotted path field is kept, wholly or in part
+        """
+        node = self.tree
+        for part in field.split("."):
+            if part not in node:
+                return False
+            node = node[part]
+            if node is None:
+                return True
+        return True
+
+    def apply(self, data):
+        return projectFields(data, self.tree)
+
+
+class Page(object):
+    """
+    The slice of a list response a client asked for with ?limit=N&cursor=C. See RestwarePlugin.shapeResponse.
+
+    Handlers see it as request.page (None unless the route is paginated), with the limit and cursor. The plugin's
+    own cursors are opaque offsets into the list the handler returns. A handler that fetches just the page itself
+    sets applied = True, returns only that page, and sets next to the cursor of the following one (or leaves it
+    None on the last page).
+    """
+    def __init__(self, limit, cursor=None):
+        self.limit = limit
+        self.cursor = cursor
+        self.applied = False
+        self.next = None
+
+    @staticmethod
+    def encodeCursor(offset):
+        return base64.urlsafe_b64encode("offset:%d" % offset).rstrip("=")
+
+    @property
+    def offset(self):
+        """
+        Where the page starts, from a cursor the plugin made. Raises a 400 HTTPError for cursors it didn't make
+        """
+        if not self.cursor:
+            return 0
+        try:
+            text = base64.urlsafe_b64decode(str(self.cursor) + "=" * (-len(self.cursor) % 4))
+            name, _, value = text.partition(":")
+            offset = int(value)
+        except (TypeError, ValueError):
+            raise bottle.HTTPError(400, "Invalid cursor: %s" % self.cursor)
+        if name != "offset" or offset < 0:
+            raise bottle.HTTPError(400, "Invalid cursor: %s" % self.cursor)
+        return offset
+
+    def apply(self, data):
+        """
+        Returns the page of data, a list, generator or iterator, and sets next if there is more after it
+        """
+        offset = self.offset
+        if isinstance(data, (list, tuple)):
+            page = data[offset:offset + self.limit]
+            more = len(data) > offset + self.limit
+        else:
+            page = list(itertools.islice(data, offset, offset + self.limit + 1))
+            more = len(page) > self.limit
+            del page[self.limit:]
+            if hasattr(data, "close"):
+                data.close()
+        self.next = self.encodeCursor(offset + self.limit) if more else None
+        return page
+
+
+class Metrics(object):
+    """
+    In-process histograms of how long each phase of handling a request took (inflate, decode, handler, encode,
+    compress and total; see RestwarePlugin) and counters of response bytes before and after compression, labeled by
+    route rule and response status. render() returns them in the Prometheus text format.
+    """
+    # upper bounds, in seconds, of the histogram buckets
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=None):
+        """
+        Args:
+            buckets (sequence of float, optional): upper bounds, in seconds, of the histogram buckets
+        """
+        self.buckets = tuple(sorted(buckets or self.buckets))
+        # (rule, status, phase) -> [count per bucket (the last one is +Inf), sum of the observed seconds]
+        self.histograms = {}
+        # (rule, status, "uncompressed" or "sent") -> bytes
+        self.bytes = collections.defaultdict(int)
+        self.lock = threading.Lock()
+
+    def afterFork(self):
+        """
+        Starts a newly forked process's metrics from zero, so every process only reports its own requests
+        """
+        self.histograms = {}
+        self.bytes = collections.defaultdict(int)
+        self.lock = threading.Lock()
+
+    def observe(self, rule, status, timings, sizes=None):
+        """
+        Records one request's timings, a sequence of (phase, seconds), and its body's (uncompressed, sent) sizes
+        """
+        buckets = self.buckets
+        with self.lock:
+            for phase, seconds in timings:
+                key = (rule, status, phase)
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = [[0] * (len(buckets) + 1), 0.0]
+                histogram[0][bisect.bisect_left(buckets, seconds)] += 1
+                histogram[1] += seconds
+            if sizes is not None:
+                self.bytes[(rule, status, "uncompressed")] += sizes[0]
+                self.bytes[(rule, status, "sent")] += sizes[1]
+
+    def render(self):
+        """
+        Returns all metrics in the Prometheus text exposition format
+        """
+        def labels(rule, status, name, value):
+            rule = (rule or "").replace("\\", "\\\\").replace('"', '\\"')
+            return 'rule="%s",status="%s",%s="%s"' % (rule, status, name, value)
+
+        with self.lock:
+            histograms = sorted((key, list(counts), total) for key, (counts, total) in self.histograms.iteritems())
+            sizes = sorted(self.bytes.items())
+        lines = ["# HELP restware_phase_seconds Time spent in each phase of handling a request",
+                 "# TYPE restware_phase_seconds histogram"]
+        for (rule, status, phase), counts, total in histograms:
+            prefix = labels(rule, status, "phase", phase)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append('restware_phase_seconds_bucket{%s,le="%s"} %d' % (prefix, bound, cumulative))
+            lines.append('restware_phase_seconds_sum{%s} %r' % (prefix, total))
+            lines.append('restware_phase_seconds_count{%s} %d' % (prefix, cumulative))
+        lines += ["# HELP restware_response_bytes_total Response body bytes before compression and as sent",
+                  "# TYPE restware_response_bytes_total counter"]
+        for (rule, status, stage), size in sizes:
+            lines.append('restware_response_bytes_total{%s} %d' % (labels(rule, status, "stage", stage), size))
+        return "\n".join(lines) + "\n"
+
+
+# What a batched operation keeps of the batch request's environ: the server's details and all headers but these,
+# which are about the batch request itself, or would make the operations' responses differ in form
+BATCH_ENVIRON = ("SERVER_NAME", "SERVER_PORT", "SERVER_PROTOCOL", "SCRIPT_NAME", "REMOTE_ADDR", "REMOTE_USER", "HTTPS",
+                 "wsgi.version", "wsgi.url_scheme", "wsgi.errors", "wsgi.multithread", "wsgi.multiprocess",
+                 "wsgi.run_once")
+BATCH_DROPPED_HEADERS = ("HTTP_ACCEPT", "HTTP_ACCEPT_ENCODING", "HTTP_CONTENT_ENCODING", "HTTP_IF_NONE_MATCH",
+                         "HTTP_IF_MODIFIED_SINCE", "HTTP_RANGE")
+
+
+class RoutePolicy(object):
+    """
+    How the RestwarePlugin handles one route, worked out once when the route is applied instead of on every
+    request. The plugin's settings are the defaults; a route overrides them with keyword arguments in its config:
+    json (serialize the response as JSON, which by default only routes under apiBasePath do), compress,
+    compress_level, cache, invalidates, max_body_size, max_depth, codec, stream, static, projection, page_size,
+    coalesce, stream_body, max_item_size, schema, etag and binary_formats.
+    """
+    def __init__(self, rule, json, compress, compressLevel, cacheTTL, invalidates, maxBodySize, maxDepth, codec,
+                 stream, static, projection=False, pageSize=None, coalesce=False, streamBody=False, maxItemSize=None,
+                 schema=None, etag=False, binaryFormats=()):
+        """
+        Args:
+            rule (str): the route's rule, or None for the policy errors are handled with
+            json (bool): whether dicts, lists and iterators the route returns are serialized as JSON
+            compress (bool): whether the response may be compressed
+            compressLevel (int): the compression level
+            cacheTTL (int): how many seconds GET responses are cached for, or None
+            invalidates (list): (rule, names of the URL arguments shared with it) for each rule whose cached
+            responses this route makes stale
+            maxBodySize (int): the largest JSON request body, in bytes, that is decoded, or None
+            maxDepth (int): how deeply the arrays and objects of a JSON request body may nest, or None
+            codec (JSONCodec): encodes and decodes the route's JSON
+            stream (bool): whether lists are streamed like iterators
+            static (bool): whether the route serves documents or files that rarely change, whose compressed variants
+            are worth keeping (see RestwarePlugin.serveFile). By default, routes that don't produce JSON do
+            projection (bool): whether clients may pick the fields of the response with ?fields=
+            pageSize (int): how many items of a list response go in a page when the client doesn't give ?limit=,
+            or None if list responses aren't paginated
+            coalesce (bool): whether identical concurrent GETs share one handler run (see SingleFlight)
+            streamBody (bool): whether JSON array and NDJSON request bodies are decoded an item at a time, as the
+            handler iterates over request.jsonData (see JSONItemReader)
+            maxItemSize (int): the largest item, in bytes, of a streamed request body, or None
+            schema (ResponseSchema): the compiled shape of the route's responses, or None
+            etag (bool): whether GET responses always get an ETag derived from their body. Without it they only get
+            one when the request carries a validator (If-None-Match or If-Match) to check it against
+            binaryFormats (sequence of BinaryFormat): the binary formats clients may ask for instead of JSON. When
+            there are none, the Accept header is left alone
+        """
+        self.rule = rule
+        self.json = json
+        self.compress = compress
+        self.compressLevel = compressLevel
+        self.cacheTTL = cacheTTL
+        self.invalidates = invalidates
+        self.maxBodySize = maxBodySize
+        self.maxDepth = maxDepth
+        self.codec = codec
+        self.stream = stream
+        self.static = static
+        self.projection = projection
+        self.pageSize = pageSize
+        self.coalesce = coalesce
+        self.streamBody = streamBody
+        self.maxItemSize = maxItemSize
+        self.schema = schema
+        self.etag = etag
+        # media type -> BinaryFormat, aliases included
+        self.binaryMediaTypes = collections.OrderedDict((mediaType, binaryFormat) for binaryFormat in binaryFormats
+                                                        for mediaType in binaryFormat.mediaTypes)
+
+    def __repr__(self):
+        return "<RoutePolicy %s json=%s compress=%s level=%s cache=%s maxBodySize=%s maxDepth=%s stream=%s static=%s projection=%s pageSize=%s coalesce=%s streamBody=%s schema=%s etag=%s binaryFormats=%s codec=%s>" % (
+            self.rule, self.json, self.compress, self.compressLevel, self.cacheTTL, self.maxBodySize, self.maxDepth,
+            self.stream, self.static, self.projection, self.pageSize, self.coalesce, self.streamBody,
+            self.schema is not None, self.etag, sorted(set(f.name for f in self.binaryMediaTypes.values())),
+            self.codec.name)
+
+
 class RestwarePlugin:
     """
     This plugin is designed to fix a few peculiar behaviors that keep Bottle from being a really
@@ -37,38 +2352,229 @@ class RestwarePlugin:
     """
     name = "restwareplugin"
     api = 2
+    # the piece size large bodies are split into for the compression thread pool
+    offloadChunkSize = 256 * 1024
 
-    def __init__(self, apiBasePath='/api/', logger=None):
+    def __init__(self, apiBasePath='/api/', logger=None, streamResponses=False, codec=None, cacheTTL=60,
+                 cacheMaxBytes=32 * 1024 * 1024, encodings=CONTENT_ENCODINGS, compressionLevel=6,
+                 compressionMinSize=256, incompressibleTypes=INCOMPRESSIBLE_TYPES, compressionThreads=0,
+                 compressionQueueSize=64, offloadMinSize=1024 * 1024, jsonProcesses=0, jsonQueueSize=4,
+                 jsonOffloadMinSize=4 * 1024 * 1024, jsonTimeout=10.0, logLevel=logging.WARNING, accessLogger=None, accessLogSampleRate=1.0,
+                 maxBodySize=None, metrics=None, serverTiming=False, metricsPath=None, maxJSONDepth=None,
+                 staticCacheMaxBytes=16 * 1024 * 1024, batchPath=None, batchMaxOperations=50, batchThreads=0,
+                 projection=False, pageSize=None, maxPageSize=1000, coalesce=False, coalesceTimeout=5.0,
+                 binaryFormats=None, maxItemSize=1024 * 1024, etags=False):
         """
         Args:
             apiBasePath (str, optional): Set the base path under which your API operations/routes will lie.
             Defaults to /api/, but you can set it to '/' to force all responses be JSON
             logger (logging.Logger, optional): if you want custom logging, specify your own logger instance
+            streamResponses (bool, optional): stream lists returned by API routes instead of serializing them in one
+            go. Generators and iterators returned by API routes are always streamed
+            codec (JSONCodec, optional): encodes and decodes all JSON. Defaults to a JSONCodec using the fastest
+            JSON library installed; create your own to register encoders for extra types or restrict the backends
+            cacheTTL (int, optional): how many seconds responses of routes configured with cache=True are cached for
+            cacheMaxBytes (int, optional): the most memory, in bytes of response bodies, the response cache may use
+            encodings (sequence of str, optional): the content-encodings responses may be compressed with, most
+            preferred first. Defaults to zstd (if the zstandard package is installed), gzip and deflate
+            compressionLevel (int, optional): the default compression level; routes can override it with
+            compress_level=N in their route config, or turn compression off altogether with compress=False
+            compressionMinSize (int, optional): bodies smaller than this many bytes are never compressed
+            incompressibleTypes (sequence of str, optional): content types (or prefixes, like "video/") that are
+            never compressed because they already are
+            compressionThreads (int, optional): gzip and deflate bodies of at least offloadMinSize bytes are split into
+            chunks that are compressed concurrently by this many threads (zlib releases the GIL), or with that many
+            zstd threads. Defaults to 0, which compresses everything inline on the request thread
+            compressionQueueSize (int, optional): how many chunks may wait for a compression thread; beyond that the
+            request thread compresses them itself
+            offloadMinSize (int, optional): bodies smaller than this are always compressed inline. Defaults to 1MiB
+            jsonProcesses (int, optional): dicts and lists that come to at least jsonOffloadMinSize bytes of pretty
+            JSON are encoded by a pool of this many processes, started when the plugin is installed. The data has to
+            be pickled across, so this only pays off for payloads that are expensive to encode. Defaults to 0, which
+            encodes everything inline
+            jsonQueueSize (int, optional): how many payloads may be waiting on (or in) the JSON processes at once;
+            beyond that they are encoded inline
+            jsonOffloadMinSize (int, optional): dicts and lists estimated (see estimateJSONSize) to encode to fewer
+            bytes are always encoded inline. Defaults to 4MiB
+            jsonTimeout (int or float, optional): how many seconds to wait for the pool to encode a payload before
+            encoding it inline instead. Defaults to 10
+            logLevel (int, optional): the level of the logger made when none is given. Defaults to WARNING
+            accessLogger (logging.Logger, optional): where a structured INFO record per response goes. Defaults to
+            the child "<logger name>.access" of the logger, so it can be turned on (or off) on its own
+            accessLogSampleRate (float, optional): the fraction of responses, between 0 and 1, that get an access
+            log record. Responses with a 5xx status are always logged
+            maxBodySize (int, optional): JSON request bodies larger than this many bytes are rejected with a 413.
+            Defaults to None, no limit; routes can set their own with max_body_size=N
+            metrics (Metrics or bool, optional): time each phase of every request (inflating the body in the
+            middleware, decoding its JSON, the handler, encoding and compressing the response) and count the bytes
+            sent, into this Metrics instance (a new one if True). Defaults to None: nothing is timed
+            serverTiming (bool, optional): send those timings to the client in a Server-Timing header
+            metricsPath (str, optional): serve the metrics, in the Prometheus text format, from this path
+            maxJSONDepth (int, optional): JSON request bodies whose arrays and objects nest deeper than this are
+            rejected with a 400 before they're decoded. Defaults to None, no limit; routes can set their own with
+            max_depth=N
+            staticCacheMaxBytes (int, optional): the most memory the compressed variants of static routes' files and
+            documents may use (see serveFile). Defaults to 16MiB; 0 turns the static cache off
+            batchPath (str, optional): serve batches of API calls from this path, e.g. "/api/_batch". See batchEndpoint
+            batchMaxOperations (int, optional): batches with more operations are rejected with a 413. Defaults to 50
+            batchThreads (int, optional): dispatch the operations of a batch concurrently on this many threads.
+            Defaults to 0, one after the other on the request thread
+            projection (bool, optional): let clients of API routes pick the fields they want with ?fields=a,b.c (see
+            FieldProjection). Defaults to False; routes can turn it on or off with projection=True/False
+            pageSize (int, optional): paginate the lists API routes return, this many items per page unless the client
+            asks for another ?limit=, with ?cursor= picking the page (see Page). Defaults to None, no pagination;
+            routes can set their own with page_size=N, or turn it off with page_size=None
+            maxPageSize (int, optional): the largest ?limit= honoured. Defaults to 1000
+            coalesce (bool, optional): let identical GETs to an API route that arrive while one of them is being
+            handled wait for it and share its response instead of running the handler again (see SingleFlight).
+            Defaults to False; routes can turn it on or off with coalesce=True/False
+            coalesceTimeout (int or float, optional): how many seconds a coalesced request waits before it gives up
+            and runs the handler itself. Defaults to 5
+            binaryFormats (bool or sequence of str, optional): the binary formats (see BinaryFormat) API routes speak
+            besides JSON: "msgpack" and "cbor", or True for whichever have their library installed. Clients that name
+            one in Accept get dicts and lists in it, and request bodies in one fill request.jsonData just as JSON
+            would. Defaults to None, so routes only speak JSON and don't parse Accept unless they turn formats on
+            with binary_formats=True or binary_formats=["msgpack"] in their route config
+            maxItemSize (int, optional): on routes with stream_body=True in their route config, whose JSON array
+            and NDJSON request bodies are decoded an item at a time (see JSONItemReader), items larger than this
+            many bytes are rejected with a 413. Defaults to 1MiB; routes can set their own with max_item_size=N
+            etags (bool, optional): give every 200 GET response a strong ETag derived (with SHA-1) from its body, so
+            clients can revalidate it. Defaults to False, which only does so for routes with cache=... or
+            etag=True in their route config, and requests that carry If-None-Match or If-Match. Files served by
+            static routes get theirs from their modification time and size instead (see serveFile). ETags
+            declared by handlers (see declareETag) are always honoured
         """
         self.baseRulePath = apiBasePath
+        self.streamResponses = streamResponses
         self.logger = logger
         if not self.logger:
-            self.logger = logging.getLogger("RestPlugin")
-            handler = logging.StreamHandler(sys.stdout)
-            handler.setFormatter(logging.Formatter("%(levelname)s %(module)s:%(funcName)s | %(message)s"))
-            self.logger.addHandler(handler)
-            self.logger.setLevel(logging.DEBUG)
+            self.logger = defaultLogger("RestPlugin", "%(levelname)s %(module)s:%(funcName)s | %(message)s", logLevel)
+        self.accessLogger = accessLogger or logging.getLogger("%s.access" % self.logger.name)
+        self.accessLogSampleRate = accessLogSampleRate
+        self.codec = codec or JSONCodec(logger=self.logger)
+        self.cacheTTL = cacheTTL
+        self.cache = ResponseCache(cacheMaxBytes)
+        self.staticCache = ResponseCache(staticCacheMaxBytes) if staticCacheMaxBytes else None
+        self.batchPath = batchPath
+        self.batchMaxOperations = batchMaxOperations
+        self.batchPool = WorkerPool(batchThreads, batchMaxOperations) if batchThreads > 0 else None
+        self.projection = projection
+        self.pageSize = pageSize
+        self.maxPageSize = maxPageSize
+        self.coalesce = coalesce
+        self.singleFlight = SingleFlight(coalesceTimeout)
+        self.binaryFormats = self.loadBinaryFormats(binaryFormats)
+        self.maxItemSize = maxItemSize
+        self.etags = etags
+        self.encodings = tuple(encodings)
+        self.compressionLevel = compressionLevel
+        self.compressionMinSize = compressionMinSize
+        self.incompressibleTypes = tuple(incompressibleTypes)
+        self.compressionThreads = compressionThreads
+        self.compressionPool = WorkerPool(compressionThreads, compressionQueueSize) if compressionThreads > 0 else None
+        self.offloadMinSize = offloadMinSize
+        self.jsonProcesses = jsonProcesses
+        self.jsonPool = None
+        self.jsonQueueSize = jsonQueueSize
+        self.jsonSlots = threading.BoundedSemaphore(jsonQueueSize)
+        self.jsonOffloadMinSize = jsonOffloadMinSize
+        self.jsonTimeout = jsonTimeout
+        # how much work went to the pools, and how much was done inline; see offloadStats()
+        self.offloadCounters = collections.defaultdict(int)
+        self.lock = threading.Lock()
+        self.maxBodySize = maxBodySize
+        self.maxJSONDepth = maxJSONDepth
+        # (method, rule) -> RoutePolicy of every route applied so far; see compilePolicy()
+        self.policies = collections.OrderedDict()
+        # route -> its compiled ResponseSchema; see compileSchema()
+        self.schemas = {}
+        self.errorPolicy = None
+        if metrics is True or (metrics is None and metricsPath):
+            metrics = Metrics()
+        self.metrics = metrics or None
+        self.serverTiming = serverTiming
+        self.metricsPath = metricsPath
+        # whether requests are timed at all; without it the wrappers carry no timing code
+        self.timed = self.metrics is not None or serverTiming
+
+    def afterFork(self):
+        """
+        Resets whatever a forked child can't share with its parent: locks another thread may have held, the
+        compression and batch threads, the JSON process pool (the child starts one of its own) and the counters.
+        The response caches keep their entries. See PreforkServer, which calls this in every worker it forks, after
+        calling beforeFork() before forking them
+        """
+        self.lock = threading.Lock()
+        self.jsonPool = None
+        self.jsonSlots = threading.BoundedSemaphore(self.jsonQueueSize)
+        self.offloadCounters = collections.defaultdict(int)
+        for part in (self.cache, self.staticCache, self.compressionPool, self.batchPool, self.metrics, self.singleFlight):
+            if part is not None:
+                part.afterFork()
+        self.startJSONPool()
+
+    def beforeFork(self):
+        """
+        Stops the JSON process pool before this process forks children that will serve requests. Its processes
+        belong to this one; children can't use them, and would kill them as they replaced the pool (see afterFork)
+        """
+        self.close()
+
+    def startJSONPool(self):
+        """
+        Starts the JSON process pool, if there is to be one. This happens when the plugin is installed, before the
+        webserver starts any threads: forking a process while other threads hold locks leaves them held in it
+        """
+        if self.jsonProcesses > 0 and self.jsonPool is None:
+            self.jsonPool = multiprocessing.Pool(self.jsonProcesses, _initJSONWorker, (self.codec,))
+
+    def close(self):
+        """
+        Shuts the JSON process pool down. Bottle calls this when the plugin is uninstalled or the app is closed
+        """
+        if self.jsonPool is not None:
+            self.jsonPool.terminate()
+            self.jsonPool.join()
+            self.jsonPool = None
 
     def setup(self, app):
         '''
         Set all error status codes so that our own error handler function is used. We'll also go ahead
-        and wrap that function with our Gzip and JSON'ing method (apply()). This way we get uniform behavior
+        and wrap that function with our Gzip and JSON'ing method (postprocessRequest()). This way we get uniform behavior
         from our app, even when errors are returned: the client will never see HTML, only text or JSON.
         '''
         def standardErrorHandlerFunc(errorInst):
-            self.logger.warn("error, %s" % errorInst.status)
+            self.logger.warn("error, %s", errorInst.status)
             if type(errorInst.body) is not dict:
                 return {"message": errorInst.body}
             return errorInst.body
 
+        self.errorPolicy = self.compilePolicy(None)
+
+        def errorHandlerWrapper(errorInst):
+            # No request preprocessing here: the error may well have come from reading the request body
+            return self.postprocessRequest(standardErrorHandlerFunc(errorInst), self.errorPolicy)
+
         for errorCode in [statusCode for statusCode, description in bottle.HTTP_CODES.iteritems() if statusCode >= 400]:
-            self.logger.debug("applying for status-code %d" % errorCode)
-            app.error_handler[int(errorCode)] = self.apply(standardErrorHandlerFunc, "error")
+            self.logger.debug("applying for status-code %d", errorCode)
+            app.error_handler[int(errorCode)] = errorHandlerWrapper
+
+        # bottle applies plugins lazily, on a route's first request; response schemas are compiled now instead, for
+        # the routes there already are and for each one added from here on
+        for route in app.routes:
+            self.compileSchema(route)
+        addRoute = app.add_route
+
+        def addRouteAndCompileSchema(route):
+            addRoute(route)
+            self.compileSchema(route)
+        app.add_route = addRouteAndCompileSchema
+
+        if self.metricsPath and self.metrics is not None:
+            app.route(self.metricsPath, "GET", self.metricsEndpoint, skip=[self])
+        if self.batchPath:
+            app.route(self.batchPath, "POST", self.batchEndpoint, json=True)
+        self.startJSONPool()
 
     def apply(self, callback, route):
         '''
@@ -83,97 +2589,688 @@ class RestwarePlugin:
 
         We can also return pretty-printed JSON. All the client must do is specify the "pretty" query parameter
         and give it the "true" value: &pretty=true
+
+        API routes may also return a generator or iterator (or, with streamResponses on, a list); it is sent as a
+        JSON array that is serialized and compressed incrementally. See JSONArrayStream.
+
+        GET routes can opt into having their final, serialized and compressed responses cached by setting cache=True
+        (or a number of seconds) in their route config: @get("/api/v1/thing/<name>", cache=30)
+
+        Everything about the route that can't change between requests is worked out here, once, into a RoutePolicy
+        (see compilePolicy). Routes that don't produce JSON and aren't cached get a lighter wrapper that only
+        compresses whatever they return. When requests are timed (see metrics and serverTiming), the wrapper is
+        wrapped once more by instrument().
         '''
+        policy = self.compilePolicy(route)
+        self.policies[(route.method, route.rule)] = policy
+        preprocess, postprocess, finish = self.preprocessRequest, self.postprocessRequest, self.finishResponse
+        if self.timed:
+            callback = self.timePhase("handler", callback)
+
+        if not policy.json and not policy.cacheTTL and not policy.invalidates and not policy.coalesce:
+            def passthrough(*args, **kwargs):
+                try:
+                    preprocess(policy)
+                    retval = callback(*args, **kwargs)
+                    if retval is None or response.status_code >= 400:
+                        return postprocess(retval, policy)
+                    return finish(retval, policy, False)
+                finally:
+                    self.releaseJSONBody()
+            return self.instrument(passthrough, policy) if self.timed else passthrough
+
         def wrapper(*args, **kwargs):
-            # perform pre operations to setup the request if necessary
-            self.preprocessRequest(route)
-            retval = callback(*args, **kwargs)
-            return self.postprocessRequest(retval, route)
-        return wrapper
+            cacheKey = None
+            if policy.cacheTTL and request.method == 'GET':
+                cacheKey = self.cacheKey(policy, kwargs)
+                cached = self.cache.get(cacheKey)
+                if cached is not None:
+                    self.logger.debug("serving cached response")
+                    body = cached.replay()
+                    self.logAccess(response.status_code, response.headers.get('Content-Encoding'),
+                                   response.content_type.startswith("application/json"), len(body))
+                    return body
+
+            flight = None
+            if policy.coalesce and request.method == 'GET':
+                # requests that would be answered with the same bytes, or the same 304, share one run of the handler
+                flightKey = (cacheKey or self.cacheKey(policy, kwargs)) + (request.headers.get('If-None-Match'),)
+                flight, leader = self.singleFlight.join(flightKey)
+                if not leader:
+                    outcome = self.singleFlight.wait(flight)
+                    if outcome is not None:
+                        return self.replayOutcome(outcome)
+                    flight = None
+
+            outcome = None
+            try:
+                # perform pre operations to setup the request if necessary
+                preprocess(policy)
+                retval = callback(*args, **kwargs)
+                retval = postprocess(retval, policy)
+                if flight is not None:
+                    outcome = self.shareableOutcome(retval)
+            except bottle.HTTPResponse, e:
+                outcome = None if setsCookies(e) else ("raise", e)
+                raise
+            finally:
+                self.releaseJSONBody()
+                if flight is not None:
+                    self.singleFlight.land(flightKey, flight, outcome)
+
+            if cacheKey is not None:
+                self.cacheResponse(cacheKey, retval, policy.cacheTTL)
+            if policy.invalidates and response.status_code < 400:
+                for rule, names in policy.invalidates:
+                    self.invalidate(rule, **dict((name, kwargs[name]) for name in names if name in kwargs))
+            return retval
+        return self.instrument(wrapper, policy) if self.timed else wrapper
+
+    def shareableOutcome(self, retval):
+        """
+        Returns how the coalesced followers of this request can replay its postprocessed response (see SingleFlight),
+        or None if they can't
+        """
+        if setsCookies(response):
+            return None
+        if isinstance(retval, bottle.HTTPResponse):
+            shareable = isinstance(retval.body, (basestring, BodyChunks)) and not setsCookies(retval)
+            return ("return", retval) if shareable else None
+        if isinstance(retval, (str, BodyChunks)):
+            return ("replay", CachedResponse(response.status_line, list(response.headerlist), retval, float("inf")))
+        return None
+
+    def replayOutcome(self, outcome):
+        """
+        Answers a coalesced request with the outcome its leader shared
+        """
+        kind, value = outcome
+        if kind == "raise":
+            raise value
+        if kind == "return":
+            self.logAccess(value.status_code, value.headers.get('Content-Encoding'), False, len(value.body))
+            return value
+        body = value.replay()
+        self.logAccess(response.status_code, response.headers.get('Content-Encoding'),
+                       response.content_type.startswith("application/json"), len(body))
+        return body
+
+    def coalesceStats(self):
+        """
+        Returns the counters of request coalescing: leaders, coalesced (requests that shared a leader's response),
+        unshared and expired (ones that had to run the handler after all), and inFlight. See SingleFlight
+        """
+        return self.singleFlight.stats()
+
+    def schemaStats(self):
+        """
+        Returns, for each route with a response schema, by (method, rule) like policies, whether its compiled
+        encoder is used and how many responses it encoded or found didn't fit (see ResponseSchema)
+        """
+        return dict((key, policy.schema.stats()) for key, policy in self.policies.items() if policy.schema is not None)
+
+    def timePhase(self, phase, func):
+        """
+        Wraps func so the time it takes is recorded as the given phase of the current request
+        """
+        timer = timeit.default_timer
+
+        def timed(*args, **kwargs):
+            start = timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.recordPhase(phase, timer() - start)
+        return timed
+
+    def recordPhase(self, phase, seconds):
+        timings = request.environ.get('restware.timings')
+        if timings is not None:
+            timings.append((phase, seconds))
+
+    def instrument(self, wrapper, policy):
+        """
+        Wraps a route's wrapper so the phases of each request are collected: the time the middleware spent
+        inflating the request body (only what it inflated up front; the rest is part of decode), then handler, encode
+        and compress as they happen. request.jsonData is decoded when the handler first reads it, so decode is part
+        of handler. Once the response is ready they are recorded in the metrics and,
+        with serverTiming on, sent in a Server-Timing header. Streamed responses are encoded and compressed while
+        they're sent, so those two phases are missing for them, and so are they for errors raised by the handler,
+        which bottle renders after the wrapper has returned.
+        """
+        timer = timeit.default_timer
+
+        def instrumented(*args, **kwargs):
+            environ = request.environ
+            timings = environ['restware.timings'] = []
+            inflate = environ.get('restware.inflate')
+            if inflate is not None:
+                timings.append(("inflate", inflate))
+            start = timer()
+            try:
+                retval = wrapper(*args, **kwargs)
+            except bottle.HTTPResponse, e:
+                self.finishTiming(policy, e.status_code, timer() - start, e)
+                raise
+            except Exception:
+                self.finishTiming(policy, 500, timer() - start, None)
+                raise
+            if isinstance(retval, bottle.BaseResponse):
+                self.finishTiming(policy, retval.status_code, timer() - start, retval)
+            else:
+                self.finishTiming(policy, response.status_code, timer() - start, response)
+            return retval
+        return instrumented
+
+    def finishTiming(self, policy, status, elapsed, target):
+        """
+        Records the current request's timings, and sets the Server-Timing header on target (a response)
+        """
+        environ = request.environ
+        timings = environ.get('restware.timings') or []
+        timings.append(("total", elapsed + (environ.get('restware.inflate') or 0)))
+        if self.serverTiming and target is not None:
+            target.set_header('Server-Timing', ", ".join("%s;dur=%.3f" % (phase, seconds * 1000) for phase, seconds in timings))
+        if self.metrics is not None:
+            self.metrics.observe(policy.rule, status, timings, environ.get('restware.bytes'))
+
+    def batchEndpoint(self):
+        """
+        Serves batchPath. The request body is a JSON array of operations, {"method": "GET", "path": "/api/...",
+        "body": ...} (method defaults to GET, body to nothing), each of which is dispatched through the app just as
+        if it had been a request of its own, with the same headers. What comes back is an array holding each one's
+        {"status": ..., "body": ...} in the same order, encoded and compressed once. Error bodies are the usual
+        {"message": ...}.
+        """
+        operations = request.jsonData
+        if not isinstance(operations, list):
+            raise bottle.HTTPError(400, "The request body must be a JSON array of operations")
+        if len(operations) > self.batchMaxOperations:
+            raise bottle.HTTPError(413, "A batch may hold at most %d operations" % self.batchMaxOperations)
+
+        app, environ = request.app, request.environ
+        results = []
+        for operation in operations:
+            try:
+                subEnviron = self.batchEnviron(environ, operation)
+            except ValueError, e:
+                results.append({"status": 400, "body": {"message": str(e)}})
+                continue
+            task = self.batchPool.submit(self.dispatch, app, subEnviron) if self.batchPool is not None else None
+            results.append(task if task is not None else self.dispatchInline(app, subEnviron))
+        return [result.result() if isinstance(result, PoolTask) else result for result in results]
+
+    def batchEnviron(self, environ, operation):
+        """
+        Returns the environ of a batched operation, based on that of the batch request. Raises a ValueError if the
+        operation doesn't make sense
+        """
+        if not isinstance(operation, dict) or not isinstance(operation.get("path"), basestring) \
+                or not operation["path"].startswith("/"):
+            raise ValueError("Each operation needs a path, starting with /")
+        path, _, query = operation["path"].encode("utf-8").partition("?")
+        path = urllib.unquote(path)
+        if path == self.batchPath:
+            raise ValueError("Batches can't be nested")
+        subEnviron = dict((key, value) for key, value in environ.iteritems()
+                          if key in BATCH_ENVIRON or (key.startswith("HTTP_") and key not in BATCH_DROPPED_HEADERS))
+        body = ""
+        if operation.get("body") is not None:
+            body = self.codec.dumps(operation["body"])
+            subEnviron["CONTENT_TYPE"] = "application/json"
+        subEnviron.update({"REQUEST_METHOD": str(operation.get("method") or "GET").upper(), "PATH_INFO": path,
+                           "QUERY_STRING": query, "CONTENT_LENGTH": str(len(body)), "wsgi.input": StringIO.StringIO(body)})
+        return subEnviron
+
+    def dispatch(self, app, environ):
+        """
+        Runs one batched operation through the app, returning its {"status": ..., "body": ...}
+        """
+        started = []
+
+        def startResponse(status, headers, excInfo=None):
+            started[:] = [status, headers]
+
+        result = app(environ, startResponse)
+        try:
+            body = "".join(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        status, headers = started
+        contentType = dict((name.lower(), value) for name, value in headers).get("content-type", "")
+        if not body:
+            body = None
+        elif contentType.startswith("application/json"):
+            body = self.codec.loads(body)
+        else:
+            body = body.decode("utf-8", "replace")
+        return {"status": int(status.split()[0]), "body": body}
+
+    def dispatchInline(self, app, environ):
+        """
+        dispatch() on the current thread. Bottle keeps the request and response being handled in thread-locals,
+        which it binds afresh for the operation, so the batch request's are bound again afterwards: its environ,
+        and a response with the status, headers and cookies (as Set-Cookie headers) of a copy taken beforehand
+        """
+        outerEnviron = request.environ
+        outer = response.copy()
+        outerBody = response.body
+        try:
+            return self.dispatch(app, environ)
+        finally:
+            request.bind(outerEnviron)
+            headers = outer.headers.allitems()
+            # headerlist ends with the cookies
+            cookies = [value for name, value in outer.headerlist if name == "Set-Cookie"]
+            cookies = cookies[len(outer.headers.getall("Set-Cookie")):]
+            response.bind(outerBody, outer.status_line, headers + [("Set-Cookie", value) for value in cookies])
+
+    def metricsEndpoint(self):
+        """
+        Serves the metrics in the Prometheus text format. Registered at metricsPath by setup()
+        """
+        response.content_type = "text/plain; version=0.0.4"
+        return self.metrics.render()
+
+    def compilePolicy(self, route):
+        """
+        Works out the RoutePolicy of a route from the plugin's settings and the route's config. route may also be
+        None, for the policy of error responses and of code that has no route at hand
+        """
+        config = getattr(route, "config", None) or {}
+        rule = getattr(route, "rule", None)
+        ttl = config.get("cache")
+        if ttl is True:
+            ttl = self.cacheTTL
+        # for each rule this route invalidates, the names of the URL arguments it shares with this route
+        urlArgs = re.findall(r"<(\w+)", rule or "")
+        invalidates = [(other, [name for name in re.findall(r"<(\w+)", other) if name in urlArgs])
+                       for other in config.get("invalidates") or []]
+        isJSON = bool(config.get("json", rule is not None and rule.startswith(self.baseRulePath)))
+        return RoutePolicy(rule, json=isJSON,
+                           compress=config.get("compress", True) is not False,
+                           compressLevel=config.get("compress_level", self.compressionLevel),
+                           cacheTTL=ttl or None, invalidates=invalidates,
+                           maxBodySize=config.get("max_body_size", self.maxBodySize),
+                           maxDepth=config.get("max_depth", self.maxJSONDepth),
+                           codec=config.get("codec") or self.codec, stream=config.get("stream", self.streamResponses),
+                           static=bool(config.get("static", not isJSON)),
+                           projection=isJSON and bool(config.get("projection", self.projection)),
+                           pageSize=config.get("page_size", self.pageSize) if isJSON else None,
+                           coalesce=isJSON and bool(config.get("coalesce", self.coalesce)),
+                           streamBody=bool(config.get("stream_body", False)),
+                           maxItemSize=config.get("max_item_size", self.maxItemSize),
+                           schema=self.compileSchema(route) if isJSON else None,
+                           etag=bool(config.get("etag", self.etags)) or bool(ttl),
+                           binaryFormats=self.routeBinaryFormats(config) if isJSON else ())
+
+    def compileSchema(self, route):
+        """
+        Returns the ResponseSchema the route declares with schema=... in its config, compiled the first time it is
+        asked for, or None. Raises a ValueError if the schema isn't one
+        """
+        schema = self.schemas.get(route)
+        if schema is None:
+            config = getattr(route, "config", None) or {}
+            declared = unflattenConfig(config, "schema")
+            if declared is None:
+                return None
+            schema = self.schemas[route] = ResponseSchema(declared, config.get("codec") or self.codec, self.logger)
+        return schema
+
+    def routeBinaryFormats(self, config):
+        """
+        Returns the BinaryFormats a route with the given config speaks: those named by its binary_formats (True for
+        every installed one), or the plugin's binaryFormats
+        """
+        if "binary_formats" not in config:
+            return self.binaryFormats
+        return self.loadBinaryFormats(config["binary_formats"])
+
+    def loadBinaryFormats(self, names):
+        """
+        Loads the named BinaryFormats (see loadBinaryFormats; None loads none), warning about the ones whose
+        library is running without its C extension
+        """
+        formats = loadBinaryFormats(names or False, self.logger)
+        for binaryFormat in formats:
+            if not binaryFormat.native:
+                self.logger.warn("%s is running without its C extension; encoding it is many times slower than JSON",
+                                 binaryFormat.name)
+        return formats
+
+    def policyFor(self, route):
+        """
+        Returns the RoutePolicy of the given route (or the route itself, if it already is a RoutePolicy)
+        """
+        if isinstance(route, RoutePolicy):
+            return route
+        policy = self.policies.get((getattr(route, "method", None), getattr(route, "rule", None)))
+        return policy if policy is not None else self.compilePolicy(route)
+
+    def cacheKey(self, route, urlArgs):
+        """
+        Identifies a response in the cache by everything that determines its bytes: the route, its URL arguments,
+        the query string (which includes "pretty"), the content-encoding negotiated with the client, whether it
+        wants lists as records and which binary format, if any, it wants
+        """
+        return (route.rule, frozenset(urlArgs.items()), tuple(sorted(request.query.allitems())), self.negotiateEncoding(route),
+                self.negotiateRecordFormat(), self.negotiateBinaryFormat(self.policyFor(route)))
+
+    def cacheResponse(self, key, retval, ttl):
+        """
+        Stores a fully postprocessed response, if it is something that can be replayed to other clients
+        """
+        if response.status_code != 200 or not isinstance(retval, (str, BodyChunks)) or setsCookies(response):
+            return
+        self.cache.put(key, CachedResponse(response.status_line, list(response.headerlist), retval, time.time() + ttl))
+
+    def invalidate(self, rule=None, **urlArgs):
+        """
+        Drops responses from the cache, e.g. after a write. See ResponseCache.invalidate. Routes can also list the
+        rules whose responses they make stale, e.g. invalidates=["/api/v1/key/<keyName>"], and matching entries
+        will be dropped automatically (using the same URL arguments) whenever they succeed.
+        """
+        self.cache.invalidate(rule, **urlArgs)
+
+    def routeConfig(self, route, name, default=None):
+        """
+        Returns a setting from a route's config (the extra keyword arguments given to @route), or default
+        """
+        config = getattr(route, "config", None)
+        if config is None:
+            return default
+        return config.get(name, default)
+
+    def negotiateEncoding(self, route=None):
+        """
+        Returns the content-encoding the client would like the response body in (see negotiateContentEncoding),
+        or None if it should go out uncompressed or the route has compression turned off
+        """
+        if route is not None and not self.policyFor(route).compress:
+            return None
+        return negotiateContentEncoding(request.headers.get("Accept-Encoding", ""), self.encodings)
+
+    def negotiateRecordFormat(self):
+        """
+        Returns the record format (see RECORD_STREAM_TYPES) the client would like lists and iterators sent in, or
+        None for a JSON array
+        """
+        return negotiateRecordFormat(request.headers.get("Accept", ""))
+
+    def negotiateBinaryFormat(self, policy):
+        """
+        Returns the BinaryFormat, among those the route speaks, the client would rather have dicts and lists in than
+        JSON, or None
+        """
+        if not policy.binaryMediaTypes:
+            return None
+        mediaType = negotiateRecordFormat(request.headers.get("Accept", ""), policy.binaryMediaTypes)
+        return policy.binaryMediaTypes[mediaType] if mediaType else None
+
+    def isCompressible(self, contentType):
+        """
+        False for content types that are already compressed (see incompressibleTypes)
+        """
+        contentType = (contentType or "").lower()
+        return not any(contentType.startswith(incompressible) for incompressible in self.incompressibleTypes)
 
     def preprocessRequest(self, route):
         """
-        This preprocessor specifically looks for POSTed JSON that exceeds bottle's MEMLIMIT (102400 bytes I think)
+        This preprocessor sets up request.jsonData, which decodes POSTed JSON when it is first read, whatever its size
+        (bottle's own request.json gives up past MEMFILE_MAX, 102400 bytes). See LazyJSONBody and decodeJSONBody.
+        On routes with stream_body=True, JSON array and NDJSON bodies are decoded an item at a time instead, see
+        streamBody
         """
-        request.jsonData = None
-
-        if not request.headers.get("Content-Type", "").startswith("application/json"):
+        policy = self.policyFor(route)
+        if policy.projection or policy.pageSize:
+            self.parseShaping(policy)
+        contentType = request.headers.get("Content-Type", "")
+        mediaType = contentType.split(";")[0].strip().lower()
+        if policy.streamBody and (mediaType == "application/json" or mediaType in RECORD_SEPARATORS):
+            request.jsonData = self.streamBody(policy, RECORD_SEPARATORS.get(mediaType))
+        elif contentType.startswith("application/json"):
+            request.jsonData = LazyJSONBody(self, policy)
+        elif policy.binaryMediaTypes and mediaType in policy.binaryMediaTypes:
+            request.jsonData = LazyJSONBody(self, policy, policy.binaryMediaTypes[mediaType])
+        else:
             # there is no JSON posted, so we can return
-            self.logger.debug("No JSON to decode; finished")
-            return
+            request.jsonData = None
 
-        # JSON is expected, so ensure it is either already parsed by bottle, or parse it ourselves
-        if hasattr(request, "json") and request.json is not None:
-            # It is already parsed, so there's nothing to do
-            self.logger.debug("JSON data already parsed by bottle")
-            request.jsonData = request.json
-            return
+    def releaseJSONBody(self):
+        """
+        Lets the current request's decoded JSON body go (see LazyJSONBody.release), now that its response is ready
+        """
+        body = request.get("bottle.request.ext.jsonData")
+        if isinstance(body, LazyJSONBody):
+            body.release()
+
+    def streamBody(self, policy, separator=None):
+        """
+        Returns the JSONItemReader that decodes the request body an item at a time, reading it straight from
+        wsgi.input rather than through request.body, which bottle would read in full before handing anything out.
+        Bodies whose declared length is over the route's maxBodySize are rejected with a 413 right away, and ones
+        in a charset other than UTF-8 with a 415
+        """
+        charset = JSON_CHARSET.search(request.content_type)
+        if charset and charset.group(1).lower() not in ("utf-8", "utf8", "us-ascii", "ascii"):
+            raise RequestBodyError(415, "Unsupported charset for a streamed request body: %s" % charset.group(1))
+        environ = request.environ
+        source = environ['wsgi.input']
+        length = None
+        if isinstance(source, InflatingInput):
+            # the middleware is inflating it, so it's read to the end
+            pass
+        elif 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+            # only bottle undoes the chunked transfer encoding
+            source = request.body
+        else:
+            length = max(request.content_length, 0)
+            if policy.maxBodySize is not None and length > policy.maxBodySize:
+                raise RequestBodyError(413, "Request body exceeds %d bytes" % policy.maxBodySize)
+        return JSONItemReader(self, policy, source, length, separator)
 
-        self.logger.debug("Attempting to parse JSON from request.body since request.json is missing/None")
-        # ensure some data was actually POSTed
-        if hasattr(request, "body") and request.body:
+    def parseShaping(self, policy):
+        """
+        Sets up request.projection and request.page (see FieldProjection and Page) from the fields, limit and cursor
+        query parameters. An invalid limit is answered with a 400
+        """
+        fields = request.query.get("fields") if policy.projection else None
+        fields = [field.strip() for field in fields.split(",") if field.strip()] if fields else None
+        request.projection = FieldProjection(fields) if fields else None
+        if not policy.pageSize:
+            request.page = None
+            return
+        limit = request.query.get("limit")
+        if limit:
             try:
-                # TODO: set encoding based on request header
-                request.jsonData = json.load(request.body)
-                self.logger.debug("Decoded JSON successfully")
-            except Exception, e:
-                self.logger.warn("Request header Content-Type indicates JSON, and we failed to parse request.body: %s" % e)
-                request.body.seek(0)
-                self.logger.warn("Request body (first 32bytes)=%s" % repr(request.body.read(32)))
+                limit = int(limit)
+            except ValueError:
+                limit = 0
+            if limit < 1:
+                raise bottle.HTTPError(400, "limit must be a positive integer")
+        request.page = Page(min(limit or policy.pageSize, self.maxPageSize), request.query.get("cursor") or None)
+
+    def shapeResponse(self, retval, policy):
+        """
+        Applies the client's page and field projection (see parseShaping) to what a handler returned, unless the
+        handler applied them itself. The page goes first, so only its items are projected. A Link header points at
+        the next page, if there is one
+        """
+        page = request.get("bottle.request.ext.page") if policy.pageSize else None
+        if page is not None and self.isStreamable(retval, True):
+            if not page.applied:
+                retval = page.apply(retval)
+            if page.next is not None:
+                query = bottle.FormsDict(request.query)
+                query.replace("cursor", page.next)
+                query.replace("limit", str(page.limit))
+                response.add_header("Link", '<%s?%s>; rel="next"' % (
+                    urllib.quote(request.fullpath), urllib.urlencode(list(query.allitems()))))
+        projection = request.get("bottle.request.ext.projection") if policy.projection else None
+        if projection is not None and not projection.applied:
+            if isinstance(retval, (dict, list, tuple)):
+                retval = projection.apply(retval)
+            elif self.isStreamable(retval, True):
+                retval = (projection.apply(item) for item in retval)
+        return retval
+
+    def decodeJSONBody(self, policy, binaryFormat=None):
+        """
+        Decodes the request's JSON body, in the charset its Content-Type names (UTF-8 by default). Bodies larger
+        than the route's maxBodySize are rejected with a 413, and bodies that aren't valid JSON, nest deeper than
+        its maxDepth or aren't in their charset with a 400, both raised as RequestBodyErrors. Returns None if the
+        body is empty.
+
+        With a binaryFormat (see BinaryFormat) the body is decoded with that instead, under the same limits, into
+        the same kind of data.
+        """
+        start = timeit.default_timer() if self.timed else None
+        # bottle's own request.json only handles bodies up to MEMFILE_MAX and always uses the stdlib decoder, so we
+        # parse request.body ourselves. Reading it may raise a RequestBodyError too
+        limit = policy.maxBodySize
+        if limit is None:
+            body = request.body.read()
         else:
-            self.logger.warn("Request header Content-Type indicates JSON, but no data was POSTed?")
+            # the declared length can be trusted, unless the middleware is inflating the body and doesn't know it yet
+            if not isinstance(request.environ.get('wsgi.input'), InflatingInput) and request.content_length > limit:
+                raise RequestBodyError(413, "Request body exceeds %d bytes" % limit)
+            body = request.body.read(limit + 1)
+            if len(body) > limit:
+                raise RequestBodyError(413, "Request body exceeds %d bytes" % limit)
+        if not body:
+            self.logger.debug("Request header Content-Type indicates JSON, but no data was POSTed")
+            return None
+        if binaryFormat is not None:
+            return self.decodeBinaryBody(body, policy, binaryFormat, start)
+
+        charset = JSON_CHARSET.search(request.content_type)
+        if charset and charset.group(1).lower() not in ("utf-8", "utf8", "us-ascii", "ascii"):
+            try:
+                body = body.decode(charset.group(1))
+            except LookupError:
+                raise RequestBodyError(415, "Unsupported charset: %s" % charset.group(1))
+            except UnicodeError, e:
+                raise RequestBodyError(400, "Request body is not valid %s: %s" % (charset.group(1), e))
+        if policy.maxDepth is not None and jsonNestingExceeds(body, policy.maxDepth):
+            raise RequestBodyError(400, "Request body nests arrays and objects deeper than %d levels" % policy.maxDepth)
+        try:
+            data = policy.codec.loads(body)
+        except Exception, e:
+            self.logger.debug("failed to decode JSON request body (first 32 bytes %r): %s", body[:32], e)
+            raise RequestBodyError(400, "Request body is not valid JSON: %s" % e)
+        if start is not None:
+            self.recordPhase("decode", timeit.default_timer() - start)
+        return data
+
+    def decodeBinaryBody(self, body, policy, binaryFormat, start=None):
+        """
+        The rest of decodeJSONBody() for a body in a BinaryFormat. Its nesting can only be measured once it has
+        been decoded
+        """
+        try:
+            data = binaryFormat.loads(body)
+        except Exception, e:
+            self.logger.debug("failed to decode %s request body (first 32 bytes %r): %s", binaryFormat.name, body[:32], e)
+            raise RequestBodyError(400, "Request body is not valid %s: %s" % (binaryFormat.name, e))
+        if policy.maxDepth is not None and nestingDepth(data) > policy.maxDepth:
+            raise RequestBodyError(400, "Request body nests arrays and objects deeper than %d levels" % policy.maxDepth)
+        if start is not None:
+            self.recordPhase("decode", timeit.default_timer() - start)
+        return data
 
     def postprocessRequest(self, retval, route):
         """
-        Ensures the output is JSON. That's all this method does.
+        Ensures the output is JSON, then compresses it (see finishResponse). route is the bottle route or its
+        RoutePolicy
         """
         JSONed = False
-        GZIPPED = False
+        policy = self.policyFor(route)
 
         if retval is None:
             self.logger.warn("retval is None!")
             return retval
 
         # Is this request under the a path we're enforcing JSON output for?
-        if (route is not None and hasattr(route, 'rule') and route.rule.startswith(self.baseRulePath)) or response.status_code >= 400:
+        if policy.json or response.status_code >= 400:
             # It is. Try to serialize the returned data as JSON
             self.logger.debug("response should be JSON")
 
+            if (policy.projection or policy.pageSize) and response.status_code < 400:
+                retval = self.shapeResponse(retval, policy)
+
+            # On routes that speak binary formats, dicts and lists go out in one instead of JSON to clients that ask
+            # for one, unless the JSON is to be pretty-printed
+            binaryFormat = None
+            if policy.binaryMediaTypes and type(retval) in (dict, list):
+                addVary(response.headers, 'Accept')
+                if request.query.get("pretty") != 'true':
+                    binaryFormat = self.negotiateBinaryFormat(policy)
+
+            # Lists, generators and iterators can be serialized (and compressed) a piece at a time, and successful
+            # ones can be sent as one record per item if the client asks for that
+            if binaryFormat is None and self.isStreamable(retval, True):
+                addVary(response.headers, 'Accept')
+                recordFormat = self.negotiateRecordFormat() if response.status_code < 400 else None
+                if recordFormat or self.isStreamable(retval, policy.stream):
+                    return self.streamResponse(retval, policy, recordFormat)
+
             # First, is the data even something we can serialize as JSON?
             # if the retval is not a dict, we don't know what to do with it, so just be transparent
             if type(retval) not in (dict, list):
-                self.logger.error("\033[41;1m You are trying to send the client data that doesn't look like it should be JSON (%s). Fix this! \033[0m" % type(retval))
+                self.logger.error("\033[41;1m You are trying to send the client data that doesn't look like it should be JSON (%s). Fix this! \033[0m", type(retval))
                 # TODO: consider raising an exception so as to generate a server error (500), forcing the app developer
                 # to confront why/how they are sending back something that doesn't make much sense serializing as JSON
             else:
                 # Was the "pretty" query parameter set?
-                if request.query.get("pretty") == 'true':
+                start = timeit.default_timer() if self.timed else None
+                if binaryFormat is not None:
+                    retval = binaryFormat.dumps(retval, policy.codec.default)
+                    response.content_type = binaryFormat.mediaType
+                elif request.query.get("pretty") == 'true':
                     # It was. Indent & sort keys
                     self.logger.debug("found pretty query param, value is true, prettying JSON")
-                    retval = json.dumps(retval, indent=4, sort_keys=True)
+                    retval = self.encodeJSON(retval, pretty=True, codec=policy.codec, schema=policy.schema)
                 else:
                     # It was not. By default, we'll use the most compact representation
-                    retval = json.dumps(retval, separators=(',', ':'))
-                response.content_type = "application/json"
-                self.logger.debug("%d bytes of JSON created" % len(retval))
+                    retval = self.encodeJSON(retval, codec=policy.codec)
+                if start is not None:
+                    self.recordPhase("encode", timeit.default_timer() - start)
+                if binaryFormat is None:
+                    response.content_type = "application/json"
+                if not isinstance(retval, LazyBodyChunks):
+                    self.logger.debug("%d bytes of %s created", len(retval), binaryFormat.name if binaryFormat else "JSON")
                 JSONed = True
         else:
             self.logger.debug("response should NOT be JSON")
 
+        return self.finishResponse(retval, policy, JSONed)
+
+    def finishResponse(self, retval, policy, JSONed):
+        """
+        Compresses (and validates, see declareETag) a response body that is already serialized
+        """
         # Gzipping the response
-        # Can the client even handle gzipped response bodies?
+        # Can the client even handle compressed response bodies?
         httpRespObj = None
         if isinstance(retval, bottle.HTTPResponse):
             # we'll keep the HTTPResponse so we can update it after gzipping.
             self.logger.debug("Found HTTPResponse instance")
             httpRespObj = retval
+            if retval.status_code == 206 or not (type(retval.body) in (str, unicode) or hasattr(retval.body, "read")):
+                # Partial content (bottle.static_file answers a Range request with a generator of the bytes asked
+                # for) goes out as it is: Content-Range counts the bytes of the uncompressed file. So do other
+                # iterables, which bottle and the webserver send a piece at a time
+                self.logAccess(retval.status_code, None, JSONed, None)
+                return retval
             if type(retval.body) in (str, unicode):
                 retval = retval.body
-            elif hasattr(retval.body, "read"):
-                retval = retval.body.read()
             else:
-                self.logger.error("HTTPResponse.body attr is not a str and does not have a read() method!")
-                raise ValueError("HTTPResponse.body is not sane: attr is not a str, and is not a file-like object")
+                stats = regularFileStat(retval.body) if policy.static and retval.status_code == 200 else None
+                if stats is not None:
+                    return self.serveFile(retval, stats, policy)
+                retval = retval.body.read()
 
         elif isinstance(retval, bottle.HTTPError):
             self.logger.debug("Found HTTPError instance")
@@ -183,64 +3280,761 @@ class RestwarePlugin:
             elif hasattr(retval.body, "read"):
                 retval = retval.body.read()
             else:
-                self.logger.error("HTTPError.body attr is not a str and does not have a read() method!")
-                raise ValueError("HTTPError.body is not sane: attr is not a str, and is not a file-like object")
+                self.logAccess(retval.status_code, None, JSONed, None)
+                return retval
 
-        if 'gzip' in request.headers.get("Accept-Encoding", "") and len(retval) > 0:
-            self.logger.debug("client accepts gzip, gzipping data")
-            # the client handle gzipped data, so lets gzip out data
-            self.logger.debug("original response data was %d bytes" % len(retval))
-            sio = StringIO.StringIO()
-            gzFile = gzip.GzipFile(fileobj=sio, mode='wb', compresslevel=6)
-            gzFile.write(retval)
-            gzFile.close()
-            sio.seek(0)
-            retval = sio.read()
-            sio.close()
-            self.logger.debug("new gzipped response data is %d bytes" % len(retval))
-            GZIPPED = True
+        elif not isinstance(retval, (basestring, LazyBodyChunks)):
+            # files, iterables of strings and the like are left for bottle (and the webserver) to send as they are
+            self.logAccess(response.status_code, None, JSONed, None)
+            return retval
+
+        # Negotiate the content-encoding. Whatever we end up doing, the response varies by Accept-Encoding
+        headers = (httpRespObj or response).headers
+        encoding = None
+        if policy.compress and 'Content-Encoding' not in headers and self.isCompressible(headers.get('Content-Type')):
+            addVary(headers, 'Accept-Encoding')
+            minSize = max(self.compressionMinSize, 1)
+            if retval.reaches(minSize) if isinstance(retval, LazyBodyChunks) else len(retval) >= minSize:
+                encoding = negotiateContentEncoding(request.headers.get("Accept-Encoding", ""), self.encodings)
+
+        # Validators: a handler may have declared an ETag (see declareETag), otherwise we derive a strong one from
+        # the body, if the route wants one or the client has one to check. Either way a client that already has
+        # this representation gets an empty 304 instead
+        etag = None
+        if httpRespObj is None and response.status_code == 200 and request.method in ('GET', 'HEAD') and isinstance(retval, (basestring, LazyBodyChunks)):
+            etag = response.headers.get('ETag')
+            if etag is None and (policy.etag or 'HTTP_IF_NONE_MATCH' in request.environ or 'HTTP_IF_MATCH' in request.environ):
+                # a body still being encoded has to be finished to be hashed
+                if isinstance(retval, LazyBodyChunks):
+                    retval = retval.collect()
+                digest = hashlib.sha1()
+                for piece in ([retval] if isinstance(retval, basestring) else retval):
+                    digest.update(piece.encode("utf-8") if isinstance(piece, unicode) else piece)
+                etag = '"%s"' % digest.hexdigest()
+            if etag is not None:
+                etag = representationETag(etag, encoding)
+                response.set_header('ETag', etag)
+                if etagMatches(request.headers.get('If-None-Match'), etag):
+                    self.logAccess(304, encoding, JSONed, 0)
+                    return notModified(etag)
+
+        lazy = retval if isinstance(retval, LazyBodyChunks) else None
+        if lazy is not None and not encoding:
+            # bottle only works out the Content-Length of strings
+            retval = lazy.collect()
+            response.set_header('Content-Length', str(len(retval)))
+            lazy = None
+        size = None if lazy is not None else len(retval)
+        if encoding:
+            self.logger.debug("client accepts %s, compressing data", encoding)
+            # the client handle compressed data, so lets compress our data
+            if isinstance(retval, unicode):
+                retval = retval.encode(response.charset or "utf-8")
+            # static routes keep the compressed variants of the documents they serve, along with the documents: a
+            # variant is only used for the very same document, which comparing them tells without hashing it
+            key = None
+            if policy.static and isinstance(retval, str) and self.staticCache is not None:
+                key = (policy.rule, len(retval), encoding, policy.compressLevel)
+            cached = self.staticCache.get(key, retval) if key is not None else None
+            if cached is not None:
+                retval = cached.body
+            else:
+                source = retval
+                start = timeit.default_timer() if self.timed else None
+                retval = self.compressBody(retval, encoding, policy.compressLevel)
+                if start is not None:
+                    self.recordPhase("compress", timeit.default_timer() - start)
+                if key is not None:
+                    self.staticCache.put(key, CachedResponse(None, [], retval, float("inf"), source=source))
+            if lazy is not None:
+                size = lazy.size
+            self.logger.debug("original response data was %d bytes", size)
+            self.logger.debug("new %s response data is %d bytes", encoding, len(retval))
 
             # Were we given an HTTPResponse isntance? If so, we need to update it a bit
             if httpRespObj:
-                self.logger.debug("Updating HTTPResponse instance with gzipped content, headers")
+                self.logger.debug("Updating HTTPResponse instance with compressed content, headers")
                 httpRespObj.body = retval
                 httpRespObj['Content-Length'] = str(len(retval))
-                httpRespObj['Content-Encoding'] = 'gzip'
+                httpRespObj['Content-Encoding'] = encoding
             else:
                 # update the content-length (it is already set) and add the content-encoding header
                 response.set_header('Content-Length', str(len(retval)))
-                response.set_header('Content-Encoding', 'gzip')
+                response.set_header('Content-Encoding', encoding)
         else:
-            self.logger.debug("client either doesn't accept gzip or there's no data to return; len(retval)=%d" % len(retval))
+            self.logger.debug("client doesn't accept compression, or the data is too small or incompressible; len(retval)=%d", len(retval))
 
-        self.logger.info("RESPONSE %s gzipped:%s json:%s size:%dB" % (response.status_code, GZIPPED, JSONed, len(retval)))
+        if self.timed:
+            request.environ['restware.bytes'] = (size, len(retval))
+        self.logAccess(response.status_code, encoding, JSONed, len(retval))
         if httpRespObj:
             return httpRespObj
         return retval
 
+    def serveFile(self, httpResp, stats, policy):
+        """
+        Sends a regular file returned by a static route, e.g. by bottle.static_file. The file isn't read into memory
+        when it goes out uncompressed: bottle hands the file object to the webserver's wsgi.file_wrapper, if it has
+        one. A compressed variant is made once, from a memory map of the file, and kept in the static cache under
+        the file's path, modification time and size, so the file is only compressed again once it changes. Its ETag
+        is derived from the same three.
+        """
+        fileobj = httpResp.body
+        headers = httpResp.headers
+        path = getattr(fileobj, "name", None)
+        encoding = None
+        if policy.compress and 'Content-Encoding' not in headers and self.isCompressible(headers.get('Content-Type')):
+            addVary(headers, 'Accept-Encoding')
+            if stats.st_size >= max(self.compressionMinSize, 1):
+                encoding = negotiateContentEncoding(request.headers.get("Accept-Encoding", ""), self.encodings)
+
+        version = u"%s:%r:%d" % (path, stats.st_mtime, stats.st_size)
+        etag = representationETag('"%s"' % hashlib.sha1(version.encode("utf-8")).hexdigest(), encoding)
+        headers['ETag'] = etag
+        if etagMatches(request.headers.get('If-None-Match'), etag):
+            fileobj.close()
+            httpResp.body = notModified(etag, httpResp)
+            self.logAccess(304, encoding, False, 0)
+            return httpResp
+
+        size = stats.st_size
+        if encoding:
+            # files without a name can't be told apart, so their variants aren't kept
+            key = (path, stats.st_mtime, stats.st_size, encoding, policy.compressLevel) if path and self.staticCache is not None else None
+            cached = self.staticCache.get(key) if key is not None else None
+            if cached is not None:
+                body = cached.body
+            else:
+                start = timeit.default_timer() if self.timed else None
+                body = self.compressFile(fileobj, encoding, policy.compressLevel)
+                if start is not None:
+                    self.recordPhase("compress", timeit.default_timer() - start)
+                if key is not None:
+                    self.staticCache.put(key, CachedResponse(None, [], body, float("inf")))
+            fileobj.close()
+            httpResp.body = body
+            headers['Content-Length'] = str(len(body))
+            headers['Content-Encoding'] = encoding
+            size = len(body)
+        if self.timed:
+            request.environ['restware.bytes'] = (stats.st_size, size)
+        self.logAccess(httpResp.status_code, encoding, False, size)
+        return httpResp
+
+    def compressFile(self, fileobj, encoding, level):
+        """
+        Compresses a whole file, through a memory map of it rather than a copy of its contents, into a BodyChunks
+        """
+        try:
+            mapped = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            fileobj.seek(0)
+            return compressChunks(fileobj.read(), encoding, level)
+        try:
+            return compressChunks(mapped, encoding, level)
+        finally:
+            mapped.close()
+
+    def compressBody(self, data, encoding, level):
+        """
+        Compresses a response body, spreading large gzip and deflate bodies over the compression thread pool. The
+        result is a BodyChunks, so the compressor's output is never copied into one string. A LazyBodyChunks is
+        compressed inline, a piece at a time as it is produced
+        """
+        counters = self.offloadCounters
+        if isinstance(data, (BodyChunks, LazyBodyChunks)):
+            counters["inlineBodies"] += 1
+            compressobj = compressor(encoding, level)
+            return BodyChunks([compressobj.compress(piece) for piece in data] + [compressobj.flush()])
+        if self.compressionPool is None or len(data) < self.offloadMinSize:
+            counters["inlineBodies"] += 1
+            return compressChunks(data, encoding, level)
+        if encoding == "zstd":
+            # zstd does its own multi-threading
+            counters["offloadedBodies"] += 1
+            counters["offloadedBytes"] += len(data)
+            return BodyChunks([zstandard.ZstdCompressor(level=level, threads=self.compressionThreads).compress(data)])
+        compressed, offloaded = compressInParallel(data, encoding, level, self.compressionPool, self.offloadChunkSize)
+        counters["offloadedBodies"] += 1
+        counters["offloadedBytes"] += len(data)
+        counters["offloadedChunks"] += offloaded
+        counters["inlineChunks"] += (len(data) + self.offloadChunkSize - 1) // self.offloadChunkSize - offloaded
+        return compressed
+
+    def encodeJSON(self, retval, pretty=False, codec=None, schema=None):
+        """
+        Serializes retval with the codec (the plugin's, unless another is given), handing very large pretty
+        payloads to the JSON process pool if there is one. The pool's processes only have the plugin's codec. Only
+        pretty JSON goes there: its keys are sorted, whereas the key order of compact JSON is that of the dicts, which
+        depends on how they were built and doesn't survive pickling, so it would come back different. Compact JSON
+        is also about as quick to encode as to pickle. Pretty JSON is encoded by the route's ResponseSchema instead,
+        if it has one and retval fits it.
+
+        Lists too long to be encoded in one batch (see JSONArrayStream) that stay on this thread come back as a
+        LazyBodyChunks, encoded a batch at a time as finishResponse compresses them, so their JSON text is never held
+        whole. That is the same text codec.dumps would produce, but its encoding counts towards the compress phase
+        of the metrics. Not when there is a compression pool, though, which needs the whole body to split it up
+        """
+        if pretty and schema is not None:
+            encoded = schema.dumpsPretty(retval)
+            if encoded is not None:
+                return encoded
+        counters = self.offloadCounters
+        codec = codec or self.codec
+        inline = (not pretty or codec is not self.codec or self.jsonPool is None
+                  or estimateJSONSize(retval) < self.jsonOffloadMinSize)
+        if inline or not self.jsonSlots.acquire(False):
+            if type(retval) is list and len(retval) > JSONArrayStream.batchSize and self.compressionPool is None:
+                return LazyBodyChunks(JSONArrayStream(retval, pretty, codec=codec).iterText())
+            return codec.dumps(retval, pretty)
+        try:
+            try:
+                payload = cPickle.dumps(retval, cPickle.HIGHEST_PROTOCOL)
+                encoded = self.jsonPool.apply_async(_encodeJSONInWorker, (payload, pretty)).get(self.jsonTimeout)
+            except multiprocessing.TimeoutError:
+                # the process keeps at it, but this request has waited long enough
+                self.logger.warn("JSON encoding in the process pool took over %ss; encoding inline", self.jsonTimeout)
+                counters["jsonFailed"] += 1
+                counters["jsonTimeouts"] += 1
+                return self.codec.dumps(retval, pretty)
+            except Exception, e:
+                # most likely something that can't be pickled; it may still be encodable here
+                self.logger.debug("JSON encoding in the process pool failed (%s); encoding inline", e)
+                counters["jsonFailed"] += 1
+                return self.codec.dumps(retval, pretty)
+            counters["jsonOffloaded"] += 1
+            counters["jsonOffloadedBytes"] += len(encoded)
+            return encoded
+        finally:
+            self.jsonSlots.release()
+
+    def offloadStats(self):
+        """
+        Returns counters describing how much work was handed to the worker pools: offloadedBodies, offloadedBytes,
+        offloadedChunks and inlineChunks (chunks the full queue made us compress on the request thread) for
+        compression, inlineBodies for bodies compressed inline, and jsonOffloaded, jsonOffloadedBytes, jsonFailed
+        (payloads encoded inline after all because the pool couldn't) and jsonTimeouts (those of them it took too
+        long for) for JSON encoding
+        """
+        return dict(self.offloadCounters)
+
+    def logAccess(self, status, encoding, JSONed, size):
+        """
+        Emits the access log record of the current response: one INFO record on the access logger, whose fields
+        (method, path, query, status, encoding, json and size, which is None for streamed bodies) are also set as
+        attributes of the record, for formatters and handlers that want them structured. Only a sample of
+        accessLogSampleRate of the responses is logged, plus every 5xx, and nothing at all is done while the
+        access logger isn't enabled for INFO.
+        """
+        if not self.accessLogger.isEnabledFor(logging.INFO):
+            return
+        if status < 500 and self.accessLogSampleRate < 1 and random.random() >= self.accessLogSampleRate:
+            return
+        fields = {"method": request.method, "path": request.path, "query": request.query_string, "status": status,
+                  "encoding": encoding or "identity", "json": JSONed, "size": size}
+        self.accessLogger.info("RESPONSE %(status)s %(method)s %(path)s encoding:%(encoding)s json:%(json)s size:%(size)s",
+                               fields, extra=fields)
+
+    def isStreamable(self, retval, streamLists=None):
+        """
+        True if retval should be sent to the client as a streamed JSON array: any generator or iterator, and
+        lists when streamLists (by default, streamResponses) is on.
+        """
+        if type(retval) is list:
+            return self.streamResponses if streamLists is None else streamLists
+        if isinstance(retval, (basestring, dict, bottle.BaseResponse)) or hasattr(retval, "read"):
+            return False
+        return isinstance(retval, types.GeneratorType) or (hasattr(retval, "next") and hasattr(retval, "__iter__"))
+
+    def streamResponse(self, retval, route=None, recordFormat=None):
+        """
+        Serializes retval as a JSON array, a batch of items at a time, or with recordFormat as one record per item,
+        compressing it on the fly if the client can handle that. No Content-Length is set, so the webserver sends
+        the body chunked (or closes the connection when it's done).
+        """
+        policy = self.policyFor(route)
+        encoding = self.negotiateEncoding(policy)
+        response.content_type = recordFormat or "application/json"
+        if policy.compress:
+            addVary(response.headers, 'Accept-Encoding')
+        if encoding:
+            response.set_header('Content-Encoding', encoding)
+        self.logAccess(response.status_code, encoding, True, None)
+        return JSONArrayStream(retval, pretty=request.query.get("pretty") == 'true', encoding=encoding,
+                               compresslevel=policy.compressLevel, logger=self.logger, codec=policy.codec,
+                               format=recordFormat)
+
+
+class InflatingInput(object):
+    """
+    A read-only file-like object that decompresses a gzip, deflate or zstd encoded request body as it is read,
+    instead of all at once. Only as much compressed data is pulled from the underlying wsgi.input as is needed to
+    satisfy each read(), and the decompressor is never asked for more output than the caller wants, so memory use
+    stays bounded no matter how large the upload (or how malicious the gzip bomb) is.
+
+    The size limits are enforced while inflating: as soon as the body grows beyond maxSize bytes, or expands by
+    more than maxRatio times the compressed bytes consumed so far, a RequestBodyError (413) is raised. Corrupt or
+    truncated data raises a RequestBodyError (400).
+    """
+    readSize = 64 * 1024
+    # The expansion ratio is meaningless for tiny bodies (a 30 byte gzip of "{}" expands by less than 1x, a
+    # few hundred bytes of repetitive JSON can easily expand 500x), so it's only enforced past this many bytes
+    ratioFloor = 1024 * 1024
+
+    def __init__(self, rawInput, compressedLength=None, maxSize=None, maxRatio=None, encoding="gzip", chunked=False):
+        """
+        Args:
+            rawInput (file-like, required): the original wsgi.input, holding compressed data
+            compressedLength (int, optional): how many compressed bytes to read from rawInput, if known
+            maxSize (int, optional): the largest number of inflated bytes we'll produce
+            maxRatio (int or float, optional): the largest inflated/compressed ratio we'll tolerate
+            encoding (str, optional): the request's Content-Encoding; "gzip" (the default), "deflate" or "zstd"
+            chunked (bool, optional): rawInput holds the body in chunked transfer encoding (see ChunkedReader).
+            Each chunk is inflated by a BodyInflater as it arrives
+        """
+        self.maxSize = maxSize
+        self.maxRatio = maxRatio
+        self.encoding = encoding
+        self.inflatedSize = 0
+        if chunked:
+            self.source = ChunkedReader(rawInput)
+            self._decoder = InflaterDecoder(self.source.chunks(), BodyInflater(encoding))
+        else:
+            self.source = CountingReader(rawInput, compressedLength)
+            self._decoder = ZstdDecoder(self.source) if encoding == "zstd" else ZlibDecoder(self.source, encoding)
+        # inflated data not yet read: pieces as the decoder returned them, and how far into the first one we are
+        self._pieces = collections.deque()
+        self._offset = 0
+        self._buffered = 0
+        self._eof = False
+        self._error = None
+
+    @property
+    def compressedRead(self):
+        return self.source.count
+
+    def _fail(self, status, message):
+        """
+        Raises (and remembers, so every later read raises it again) a RequestBodyError
+        """
+        self._error = RequestBodyError(status, message)
+        raise self._error
+
+    def _inflate(self, wanted):
+        """
+        Returns up to ``wanted`` bytes of newly inflated data, or an empty string once the body is exhausted
+        """
+        if self._error:
+            raise self._error
+        if self._eof:
+            return ""
+        try:
+            data = self._decoder.read(wanted)
+        except RequestBodyError, e:
+            # a BodyInflater or ChunkedReader has already said what's wrong
+            self._error = e
+            raise
+        except Exception, e:
+            # zlib.error, zstandard.ZstdError, or whatever the underlying input raised
+            self._fail(400, malformedBodyMessage(self.encoding, e))
+        if not data:
+            self._eof = True
+            return ""
+        self._checkLimits(len(data))
+        return data
+
+    def _checkLimits(self, count):
+        self.inflatedSize += count
+        if self.maxSize is not None and self.inflatedSize > self.maxSize:
+            self._fail(413, "Decompressed request body exceeds %d bytes" % self.maxSize)
+        if self.maxRatio is not None and self.inflatedSize > self.ratioFloor \
+                and self.inflatedSize > self.maxRatio * max(self.compressedRead, 1):
+            self._fail(413, "Request body expands more than %sx when decompressed" % self.maxRatio)
+
+    def _fill(self, size):
+        """
+        Inflates until at least ``size`` bytes are buffered. Returns False if the body ended first
+        """
+        while self._buffered < size:
+            data = self._inflate(size - self._buffered)
+            if not data:
+                return False
+            self._pieces.append(data)
+            self._buffered += len(data)
+        return True
+
+    def _take(self, size):
+        """
+        Removes and returns up to ``size`` buffered bytes. A read that falls within one inflated piece returns that
+        piece (or a slice of it); only reads spanning several pieces join them
+        """
+        chunks = []
+        while size > 0 and self._pieces:
+            piece = self._pieces[0]
+            available = len(piece) - self._offset
+            if available <= size:
+                chunks.append(piece[self._offset:] if self._offset else piece)
+                self._pieces.popleft()
+                self._offset = 0
+            else:
+                available = size
+                chunks.append(piece[self._offset:self._offset + size])
+                self._offset += size
+            size -= available
+            self._buffered -= available
+        return chunks[0] if len(chunks) == 1 else "".join(chunks)
+
+    def prefetch(self, size):
+        """
+        Inflates up to ``size`` bytes ahead of the reader. Returns True if that reached the end of the body,
+        in which case ``inflatedSize`` is the exact length of the decompressed body.
+        """
+        return not self._fill(size)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while self._fill(self._buffered + self.readSize):
+                pass
+            return self._take(self._buffered)
+        self._fill(size)
+        return self._take(size)
+
+    def readline(self, size=-1):
+        chunks = []
+        length = 0
+        while size is None or size < 0 or length < size:
+            if not self._buffered:
+                self._fill(self.readSize)
+                if not self._buffered:
+                    break
+            piece = self._pieces[0]
+            end = (piece.find("\n", self._offset) + 1 or len(piece)) - self._offset
+            if size is not None and size >= 0:
+                end = min(end, size - length)
+            chunk = self._take(end)
+            chunks.append(chunk)
+            length += len(chunk)
+            if chunk.endswith("\n"):
+                break
+        return "".join(chunks)
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self._pieces.clear()
+        self._offset = self._buffered = 0
+        self._eof = True
+
+
+class BodyInflater(object):
+    """
+    The push-style counterpart of the decoders of InflatingInput, for bodies that arrive in chunks: feed() each
+    chunk of compressed data and iterate over what it inflates to, then call finish(). InflatingInput uses it for
+    chunked request bodies (see InflaterDecoder), and servers that hand a body over a chunk at a time instead of
+    letting the app read it can use it directly. Every piece is at most outputSize bytes, so a caller that must not
+    block for long can yield between them. The same limits apply, with the same RequestBodyErrors.
+
+    zstandard's decompressobj can't bound its output, so zstd data is fed to it a few bytes at a time instead, and
+    what that inflates to is split up. Nor does it go past the end of a frame, so each frame gets its own (see
+    ZstdFrames).
+    """
+    outputSize = 64 * 1024
+    zstdSliceSize = 256
+    ratioFloor = InflatingInput.ratioFloor
+
+    def __init__(self, encoding="gzip", maxSize=None, maxRatio=None):
+        """
+        Args:
+            encoding (str, optional): the request's Content-Encoding; "gzip" (the default), "deflate" or "zstd"
+            maxSize (int, optional): the largest number of inflated bytes we'll produce
+            maxRatio (int or float, optional): the largest inflated/compressed ratio we'll tolerate
+        """
+        if encoding not in CONTENT_ENCODINGS:
+            raise RequestBodyError(415, "Unsupported Content-Encoding: %s" % encoding)
+        self.encoding = encoding
+        self.maxSize = maxSize
+        self.maxRatio = maxRatio
+        self.compressedSize = 0
+        self.inflatedSize = 0
+        self.inflater = None
+        self.pending = ""
+        # zstd: where its frames end, and how much of it has been handed to a decompressobj
+        self.frames = ZstdFrames()
+        self.frameEnds = collections.deque()
+        self.zstdPosition = 0
+
+    def checkLimits(self, count):
+        self.inflatedSize += count
+        if self.maxSize is not None and self.inflatedSize > self.maxSize:
+            raise RequestBodyError(413, "Decompressed request body exceeds %d bytes" % self.maxSize)
+        if self.maxRatio is not None and self.inflatedSize > self.ratioFloor \
+                and self.inflatedSize > self.maxRatio * max(self.compressedSize, 1):
+            raise RequestBodyError(413, "Request body expands more than %sx when decompressed" % self.maxRatio)
+
+    def feed(self, data):
+        """
+        Generates the inflated data in a chunk of the compressed body. Iterate over all of it before feeding the
+        next chunk
+        """
+        self.compressedSize += len(data)
+        if self.encoding == "zstd":
+            self.frameEnds.extend(self.frames.feed(data))
+        pending, self.pending = self.pending + data, ""
+        while pending:
+            if self.inflater is None:
+                if self.encoding == "zstd":
+                    self.inflater = zstandard.ZstdDecompressor().decompressobj()
+                elif self.encoding == "deflate" and len(pending) < 2:
+                    # too little to tell zlib-wrapped from raw deflate yet
+                    self.pending = pending
+                    return
+                else:
+                    self.inflater = zlibDecompressor(self.encoding, pending)
+            try:
+                if self.encoding == "zstd":
+                    size = min(self.zstdSliceSize, len(pending))
+                    if self.frameEnds:
+                        size = min(size, self.frameEnds[0] - self.zstdPosition)
+                    out = self.inflater.decompress(pending[:size])
+                    pending = pending[size:]
+                    self.zstdPosition += size
+                    if self.frameEnds and self.zstdPosition == self.frameEnds[0]:
+                        # the next frame needs a decompressobj of its own
+                        self.frameEnds.popleft()
+                        self.inflater = None
+                else:
+                    out = self.inflater.decompress(pending, self.outputSize)
+                    pending = self.inflater.unconsumed_tail
+                    if self.inflater.unused_data:
+                        if self.encoding == "gzip":
+                            # one gzip member finished and another follows it (see ZlibDecoder.read)
+                            pending = self.inflater.unused_data
+                            self.inflater = None
+                        else:
+                            # anything after the end of a deflate stream is junk
+                            pending = ""
+            except Exception, e:
+                # zlib.error or zstandard.ZstdError
+                raise RequestBodyError(400, malformedBodyMessage(self.encoding, e))
+            if out:
+                self.checkLimits(len(out))
+                for start in xrange(0, len(out), self.outputSize):
+                    yield out[start:start + self.outputSize]
+
+    def finish(self):
+        """
+        Returns the last of the inflated data, once the whole body has been fed
+        """
+        if self.pending:
+            # a deflate body of a single byte
+            raise RequestBodyError(400, "Malformed %s data in request body: truncated data" % self.encoding)
+        if self.encoding == "zstd":
+            if self.frames.invalid:
+                raise RequestBodyError(400, "Malformed zstd data in request body: unknown frame descriptor")
+            if not self.frames.complete:
+                raise RequestBodyError(400, "Malformed zstd data in request body: truncated data")
+            return ""
+        if self.inflater is None:
+            return ""
+        ended = zlibStreamEnded(self.inflater)
+        data = self.inflater.flush()
+        if not ended:
+            raise RequestBodyError(400, "Malformed %s data in request body: truncated data" % self.encoding)
+        self.checkLimits(len(data))
+        return data
+
+
+class InflaterDecoder(object):
+    """
+    Reads from a BodyInflater the way InflatingInput reads from its other decoders, feeding it the chunks of
+    compressed data an iterator yields (see ChunkedReader.chunks) one at a time, as more output is wanted
+    """
+    def __init__(self, chunks, inflater):
+        self.chunks = chunks
+        self.inflater = inflater
+        self.output = iter(())
+        self.piece = ""
+        self.offset = 0
+        self.finished = False
+
+    def read(self, wanted):
+        """
+        Returns up to ``wanted`` bytes of newly inflated data, or an empty string once the data is exhausted
+        """
+        while self.offset >= len(self.piece):
+            piece = next(self.output, None)
+            if piece is not None:
+                self.piece, self.offset = piece, 0
+            elif self.finished:
+                return ""
+            else:
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    self.finished = True
+                    self.output = iter([self.inflater.finish()])
+                else:
+                    self.output = self.inflater.feed(chunk)
+        if self.offset == 0 and wanted >= len(self.piece):
+            data, self.piece = self.piece, ""
+        else:
+            data = self.piece[self.offset:self.offset + wanted]
+            self.offset += len(data)
+        return data
+
+
+class AdmissionLimit(object):
+    """
+    Lets at most ``concurrency`` requests through at once. Up to ``maxQueue`` more may wait for one of them to
+    finish, each for no longer than ``maxWait`` seconds; the rest are shed straight away. See Restware.
+    """
+    def __init__(self, concurrency, maxQueue=0, maxWait=1.0):
+        """
+        Args:
+            concurrency (int, required): how many requests may be in progress at once
+            maxQueue (int, optional): how many requests may wait for a slot. Defaults to 0, no waiting
+            maxWait (int or float, optional): how many seconds a request may wait before it is shed. Defaults to 1
+        """
+        self.concurrency = concurrency
+        self.maxQueue = maxQueue
+        self.maxWait = maxWait
+        self.active = self.waiting = 0
+        self.condition = threading.Condition(threading.Lock())
+        # admitted, queued (admitted or not), shed (queue full) and expired (waited maxWait in vain)
+        self.counters = collections.defaultdict(int)
+
+    def acquire(self):
+        """
+        Returns True once the request may go ahead, in which case release() must follow, or False if it is shed
+        """
+        with self.condition:
+            if self.active < self.concurrency and not self.waiting:
+                self.active += 1
+                self.counters["admitted"] += 1
+                return True
+            if self.waiting >= self.maxQueue:
+                self.counters["shed"] += 1
+                return False
+            self.waiting += 1
+            self.counters["queued"] += 1
+            deadline = time.time() + self.maxWait
+            try:
+                while self.active >= self.concurrency:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.counters["expired"] += 1
+                        return False
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            self.counters["admitted"] += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def afterFork(self):
+        """
+        Starts a newly forked process with no requests in progress or waiting, and a new lock
+        """
+        self.active = self.waiting = 0
+        self.condition = threading.Condition(threading.Lock())
+        self.counters = collections.defaultdict(int)
+
+    def stats(self):
+        """
+        Returns the counters, and how many requests are in progress (active) and waiting right now
+        """
+        with self.condition:
+            stats = dict(self.counters)
+            stats.update(active=self.active, waiting=self.waiting)
+        return stats
+
+
+class AdmittedResponse(object):
+    """
+    Wraps a WSGI response iterable, releasing the admission slots its request holds once the webserver closes it
+    """
+    def __init__(self, result, release):
+        self.result = result
+        self.release = release
+
+    def __iter__(self):
+        return iter(self.result)
+
+    def close(self):
+        try:
+            if hasattr(self.result, "close"):
+                self.result.close()
+        finally:
+            release, self.release = self.release, None
+            if release is not None:
+                release()
+
 
 class Restware(object):
     """
-    Middleware that handles de-gzipping incoming request body data. This should work with any other WSGI app obviously,
+    Middleware that handles decompressing incoming request body data. This should work with any other WSGI app obviously,
     but it is tested with Bottle, and it is designed to work in conjunction with the RestwarePlugin (which handles
     gzipping response body data).
 
     .. codeauthor:: Trevor Tonn <smthmlk@gmail.com>
     """
-    def __init__(self, app, logger=None):
+    # Bodies that inflate to no more than this (or than bottle's MEMFILE_MAX, whichever is larger) are decoded up
+    # front, so CONTENT_LENGTH can be set exactly
+    prefetchSize = 64 * 1024
+
+    def __init__(self, app, logger=None, maxDecompressedSize=1024 * 1024 * 1024, maxExpansionRatio=100,
+                 logLevel=logging.WARNING, maxConcurrency=None, maxQueue=0, maxQueueWait=1.0, prefixLimits=None,
+                 retryAfter=1):
         """
         Args:
             app (wsgi app instance, required): the app to wrap with this middleware
             logger (logging.Logger, optional): provide a logger instance to use
+            maxDecompressedSize (int, optional): compressed request bodies that inflate past this many bytes are
+            rejected with a 413. Defaults to 1GiB; None disables the check
+            maxExpansionRatio (int or float, optional): compressed request bodies that inflate to more than this
+            many times their compressed size are rejected with a 413. Defaults to 100; None disables the check
+            logLevel (int, optional): the level of the logger made when none is given. Defaults to WARNING
+            maxConcurrency (int, optional): how many requests the app may be handling at once. Beyond that,
+            requests wait for a slot (see maxQueue), or are answered with a 503 without reaching the app. Defaults
+            to None, no limit
+            maxQueue (int, optional): how many requests may wait for a slot. Defaults to 0: shed them right away
+            maxQueueWait (int or float, optional): how many seconds a request may wait for a slot before it is shed.
+            Defaults to 1
+            prefixLimits (dict, optional): limits for the requests under a path prefix, e.g.
+            {"/api/v1/reports/": 4}, on top of maxConcurrency. Values are a concurrency (queueing like maxQueue and
+            maxQueueWait say) or an AdmissionLimit. The longest matching prefix applies
+            retryAfter (int, optional): the Retry-After, in seconds, sent with 503s for shed requests. Defaults to 1
         """
         self.app = app
+        self.globalLimit = AdmissionLimit(maxConcurrency, maxQueue, maxQueueWait) if maxConcurrency else None
+        self.prefixLimits = []
+        for prefix, limit in (prefixLimits or {}).items():
+            if not isinstance(limit, AdmissionLimit):
+                limit = AdmissionLimit(limit, maxQueue, maxQueueWait)
+            self.prefixLimits.append((prefix, limit))
+        # longest prefix first, so the first match is the most specific one
+        self.prefixLimits.sort(key=lambda item: len(item[0]), reverse=True)
+        self.limited = self.globalLimit is not None or bool(self.prefixLimits)
+        self.retryAfter = retryAfter
+        self.maxDecompressedSize = maxDecompressedSize
+        self.maxExpansionRatio = maxExpansionRatio
         self.logger = logger
         if not self.logger:
-            self.logger = logging.getLogger("Restware")
-            handler = logging.StreamHandler(sys.stdout)
-            handler.setFormatter(logging.Formatter("%(levelname)s %(module)s:%(funcName)s %(asctime)s| %(message)s"))
-            self.logger.addHandler(handler)
-            self.logger.setLevel(logging.DEBUG)
+            self.logger = defaultLogger("Restware", "%(levelname)s %(module)s:%(funcName)s %(asctime)s| %(message)s", logLevel)
 
     def postprocess(self, yieldedData, environ):
         """
@@ -259,23 +4053,17 @@ class Restware(object):
         if 'gzip' in environ.get("HTTP_ACCEPT_ENCODING", "") and len(yieldedData) > 0:
             self.logger.debug("client accepts gzip, gzipping data")
             # the client handle gzipped data, so lets gzip out data
-            self.logger.debug("original response data was %d bytes" % len(yieldedData))
-            sio = StringIO.StringIO()
-            gzFile = gzip.GzipFile(fileobj=sio, mode='wb', compresslevel=6)
-            gzFile.write(yieldedData)
-            gzFile.close()
-            sio.seek(0)
-            yieldedData = sio.read()
-            sio.close()
+            self.logger.debug("original response data was %d bytes", len(yieldedData))
+            yieldedData = compress(yieldedData, "gzip", 6)
 
             # update the content-length (it is already set) and add the content-encoding header
             for idx, header in enumerate(self.headers):
                 if header[0].lower() in ('content-length', 'content-encoding'):
                     self.headers.pop(idx)
-                    self.logger.debug("found existing response header %s; removing" % header[0])
+                    self.logger.debug("found existing response header %s; removing", header[0])
             self.headers.append(('Content-Length', len(yieldedData)))
             self.headers.append(('Content-Encoding', 'gzip'))
-            self.logger.debug("new gzipped response data is %d bytes" % len(yieldedData))
+            self.logger.debug("new gzipped response data is %d bytes", len(yieldedData))
         else:
             self.logger.debug("client either doesn't accept gzip or there's no data to return")
 
@@ -284,30 +4072,63 @@ class Restware(object):
     def preprocess(self, environ):
         """
         The method lets see the request before the app does, so it's a reasonable place to look at the
-        request body and request headers to see if any gzipped content was provided, and transparently
-        handle it. If nothing is given, or was was given is gzip-encoded, then this method does not tamper
-        with anything.
+        request body and request headers to see if any compressed content (gzip, deflate or, with the zstandard
+        package installed, zstd) was provided, and transparently handle it. If nothing is given, or what was given
+        is not compressed, then this method does not tamper with anything.
 
         Args:
             environ (wsgi dict): from the wsgi webserver. This may be manipulated.
+
+        Returns:
+            None, or a RequestBodyError if the request should be rejected without ever reaching the app
         """
         # log a bit about this request.
-        self.logger.info("REQUEST %(REQUEST_METHOD)s server=%(SERVER_NAME)s:%(SERVER_PORT)s path=%(PATH_INFO)s query=%(QUERY_STRING)s" % environ)
-
-        # is this a POST, and if so, did they send along gzipped data?
-        if environ['REQUEST_METHOD'] == 'POST' and environ.get("HTTP_CONTENT_ENCODING") == 'gzip':
-            # we need to decompress the gzipped data
-            self.logger.debug("gzipped data found in POST body")
-            contentLength = int(environ.get('CONTENT_LENGTH', 0))
-            compressedData = environ['wsgi.input'].read(contentLength)
-            sio = StringIO.StringIO(compressedData)
-            gzFile = gzip.GzipFile(fileobj=sio)
-            decompressedData = gzFile.read()
-            gzFile.close()
-            sio.close()
-            environ['wsgi.input'] = StringIO.StringIO(decompressedData)
-            environ['CONTENT_LENGTH'] = str(len(decompressedData))
-            self.logger.debug("expanded %d bytes of gzip into %d bytes of uncompressed data" % (contentLength, len(decompressedData)))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("REQUEST %s server=%s:%s path=%s query=%s", environ['REQUEST_METHOD'], environ.get('SERVER_NAME'),
+                              environ.get('SERVER_PORT'), environ.get('PATH_INFO'), environ.get('QUERY_STRING'))
+
+        # did they send along compressed data?
+        encoding = environ.get("HTTP_CONTENT_ENCODING", "").strip().lower()
+        if encoding == "x-gzip":
+            encoding = "gzip"
+        if encoding in ("", "identity") or environ['REQUEST_METHOD'] not in ('POST', 'PUT', 'PATCH'):
+            return None
+        if encoding not in CONTENT_ENCODINGS:
+            self.logger.warn("request body has unsupported Content-Encoding %s", encoding)
+            return RequestBodyError(415, "Unsupported Content-Encoding: %s" % encoding)
+
+        # we need to decompress the data. It's inflated lazily, as the app reads wsgi.input
+        self.logger.debug("%s data found in %s body", encoding, environ['REQUEST_METHOD'])
+        contentLength = int(environ.get('CONTENT_LENGTH') or 0)
+        # A chunked body has no Content-Length: its chunks are inflated as they arrive, and what the app reads is
+        # the plain inflated body, with a length like any other
+        chunked = 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower()
+        stream = InflatingInput(environ['wsgi.input'], None if chunked else contentLength, self.maxDecompressedSize,
+                                self.maxExpansionRatio, encoding, chunked)
+        environ['wsgi.input'] = stream
+        environ.pop('HTTP_CONTENT_ENCODING')
+        if chunked:
+            environ.pop('HTTP_TRANSFER_ENCODING')
+        start = timeit.default_timer()
+        try:
+            # everything bottle would parse in memory (request.forms, request.json) gets its exact length
+            complete = stream.prefetch(max(self.prefetchSize, bottle.BaseRequest.MEMFILE_MAX + 1))
+            # picked up by the RestwarePlugin, if it is timing requests
+            environ['restware.inflate'] = timeit.default_timer() - start
+        except RequestBodyError, e:
+            self.logger.warn("%s request body rejected: %s", encoding, e.body)
+            return e
+        if complete:
+            environ['CONTENT_LENGTH'] = str(stream.inflatedSize)
+            self.logger.debug("expanded %d bytes of %s into %d bytes of uncompressed data", stream.compressedRead, encoding, stream.inflatedSize)
+        else:
+            # The real length isn't known until the body has been read, but it's past MEMFILE_MAX, so bottle's
+            # in-memory parsers would refuse it with a 413 whatever length we give. Advertise one byte past the
+            # upper bound, so readers that respect it still trip the size check. Readers stop at EOF (bottle does),
+            # and bottle spools bodies this large to a temp file rather than holding them in memory
+            environ['CONTENT_LENGTH'] = str(self.maxDecompressedSize + 1 if self.maxDecompressedSize is not None else sys.maxint)
+            self.logger.debug("streaming %d bytes of %s; decompressed size not yet known", contentLength, encoding)
+        return None
 
     def __call__(self, environ, start_response):
         """
@@ -315,5 +4136,432 @@ class Restware(object):
         call our preprocess method to examine the request, potentially altering the environ dict, before the our
         wrapped app calls the provided start_response function.
         """
-        self.preprocess(environ)
+        if not self.limited:
+            return self.handle(environ, start_response)
+        limits = self.admit(environ.get('PATH_INFO', ''))
+        if limits is None:
+            return self.errorResponse(start_response, "503 Service Unavailable", "Server is overloaded, try again later",
+                                      [('Retry-After', str(self.retryAfter))])
+        release = lambda: self.release(limits)
+        try:
+            result = self.handle(environ, start_response)
+        except BaseException:
+            release()
+            raise
+        fileWrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(fileWrapper, type) and isinstance(result, fileWrapper):
+            # wrapping it would stop the webserver from sending the file its own way; the app is done with it anyway
+            release()
+            return result
+        return AdmittedResponse(result, release)
+
+    def handle(self, environ, start_response):
+        rejection = self.preprocess(environ)
+        if rejection is not None:
+            return self.errorResponse(start_response, rejection.status_line, rejection.body)
         return self.app(environ, start_response)
+
+    def admit(self, path):
+        """
+        Acquires the limits a request for path is subject to (see AdmissionLimit): the most specific prefix limit
+        first, then the global one. Returns what it acquired, for release(), or None if the request is to be shed
+        """
+        limits = [limit for prefix, limit in self.prefixLimits if path.startswith(prefix)][:1]
+        if self.globalLimit is not None:
+            limits.append(self.globalLimit)
+        for count, limit in enumerate(limits):
+            if not limit.acquire():
+                self.release(limits[:count])
+                self.logger.warn("shedding request for %s: too many requests in progress", path)
+                return None
+        return limits
+
+    def release(self, limits):
+        for limit in limits:
+            limit.release()
+
+    def afterFork(self):
+        """
+        Resets the admission limits in a newly forked process. See PreforkServer
+        """
+        for limit in [limit for prefix, limit in self.prefixLimits] + [self.globalLimit]:
+            if limit is not None:
+                limit.afterFork()
+
+    def admissionStats(self):
+        """
+        Returns the counters of every limit (see AdmissionLimit.stats), keyed by their prefix; the global limit's
+        are under "*"
+        """
+        stats = dict((prefix, limit.stats()) for prefix, limit in self.prefixLimits)
+        if self.globalLimit is not None:
+            stats["*"] = self.globalLimit.stats()
+        return stats
+
+    def errorResponse(self, start_response, status, message, headers=()):
+        """
+        Answers a request without involving the wrapped app, using the same JSON error body the RestwarePlugin
+        produces for errors.
+
+        Args:
+            start_response (callable, required): the wsgi start_response function
+            status (str, required): the status line, e.g. "413 Request Entity Too Large"
+            message (str, required): what went wrong
+            headers (sequence of (name, value) tuples, optional): more headers to send, e.g. Retry-After
+        """
+        body = json.dumps({"message": message}, separators=(',', ':'))
+        start_response(status, [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))] + list(headers))
+        return [body]
+
+
+def restwarePlugins(app):
+    """
+    Returns the RestwarePlugins of a WSGI app: a bottle app, possibly wrapped in Restware
+    """
+    while isinstance(app, Restware):
+        app = app.app
+    return [plugin for plugin in getattr(app, "plugins", ()) if isinstance(plugin, RestwarePlugin)]
+
+
+def beforeFork(app):
+    """
+    Calls beforeFork() on the RestwarePlugins of a WSGI app that is about to fork the processes that will serve it
+    """
+    for plugin in restwarePlugins(app):
+        plugin.beforeFork()
+
+
+def afterFork(app):
+    """
+    Calls afterFork() on the Restware middleware and RestwarePlugins of a WSGI app (a bottle app, possibly wrapped
+    in Restware) in a newly forked process
+    """
+    middleware = app
+    while isinstance(middleware, Restware):
+        middleware.afterFork()
+        middleware = middleware.app
+    for plugin in restwarePlugins(app):
+        plugin.afterFork()
+
+
+def loadApp(spec, apiBasePath="/api/"):
+    """
+    Imports the WSGI app named by spec, "package.module:name" (name defaults to "app"), and restwares it: a bottle
+    app without a RestwarePlugin gets one, and anything not already wrapped in the Restware middleware is wrapped
+    """
+    moduleName, _, name = spec.partition(":")
+    __import__(moduleName)
+    app = getattr(sys.modules[moduleName], name or "app")
+    if isinstance(app, Restware):
+        return app
+    if isinstance(app, bottle.Bottle) and not any(isinstance(plugin, RestwarePlugin) for plugin in app.plugins):
+        app.install(RestwarePlugin(apiBasePath=apiBasePath))
+    return Restware(app)
+
+
+class QuietWSGIRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+    """
+    wsgiref's request handler, minus its line per request on stderr; the RestwarePlugin logs responses itself
+    """
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
+    """
+    wsgiref's server with a thread per connection. The threads aren't daemons, so a worker that is stopping can
+    wait for the requests it is still serving
+    """
+    daemon_threads = False
+
+
+class PreforkServer(object):
+    """
+    Serves a WSGI app from several forked worker processes, each with its own interpreter (and GIL) and a thread
+    per connection, so JSON encoding and compression use every core.
+
+    Where the platform has SO_REUSEPORT, every worker listens on a socket of its own, bound to the same address,
+    and the kernel spreads connections over them. Elsewhere the workers accept from the one listening socket they
+    inherit. The supervising process restarts workers that exit, and on SIGHUP replaces them all, starting the new
+    ones before telling the old ones to finish what they are serving and exit. SIGTERM and SIGINT stop everything
+    the same graceful way.
+
+    Workers recycle themselves (exit, to be replaced) after maxRequests connections or once their peak resident
+    memory passes maxRSS bytes, so a slow leak never takes a box down.
+
+    The app is normally loaded by each worker after it forks, which is what lets a reload pick up new code. With
+    preload=True it is loaded once, before forking, and the workers share its memory until they write to it; each
+    one then calls afterFork() on the app's RestwarePlugins to reset what a child can't share.
+    """
+    # how often, in seconds, the supervisor and idle workers look at their flags
+    pollInterval = 1.0
+
+    def __init__(self, loader, host="0.0.0.0", port=8080, workers=None, preload=False, maxRequests=None,
+                 maxRSS=None, gracefulTimeout=30, backlog=1024, logger=None, logLevel=logging.INFO):
+        """
+        Args:
+            loader (callable, required): returns the WSGI app to serve, e.g. lambda: loadApp("myapp:app")
+            host (str, optional): the address to listen on. Defaults to all IPv4 addresses
+            port (int, optional): the port to listen on; 0 picks a free one (see address). Defaults to 8080
+            workers (int, optional): how many worker processes to run. Defaults to one per CPU
+            preload (bool, optional): load the app in the supervisor, before forking, instead of in every worker
+            maxRequests (int, optional): workers recycle themselves after serving this many connections
+            maxRSS (int, optional): workers recycle themselves once their peak resident memory passes this many
+            bytes. Needs the resource module
+            gracefulTimeout (int or float, optional): how many seconds a stopping worker may spend finishing the
+            requests it is serving before it is killed
+            backlog (int, optional): the listen() backlog of the listening sockets
+            logger (logging.Logger, optional): where the supervisor and workers report starts, exits and failures
+            logLevel (int, optional): the level of the logger made when none is given. Defaults to INFO
+        """
+        self.loader = loader
+        self.host = host
+        self.port = port
+        self.workers = workers or multiprocessing.cpu_count()
+        self.preload = preload
+        self.maxRequests = maxRequests
+        self.maxRSS = maxRSS
+        self.gracefulTimeout = gracefulTimeout
+        self.backlog = backlog
+        self.logger = logger
+        if not self.logger:
+            self.logger = defaultLogger("RestwareServer", "%(levelname)s %(process)d | %(message)s", logLevel)
+        self.reusePort = getattr(socket, "SO_REUSEPORT", None) is not None
+        # the address actually bound, once serve() has bound it
+        self.address = None
+        # pid -> generation of every worker still running; a reload starts a new generation
+        self.children = {}
+        self.generation = 0
+        self.stopping = self.reloading = False
+
+    def bindSocket(self, listen=True):
+        family = socket.AF_INET6 if ":" in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reusePort:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(self.address or (self.host, self.port))
+        if listen:
+            sock.listen(self.backlog)
+        return sock
+
+    def serve(self):
+        """
+        Binds the address, starts the workers and supervises them until SIGTERM or SIGINT
+        """
+        # With SO_REUSEPORT this socket only holds on to the address (it never listens, so the kernel never gives
+        # it a connection); the workers bind sockets of their own next to it
+        listener = self.bindSocket(listen=not self.reusePort)
+        self.address = listener.getsockname()[:2]
+        app = None
+        if self.preload:
+            app = self.loader()
+            # the workers start JSON process pools of their own
+            beforeFork(app)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        # only there to cut the supervisor's sleep short when a worker exits
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        self.logger.info("serving on %s:%d with %d workers (%s)", self.address[0], self.address[1], self.workers,
+                         "SO_REUSEPORT" if self.reusePort else "shared socket")
+        retiring = set()
+        try:
+            while not self.stopping:
+                if self.reloading:
+                    self.reloading = False
+                    self.generation += 1
+                    self.logger.info("reloading: replacing %d workers", len(self.children))
+                self.reap()
+                current = [pid for pid, generation in self.children.items() if generation == self.generation]
+                for _ in xrange(self.workers - len(current)):
+                    self.spawn(app, listener)
+                for pid, generation in self.children.items():
+                    if generation != self.generation and pid not in retiring:
+                        self.sendSignal(pid, signal.SIGTERM)
+                        retiring.add(pid)
+                retiring.intersection_update(self.children)
+                time.sleep(self.pollInterval)
+        finally:
+            self.shutdown()
+            listener.close()
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def reload(self, signum=None, frame=None):
+        self.reloading = True
+
+    def sendSignal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def reap(self):
+        """
+        Forgets the workers that have exited, returning how many there were
+        """
+        count = 0
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                self.children.clear()
+                break
+            if not pid:
+                break
+            if self.children.pop(pid, None) is None:
+                continue
+            count += 1
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                self.logger.info("worker %d exited", pid)
+            else:
+                self.logger.warn("worker %d died (status %d)", pid, status)
+        return count
+
+    def shutdown(self):
+        """
+        Asks every worker to finish what it is serving and exit, killing the ones that take too long
+        """
+        for pid in list(self.children):
+            self.sendSignal(pid, signal.SIGTERM)
+        deadline = time.time() + self.gracefulTimeout + self.pollInterval
+        while self.children and time.time() < deadline:
+            if not self.reap():
+                time.sleep(0.1)
+        for pid in list(self.children):
+            self.logger.warn("worker %d did not stop in time, killing it", pid)
+            self.sendSignal(pid, signal.SIGKILL)
+        while self.children and self.reap():
+            pass
+
+    def spawn(self, app, listener):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = self.generation
+            return pid
+        # this is the worker
+        code = 1
+        try:
+            self.runWorker(app, listener)
+            code = 0
+        except Exception:
+            self.logger.exception("worker %d failed", os.getpid())
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def runWorker(self, app, listener):
+        """
+        Serves requests until asked to stop or it is time to recycle this worker
+        """
+        self.children = {}
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        # otherwise every worker would sample the same access log records
+        random.seed()
+        if app is None:
+            app = self.loader()
+        else:
+            afterFork(app)
+        if self.reusePort:
+            listener.close()
+            listener = self.bindSocket()
+        # accept() has to fail rather than block when another worker took the connection
+        listener.setblocking(0)
+
+        server = ThreadingWSGIServer(self.address, QuietWSGIRequestHandler, bind_and_activate=False)
+        server.socket.close()
+        server.socket = listener
+        server.server_name, server.server_port = socket.getfqdn(self.address[0]), self.address[1]
+        server.setup_environ()
+        server.set_app(app)
+
+        served = 0
+        while not self.stopping:
+            try:
+                ready = select.select([listener], [], [], self.pollInterval)[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not ready:
+                continue
+            server._handle_request_noblock()
+            served += 1
+            if self.shouldRecycle(served):
+                break
+        # connections the kernel already queued on a socket of our own would be reset when it closes
+        while self.reusePort and select.select([listener], [], [], 0)[0]:
+            server._handle_request_noblock()
+        listener.close()
+        self.finishRequests()
+        for plugin in restwarePlugins(app):
+            plugin.close()
+
+    def shouldRecycle(self, served):
+        if self.maxRequests and served >= self.maxRequests:
+            self.logger.info("worker %d served %d connections, recycling it", os.getpid(), served)
+            return True
+        if self.maxRSS and resource is not None:
+            # ru_maxrss is in kilobytes, except on OS X
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+            if rss > self.maxRSS:
+                self.logger.info("worker %d uses %d bytes of memory, recycling it", os.getpid(), rss)
+                return True
+        return False
+
+    def finishRequests(self):
+        """
+        Waits, up to gracefulTimeout seconds, for the threads still serving requests
+        """
+        deadline = time.time() + self.gracefulTimeout
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread() and not thread.daemon:
+                thread.join(max(deadline - time.time(), 0))
+
+
+def main(argv=None):
+    """
+    The command line entry point: python restware.py run package.module:app
+    """
+    parser = argparse.ArgumentParser(prog="restware", description="Tools for restwared bottle apps")
+    commands = parser.add_subparsers(dest="command")
+    run = commands.add_parser("run", help="serve a bottle (or any WSGI) app from several worker processes")
+    run.add_argument("app", help="the app to serve, as package.module:name; name defaults to app")
+    run.add_argument("--host", default="0.0.0.0", help="the address to listen on (default 0.0.0.0)")
+    run.add_argument("--port", type=int, default=8080, help="the port to listen on (default 8080)")
+    run.add_argument("--workers", type=int, help="how many worker processes to run (default: one per CPU)")
+    run.add_argument("--preload", action="store_true", help="load the app once, before forking the workers")
+    run.add_argument("--max-requests", type=int, help="recycle a worker after this many connections")
+    run.add_argument("--max-rss", type=int, help="recycle a worker once its peak memory passes this many MiB")
+    run.add_argument("--graceful-timeout", type=float, default=30,
+                     help="seconds a stopping worker may spend finishing requests (default 30)")
+    run.add_argument("--api-base-path", default="/api/",
+                     help="the apiBasePath of the RestwarePlugin installed in apps that don't have one (default /api/)")
+    args = parser.parse_args(argv)
+
+    # the app's module is looked for where we are run from, like python -m does
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    server = PreforkServer(lambda: loadApp(args.app, args.api_base_path), args.host, args.port, args.workers,
+                           preload=args.preload, maxRequests=args.max_requests,
+                           maxRSS=args.max_rss * 1024 * 1024 if args.max_rss else None,
+                           gracefulTimeout=args.graceful_timeout)
+    server.serve()
+    return 0
+
+
+if __name__ == "__main__":
+    # go through the importable module, so the app and the runner share one set of restware classes
+    import restware
+    sys.exit(restware.main())
@@ -0,0 +1,1610 @@
+"""
+Tests for restware. Run with: python -m unittest test_restware
+"""
+import StringIO
+import datetime
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib
+import zlib
+
+import bottle
+
+import restware
+
+
+def compressed(data, encoding="gzip"):
+    """
+    Returns data compressed with the given content-encoding
+    """
+    if encoding == "zstd":
+        return restware.zstandard.ZstdCompressor().compress(data)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31 if encoding == "gzip" else zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def chunkedBody(body, chunkSize):
+    """
+    Returns body in chunked transfer encoding, in chunks of chunkSize bytes
+    """
+    chunks = ["%x\r\n%s\r\n" % (len(body[start:start + chunkSize]), body[start:start + chunkSize])
+              for start in xrange(0, len(body), chunkSize)]
+    return "".join(chunks) + "0\r\n\r\n"
+
+
+def quietLogger():
+    logger = logging.getLogger("restware.tests")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    return logger
+
+
+def call(app, method, path, body="", headers=None, responseHeaders=None):
+    """
+    Makes one request of a WSGI app. Returns (status code, response body); the response's headers are put in the
+    responseHeaders dict, if one is given
+    """
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': '', 'SERVER_NAME': 'localhost',
+               'SERVER_PORT': '8080', 'SERVER_PROTOCOL': 'HTTP/1.1', 'CONTENT_LENGTH': str(len(body)),
+               'wsgi.input': StringIO.StringIO(body), 'wsgi.url_scheme': 'http', 'wsgi.errors': StringIO.StringIO(),
+               'wsgi.multithread': False, 'wsgi.multiprocess': False, 'wsgi.run_once': False, 'wsgi.version': (1, 0)}
+    environ.update(headers or {})
+    status = []
+
+    def startResponse(statusLine, headerList, excInfo=None):
+        status.append(int(statusLine.split()[0]))
+        if responseHeaders is not None:
+            responseHeaders.update(headerList)
+
+    result = app(environ, startResponse)
+    try:
+        data = "".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return status[0], data
+
+
+class CompressedFormTest(unittest.TestCase):
+    """
+    Compressed bodies still reach bottle's own parsers (request.forms), with the length they inflate to
+    """
+    def setUp(self):
+        app = bottle.Bottle()
+
+        @app.post('/form')
+        def form():
+            return "%d fields" % len(bottle.request.forms)
+
+        self.app = restware.Restware(app, logger=quietLogger())
+
+    def postForm(self, size):
+        fields = urllib.urlencode([("field%d" % i, "x" * 90) for i in range(size // 100)])
+        return call(self.app, 'POST', '/form', compressed(fields),
+                    {'CONTENT_TYPE': 'application/x-www-form-urlencoded', 'HTTP_CONTENT_ENCODING': 'gzip'})
+
+    def test_form_past_prefetch_size(self):
+        # inflates past the middleware's own prefetchSize but not past bottle's MEMFILE_MAX
+        size = 80 * 1024
+        self.assertTrue(restware.Restware.prefetchSize < size < bottle.BaseRequest.MEMFILE_MAX)
+        self.assertEqual(self.postForm(size), (200, "%d fields" % (size // 100)))
+
+    def test_form_past_memfile_max(self):
+        # bottle refuses to parse it in memory, as it does when it isn't compressed
+        self.assertEqual(self.postForm(bottle.BaseRequest.MEMFILE_MAX + 4096)[0], 413)
+
+
+class TruncatedBodyTest(unittest.TestCase):
+    """
+    A compressed body that stops short of its end is refused as such, rather than passed on cut off
+    """
+    def setUp(self):
+        app = bottle.Bottle()
+
+        @app.post('/api/echo')
+        def echo():
+            return {"received": len(bottle.request.jsonData)}
+
+        app.install(restware.RestwarePlugin(logger=quietLogger()))
+        self.app = restware.Restware(app, logger=quietLogger())
+
+    def test_truncated_gzip_and_deflate(self):
+        document = json.dumps(range(1000))
+        for encoding in ("gzip", "deflate"):
+            body = compressed(document, encoding)
+            headers = {'CONTENT_TYPE': 'application/json', 'HTTP_CONTENT_ENCODING': encoding}
+            self.assertEqual(call(self.app, 'POST', '/api/echo', body, headers), (200, '{"received":1000}'))
+            # only the gzip trailer (checksum and length) or the zlib checksum is missing
+            status, message = call(self.app, 'POST', '/api/echo', body[:-4], headers)
+            self.assertEqual(status, 400)
+            self.assertTrue("truncated data" in message, message)
+
+
+class InflaterEquivalenceTest(unittest.TestCase):
+    """
+    Bodies with a Content-Length, which InflatingInput reads with its own decoders, and chunked ones, whose chunks
+    it feeds to a BodyInflater, inflate to the same bytes, and are refused with the same errors
+    """
+    encodings = ("gzip", "deflate", "zstd")
+    document = json.dumps([{"id": i, "name": "item %d" % i, "tags": ["a", "b"]} for i in range(5000)])
+
+    def pull(self, body, encoding, **limits):
+        """
+        Returns (inflated body, None) or (None, (status, message)) from reading an InflatingInput to the end
+        """
+        try:
+            return restware.InflatingInput(StringIO.StringIO(body), len(body), encoding=encoding, **limits).read(), None
+        except restware.RequestBodyError, e:
+            return None, (e.status_code, e.body)
+
+    def push(self, body, encoding, chunkSize=1000, **limits):
+        """
+        The same, from the body sent in chunks of chunkSize bytes
+        """
+        stream = restware.InflatingInput(StringIO.StringIO(chunkedBody(body, chunkSize)), encoding=encoding,
+                                         chunked=True, **limits)
+        try:
+            return stream.read(), None
+        except restware.RequestBodyError, e:
+            return None, (e.status_code, e.body)
+
+    def assertEquivalent(self, body, encoding, expected=None, status=None, **limits):
+        """
+        Checks that both inflate the body the same way, and to expected (or fail with status), if given
+        """
+        pulled = self.pull(body, encoding, **limits)
+        for chunkSize in (1, 1000, len(body) or 1):
+            # the bodies are too big for assertEqual's diff to be of any use
+            pushed = self.push(body, encoding, chunkSize, **limits)
+            self.assertTrue(pushed == pulled, "%s, fed %d bytes at a time: %s rather than %s" % (
+                encoding, chunkSize, pushed[1] or "%d bytes" % len(pushed[0]), pulled[1] or "%d bytes" % len(pulled[0])))
+        if expected is not None:
+            self.assertTrue(pulled == (expected, None), "%s: %s" % (encoding, pulled[1]))
+        if status is not None:
+            self.assertEqual(pulled[1] and pulled[1][0], status)
+
+    def test_complete(self):
+        for encoding in self.encodings:
+            self.assertEquivalent(compressed(self.document, encoding), encoding, self.document)
+            self.assertEquivalent(compressed("", encoding), encoding, "")
+
+    def test_concatenated(self):
+        # gzip members and zstd frames may follow one another, ending anywhere in a read
+        for encoding in ("gzip", "zstd"):
+            for split in (100, 100000):
+                body = compressed(self.document[:split], encoding) + compressed(self.document[split:], encoding)
+                self.assertEquivalent(body, encoding, self.document)
+
+    def test_trailing_junk(self):
+        for encoding in self.encodings:
+            body = compressed(self.document, encoding)
+            for junk in ("j", "junk" * 5):
+                # whatever follows the end of a deflate stream is dropped as junk
+                self.assertEquivalent(body + junk, encoding, self.document if encoding == "deflate" else None,
+                                      None if encoding == "deflate" else 400)
+
+    def test_truncated(self):
+        for encoding in self.encodings:
+            body = compressed(self.document, encoding)
+            for length in (1, len(body) // 2, len(body) - 4, len(body) - 1):
+                self.assertEquivalent(body[:length], encoding, status=400)
+
+    def test_corrupt(self):
+        for encoding in self.encodings:
+            self.assertEquivalent("this is not compressed at all", encoding, status=400)
+            body = compressed(self.document, encoding)
+            self.assertEquivalent(body[:20] + "\xff" * 20 + body[40:], encoding, status=400)
+
+    def test_bombs(self):
+        zeros = "0" * (4 * 1024 * 1024)
+        for encoding in self.encodings:
+            body = compressed(zeros, encoding)
+            self.assertEquivalent(body, encoding, status=413, maxSize=1024 * 1024)
+            self.assertEquivalent(body, encoding, status=413, maxRatio=100)
+            self.assertEquivalent(body, encoding, zeros, maxSize=len(zeros), maxRatio=100000)
+
+
+class ChunkedUploadTest(unittest.TestCase):
+    """
+    Compressed bodies sent with Transfer-Encoding: chunked reach the app inflated, through the middleware
+    """
+    def setUp(self):
+        app = bottle.Bottle()
+
+        @app.post('/api/echo')
+        def echo():
+            return {"items": bottle.request.jsonData}
+
+        app.install(restware.RestwarePlugin(logger=quietLogger()))
+        self.app = restware.Restware(app, logger=quietLogger(), maxDecompressedSize=1024 * 1024)
+
+    def post(self, body, encoding="gzip"):
+        return call(self.app, 'POST', '/api/echo', body, {'CONTENT_TYPE': 'application/json', 'CONTENT_LENGTH': '',
+                                                           'HTTP_CONTENT_ENCODING': encoding,
+                                                           'HTTP_TRANSFER_ENCODING': 'chunked'})
+
+    def test_inflated(self):
+        items = [{"id": i, "name": "item %d" % i} for i in range(2000)]
+        for encoding in ("gzip", "deflate", "zstd"):
+            for chunkSize in (7, 4096):
+                status, body = self.post(chunkedBody(compressed(json.dumps(items), encoding), chunkSize), encoding)
+                self.assertEqual((status, json.loads(body)), (200, {"items": items}))
+
+    def test_refused(self):
+        document = compressed(json.dumps(range(1000)))
+        self.assertEqual(self.post(chunkedBody(document[:-10], 100))[0], 400)
+        self.assertEqual(self.post(chunkedBody(document, 100)[:-20])[0], 400)
+        self.assertEqual(self.post("zz\r\n" + document)[0], 400)
+        status, body = self.post(chunkedBody(compressed("[" + "0," * (1024 * 1024) + "0]"), 1000))
+        self.assertEqual(status, 413)
+        self.assertTrue("exceeds" in json.loads(body)["message"])
+
+
+class ReadCounter(object):
+    """
+    A file-like body that counts how often it is read
+    """
+    def __init__(self, data):
+        self.source = StringIO.StringIO(data)
+        self.reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        return self.source.read(size)
+
+
+class RoutePolicyTest(unittest.TestCase):
+    """
+    Each route's settings are worked out once, when bottle applies the plugin, from the plugin's defaults and the
+    route's config
+    """
+    def setUp(self):
+        app = bottle.Bottle()
+        self.codec = restware.JSONCodec(["json"])
+
+        @app.get('/api/plain')
+        def plain():
+            return {"ok": True}
+
+        @app.post('/api/tuned', compress=False, max_body_size=10, max_depth=2, codec=self.codec, stream=True,
+                  cache=True, invalidates=['/api/item/<name>'], etag=True)
+        def tuned():
+            return {"ok": True}
+
+        @app.get('/api/item/<name>', cache=5, invalidates=['/api/item/<name>/<version>'])
+        def item(name):
+            return {"name": name}
+
+        @app.get('/')
+        def index():
+            return "<html></html>"
+
+        @app.get('/report', json=True, static=False)
+        def report():
+            return {"ok": True}
+
+        self.plugin = restware.RestwarePlugin(logger=quietLogger(), compressionLevel=4, maxBodySize=1000,
+                                              cacheTTL=30)
+        app.install(self.plugin)
+        self.app = app
+
+    def policy(self, method, rule):
+        # bottle applies plugins to a route the first time it is called
+        call(self.app, method, rule.replace('<name>', 'x'))
+        return self.plugin.policies[(method, rule)]
+
+    def test_defaults(self):
+        policy = self.policy('GET', '/api/plain')
+        self.assertEqual((policy.json, policy.compress, policy.compressLevel, policy.maxBodySize, policy.cacheTTL,
+                          policy.stream, policy.static, policy.etag), (True, True, 4, 1000, None, False, False, False))
+        self.assertTrue(policy.codec is self.plugin.codec)
+
+    def test_route_config(self):
+        policy = self.policy('POST', '/api/tuned')
+        self.assertEqual((policy.compress, policy.maxBodySize, policy.maxDepth, policy.stream, policy.cacheTTL,
+                          policy.etag), (False, 10, 2, True, 30, True))
+        self.assertTrue(policy.codec is self.codec)
+        self.assertEqual(policy.invalidates, [('/api/item/<name>', [])])
+        policy = self.policy('GET', '/api/item/<name>')
+        self.assertEqual((policy.cacheTTL, policy.invalidates), (5, [('/api/item/<name>/<version>', ['name'])]))
+
+    def test_outside_the_api(self):
+        policy = self.policy('GET', '/')
+        self.assertEqual((policy.json, policy.static, policy.projection, policy.schema), (False, True, False, None))
+        policy = self.policy('GET', '/report')
+        self.assertEqual((policy.json, policy.static), (True, False))
+
+    def test_compiled_once(self):
+        compiled = []
+        compilePolicy = self.plugin.compilePolicy
+        self.plugin.compilePolicy = lambda route: compiled.append(route.rule) or compilePolicy(route)
+        for i in range(3):
+            call(self.app, 'GET', '/api/plain')
+        self.assertEqual(compiled, ['/api/plain'])
+        self.assertEqual(self.plugin.policyFor(self.app.routes[0]).rule, '/api/plain')
+
+
+class MetricsTest(unittest.TestCase):
+    """
+    The phases of each request are timed into histograms, served in the Prometheus text format, and sent to the
+    client in Server-Timing when asked to
+    """
+    def test_histogram_buckets(self):
+        metrics = restware.Metrics(buckets=(0.01, 0.1))
+        for seconds in (0.005, 0.05, 0.5, 0.01):
+            metrics.observe("/r", 200, [("handler", seconds)], (100, 40))
+        text = metrics.render()
+        for line in ('restware_phase_seconds_bucket{rule="/r",status="200",phase="handler",le="0.01"} 2',
+                     'restware_phase_seconds_bucket{rule="/r",status="200",phase="handler",le="0.1"} 3',
+                     'restware_phase_seconds_bucket{rule="/r",status="200",phase="handler",le="+Inf"} 4',
+                     'restware_phase_seconds_count{rule="/r",status="200",phase="handler"} 4',
+                     'restware_response_bytes_total{rule="/r",status="200",stage="uncompressed"} 400',
+                     'restware_response_bytes_total{rule="/r",status="200",stage="sent"} 160'):
+            self.assertTrue(line in text.splitlines(), line)
+
+    def test_label_escaping(self):
+        metrics = restware.Metrics()
+        metrics.observe('/a"b\\c', 200, [("total", 0.1)])
+        self.assertTrue('rule="/a\\"b\\\\c"' in metrics.render())
+
+    def makeApp(self, **kwargs):
+        app = bottle.Bottle()
+
+        @app.get('/api/items')
+        def items():
+            return {"items": range(1000)}
+
+        @app.get('/api/missing')
+        def missing():
+            raise bottle.HTTPError(404, "No such thing")
+
+        plugin = restware.RestwarePlugin(logger=quietLogger(), **kwargs)
+        app.install(plugin)
+        return app, plugin
+
+    def test_server_timing(self):
+        app, plugin = self.makeApp(serverTiming=True)
+        responseHeaders = {}
+        call(app, 'GET', '/api/items', headers={'HTTP_ACCEPT_ENCODING': 'gzip'}, responseHeaders=responseHeaders)
+        phases = [entry.split(";")[0] for entry in responseHeaders['Server-Timing'].split(", ")]
+        self.assertEqual(phases, ["handler", "encode", "compress", "total"])
+        self.assertTrue(plugin.metrics is None)
+
+    def test_metrics_endpoint(self):
+        app, plugin = self.makeApp(metrics=True, metricsPath='/metrics')
+        call(app, 'GET', '/api/items', headers={'HTTP_ACCEPT_ENCODING': 'gzip'})
+        call(app, 'GET', '/api/missing')
+        responseHeaders = {}
+        status, text = call(app, 'GET', '/metrics', responseHeaders=responseHeaders)
+        self.assertEqual(status, 200)
+        self.assertTrue(responseHeaders['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertTrue('restware_phase_seconds_count{rule="/api/items",status="200",phase="compress"} 1' in text)
+        self.assertTrue('restware_phase_seconds_count{rule="/api/missing",status="404",phase="total"} 1' in text)
+        sizes = dict((line.split("stage=")[1].split('"')[1], int(line.split()[-1])) for line in text.splitlines()
+                     if line.startswith('restware_response_bytes_total{rule="/api/items"'))
+        self.assertEqual(sizes["uncompressed"], len(plugin.codec.dumps({"items": range(1000)})))
+        self.assertTrue(0 < sizes["sent"] < sizes["uncompressed"])
+
+    def test_threads(self):
+        metrics = restware.Metrics()
+
+        def work():
+            for i in range(1000):
+                metrics.observe("/r", 200, [("total", 0.001)], (10, 5))
+
+        threads = [threading.Thread(target=work) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sum(metrics.histograms[("/r", 200, "total")][0]), 8000)
+        self.assertEqual(metrics.bytes[("/r", 200, "sent")], 40000)
+
+
+class ListHandler(logging.Handler):
+    """
+    Keeps the records it handles, and their messages with the name of the thread that handled them
+    """
+    def __init__(self, gate=None):
+        logging.Handler.__init__(self)
+        self.handled = []
+        self.records = []
+        self.gate = gate
+
+    def emit(self, record):
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.handled.append(record)
+        self.records.append((threading.current_thread().name, self.format(record)))
+
+
+class LoggingTest(unittest.TestCase):
+    """
+    Log records are written out by a background thread, never blocking the request thread, and the access log is
+    structured and sampled
+    """
+    def test_background_thread(self):
+        target = ListHandler()
+        handler = restware.BackgroundLogHandler(target)
+        logger = logging.Logger("restware.tests.background")
+        logger.addHandler(handler)
+        for i in range(100):
+            logger.warning("record %d", i)
+        handler.close()
+        self.assertEqual([message for name, message in target.records], ["record %d" % i for i in range(100)])
+        self.assertEqual(set(name for name, message in target.records), set(["restware-logger"]))
+
+    def test_full_queue_drops(self):
+        gate = threading.Event()
+        target = ListHandler(gate)
+        handler = restware.BackgroundLogHandler(target, maxQueue=2)
+        logger = logging.Logger("restware.tests.dropping")
+        logger.addHandler(handler)
+        for i in range(10):
+            logger.warning("record %d", i)
+        # one record is with the blocked target, two wait in the queue, and the logging thread didn't wait
+        self.assertTrue(7 <= handler.dropped <= 8, handler.dropped)
+        gate.set()
+        handler.close()
+        self.assertEqual(len(target.records), 10 - handler.dropped)
+
+    def test_default_logger_once(self):
+        first = restware.defaultLogger("restware.tests.default", "%(message)s")
+        second = restware.defaultLogger("restware.tests.default", "%(message)s", logging.DEBUG)
+        self.assertTrue(first is second)
+        self.assertEqual(len(first.handlers), 1)
+        self.assertEqual(first.level, logging.DEBUG)
+
+    def makeApp(self, sampleRate):
+        accessLogger = logging.Logger("restware.tests.access", logging.INFO)
+        self.access = ListHandler()
+        accessLogger.addHandler(self.access)
+        app = bottle.Bottle()
+
+        @app.get('/api/ok')
+        def ok():
+            return {"ok": True}
+
+        @app.get('/api/broken')
+        def broken():
+            raise bottle.HTTPError(503, "Down")
+
+        app.install(restware.RestwarePlugin(logger=quietLogger(), accessLogger=accessLogger,
+                                            accessLogSampleRate=sampleRate))
+        return app, accessLogger
+
+    def test_access_log_fields(self):
+        app, accessLogger = self.makeApp(1.0)
+        call(app, 'GET', '/api/ok', headers={'QUERY_STRING': 'a=1'})
+        self.assertEqual(len(self.access.handled), 1)
+        record = self.access.handled[0]
+        self.assertEqual((record.method, record.path, record.query, record.status, record.json),
+                         ('GET', '/api/ok', 'a=1', 200, True))
+        self.assertEqual(record.size, len('{"ok":true}'))
+
+    def test_sampling_keeps_server_errors(self):
+        app, accessLogger = self.makeApp(0.0)
+        for path in ('/api/ok', '/api/broken', '/api/ok'):
+            call(app, 'GET', path)
+        self.assertEqual(len(self.access.records), 1)
+        self.assertTrue("503" in self.access.records[0][1], self.access.records)
+        accessLogger.setLevel(logging.WARNING)
+        call(app, 'GET', '/api/broken')
+        self.assertEqual(len(self.access.records), 1)
+
+
+class ResponseCacheTest(unittest.TestCase):
+    """
+    Cached responses are replayed until they expire or a write invalidates them, and the cache never holds more
+    than its budget, however many threads use it
+    """
+    def entry(self, size, ttl=60):
+        return restware.CachedResponse("200 OK", [], "x" * size, time.time() + ttl)
+
+    def test_least_recently_used_evicted(self):
+        cache = restware.ResponseCache(100)
+        for name in ("a", "b"):
+            cache.put(("/r", frozenset([("name", name)])), self.entry(40))
+        self.assertTrue(cache.get(("/r", frozenset([("name", "a")]))) is not None)
+        cache.put(("/r", frozenset([("name", "c")])), self.entry(40))
+        self.assertTrue(cache.get(("/r", frozenset([("name", "b")]))) is None)
+        self.assertTrue(cache.get(("/r", frozenset([("name", "a")]))) is not None)
+        self.assertEqual((cache.size, cache.evictions), (80, 1))
+        # too big to ever fit
+        cache.put(("/r", frozenset()), self.entry(101))
+        self.assertEqual(len(cache.entries), 2)
+
+    def test_expired(self):
+        cache = restware.ResponseCache(100)
+        cache.put(("/r", frozenset()), self.entry(10, ttl=-1))
+        self.assertTrue(cache.get(("/r", frozenset())) is None)
+        self.assertEqual((cache.size, cache.misses), (0, 1))
+
+    def test_invalidate(self):
+        cache = restware.ResponseCache(1000)
+        for rule in ("/a/<name>", "/b/<name>"):
+            for name in ("x", "y"):
+                cache.put((rule, frozenset([("name", name)])), self.entry(10))
+        cache.invalidate("/a/<name>", name="x")
+        self.assertEqual(sorted(key[0] for key in cache.entries), ["/a/<name>", "/b/<name>", "/b/<name>"])
+        cache.invalidate("/b/<name>")
+        self.assertEqual(len(cache.entries), 1)
+        cache.invalidate()
+        self.assertEqual((len(cache.entries), cache.size), (0, 0))
+
+    def test_threads(self):
+        cache = restware.ResponseCache(1000)
+
+        def work(seed):
+            for i in range(2000):
+                key = ("/r", frozenset([("id", (seed * i) % 50)]))
+                if i % 7 == 0:
+                    cache.invalidate("/r", id=(seed * i) % 50)
+                elif cache.get(key) is None:
+                    cache.put(key, self.entry(10 + i % 40))
+
+        threads = [threading.Thread(target=work, args=(seed,)) for seed in range(1, 9)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache.size, sum(entry.size for entry in cache.entries.values()))
+        self.assertTrue(cache.size <= 1000)
+
+    def makeApp(self, ttl):
+        app = bottle.Bottle()
+        self.calls = []
+
+        @app.get('/api/key/<name>', cache=ttl)
+        def getKey(name):
+            self.calls.append(name)
+            return {"name": name, "value": "v" * 1000}
+
+        @app.get('/api/session/<name>', cache=ttl)
+        def getSession(name):
+            self.calls.append(name)
+            bottle.response.set_cookie("session", name)
+            return {"name": name}
+
+        @app.put('/api/key/<name>', invalidates=['/api/key/<name>'])
+        def putKey(name):
+            return {"stored": name}
+
+        app.install(restware.RestwarePlugin(logger=quietLogger()))
+        return app
+
+    def test_route_cache(self):
+        app = self.makeApp(60)
+        bodies = [call(app, 'GET', '/api/key/a', headers=headers)
+                  for headers in ({}, {}, {'HTTP_ACCEPT_ENCODING': 'gzip'}, {'QUERY_STRING': 'pretty=true'}, {})]
+        self.assertEqual(self.calls, ["a", "a", "a"])
+        self.assertEqual(bodies[0], bodies[1])
+        self.assertEqual(bodies[0], bodies[4])
+        self.assertEqual(json.loads(zlib.decompress(bodies[2][1], 16 + zlib.MAX_WBITS)), json.loads(bodies[0][1]))
+        # a successful write drops the responses of the same key, and only those
+        call(app, 'GET', '/api/key/b')
+        call(app, 'PUT', '/api/key/a')
+        call(app, 'GET', '/api/key/a')
+        call(app, 'GET', '/api/key/b')
+        self.assertEqual(self.calls, ["a", "a", "a", "b", "a"])
+
+    def test_cookies_not_cached(self):
+        app = self.makeApp(60)
+        call(app, 'GET', '/api/session/a')
+        call(app, 'GET', '/api/session/a')
+        self.assertEqual(self.calls, ["a", "a"])
+
+    def test_route_cache_expires(self):
+        app = self.makeApp(0.05)
+        call(app, 'GET', '/api/key/a')
+        call(app, 'GET', '/api/key/a')
+        time.sleep(0.1)
+        call(app, 'GET', '/api/key/a')
+        self.assertEqual(self.calls, ["a", "a"])
+
+
+class JSONBodyTest(unittest.TestCase):
+    """
+    request.jsonData decodes the body the first time it's read, under the route's limits and in the body's charset,
+    and lets the result go once the response is ready
+    """
+    def setUp(self):
+        app = bottle.Bottle()
+        self.bodies = []
+
+        @app.post('/api/echo')
+        def echo():
+            self.bodies.append(bottle.request.get("bottle.request.ext.jsonData"))
+            return {"received": bottle.request.jsonData}
+
+        @app.post('/api/ignore')
+        def ignore():
+            return {"ignored": True}
+
+        @app.post('/api/retry')
+        def retry():
+            errors = []
+            for i in range(2):
+                try:
+                    bottle.request.jsonData
+                except restware.RequestBodyError, e:
+                    errors.append(e)
+            return {"same": errors[0] is errors[1]}
+
+        @app.post('/api/small', max_body_size=10, max_depth=2)
+        def small():
+            return {"received": bottle.request.jsonData}
+
+        app.install(restware.RestwarePlugin(logger=quietLogger()))
+        self.app = app
+
+    def post(self, path, body, contentType='application/json', **headers):
+        headers['CONTENT_TYPE'] = contentType
+        status, body = call(self.app, 'POST', path, body, headers)
+        return status, json.loads(body)
+
+    def test_decoded_when_read(self):
+        self.assertEqual(self.post('/api/echo', '{"a": [1, 2]}'), (200, {"received": {"a": [1, 2]}}))
+        self.assertEqual(self.post('/api/echo', ''), (200, {"received": None}))
+        self.assertEqual(self.post('/api/ignore', 'not json'), (200, {"ignored": True}))
+        self.assertEqual(self.post('/api/retry', 'not json'), (200, {"same": True}))
+
+    def test_released_with_the_response(self):
+        self.post('/api/echo', '{"a": [1, 2]}')
+        self.assertTrue(isinstance(self.bodies[0], restware.LazyJSONBody))
+        self.assertEqual((self.bodies[0].decoded, self.bodies[0].value), (False, None))
+
+    def test_limits(self):
+        self.assertEqual(self.post('/api/small', '[1, 2, 3]'), (200, {"received": [1, 2, 3]}))
+        status, body = self.post('/api/small', '[1, 2, 3, 4, 5]')
+        self.assertEqual((status, body["message"]), (413, "Request body exceeds 10 bytes"))
+        # the declared length can't be trusted while the middleware inflates the body
+        status, body = call(restware.Restware(self.app), 'POST', '/api/small', compressed('[1, 2, 3, 4, 5]'),
+                            {'CONTENT_TYPE': 'application/json', 'HTTP_CONTENT_ENCODING': 'gzip'})
+        self.assertEqual(status, 413)
+        status, body = self.post('/api/small', '[[[1]]]')
+        self.assertEqual((status, body["message"]), (400, "Request body nests arrays and objects deeper than 2 levels"))
+
+    def test_charsets(self):
+        text = u'{"name": "caf\xe9"}'
+        for charset in ("latin-1", "utf-16"):
+            self.assertEqual(self.post('/api/echo', text.encode(charset), 'application/json; charset=%s' % charset),
+                             (200, {"received": {"name": u"caf\xe9"}}))
+        status, body = self.post('/api/echo', text.encode("utf-8"), 'application/json; charset=klingon')
+        self.assertEqual((status, body["message"]), (415, "Unsupported charset: klingon"))
+        status, body = self.post('/api/echo', "\xff\xfe{", 'application/json; charset=utf-16')
+        self.assertEqual(status, 400)
+        status, body = self.post('/api/echo', "\xff{}")
+        self.assertEqual(status, 400)
+
+
+class AdmissionTest(unittest.TestCase):
+    """
+    Requests beyond the concurrency limit wait in a bounded queue for a bounded time, and are shed with a 503
+    otherwise
+    """
+    def test_queue_then_shed(self):
+        limit = restware.AdmissionLimit(1, maxQueue=1, maxWait=5)
+        self.assertTrue(limit.acquire())
+        outcome = []
+        waiter = threading.Thread(target=lambda: outcome.append(limit.acquire()))
+        waiter.start()
+        while limit.stats()["waiting"] == 0:
+            time.sleep(0.001)
+        # the queue is full
+        self.assertFalse(limit.acquire())
+        limit.release()
+        waiter.join()
+        self.assertEqual(outcome, [True])
+        limit.release()
+        self.assertEqual(limit.stats(), {"admitted": 2, "queued": 1, "shed": 1, "active": 0, "waiting": 0})
+
+    def test_wait_expires(self):
+        limit = restware.AdmissionLimit(1, maxQueue=5, maxWait=0.05)
+        self.assertTrue(limit.acquire())
+        self.assertFalse(limit.acquire())
+        self.assertEqual(limit.stats()["expired"], 1)
+
+    def test_threads_never_exceed_concurrency(self):
+        limit = restware.AdmissionLimit(3, maxQueue=100, maxWait=10)
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def work():
+            self.assertTrue(limit.acquire())
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.005)
+            with lock:
+                running[0] -= 1
+            limit.release()
+
+        threads = [threading.Thread(target=work) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(running[1] <= 3, running[1])
+        self.assertEqual(limit.stats()["admitted"], 20)
+
+    def makeApp(self, **kwargs):
+        self.entered, self.finish = threading.Event(), threading.Event()
+
+        def app(environ, start_response):
+            if environ['PATH_INFO'].endswith('/slow'):
+                self.entered.set()
+                self.finish.wait(5)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ['ok']
+        return restware.Restware(app, logger=quietLogger(), **kwargs)
+
+    def hold(self, wsgi, path):
+        """
+        Starts a request for path on another thread, returning once the app is handling it
+        """
+        self.entered.clear()
+        thread = threading.Thread(target=call, args=(wsgi, 'GET', path))
+        thread.start()
+        self.entered.wait(5)
+        return thread
+
+    def test_shed_with_retry_after(self):
+        wsgi = self.makeApp(maxConcurrency=1, retryAfter=3)
+        thread = self.hold(wsgi, '/api/slow')
+        responseHeaders = {}
+        status, body = call(wsgi, 'GET', '/api/fast', responseHeaders=responseHeaders)
+        self.assertEqual((status, json.loads(body)), (503, {"message": "Server is overloaded, try again later"}))
+        self.assertEqual(responseHeaders['Retry-After'], '3')
+        self.finish.set()
+        thread.join()
+        # the slot is given back when the response is closed
+        self.assertEqual(call(wsgi, 'GET', '/api/fast'), (200, 'ok'))
+        self.assertEqual(wsgi.admissionStats()["*"]["active"], 0)
+
+    def test_prefix_limits(self):
+        wsgi = self.makeApp(prefixLimits={"/api/reports/": 1, "/api/": 10})
+        thread = self.hold(wsgi, '/api/reports/slow')
+        self.assertEqual(call(wsgi, 'GET', '/api/reports/fast')[0], 503)
+        self.assertEqual(call(wsgi, 'GET', '/api/other'), (200, 'ok'))
+        self.finish.set()
+        thread.join()
+        self.assertEqual(wsgi.admissionStats()["/api/reports/"]["shed"], 1)
+        self.assertEqual(wsgi.admissionStats()["/api/"]["admitted"], 1)
+
+
+class ShapingTest(unittest.TestCase):
+    """
+    Clients can trim responses to the fields they want with ?fields= and page through lists with ?limit= and
+    ?cursor=, on routes that allow it
+    """
+    records = [{"id": i, "name": "item %d" % i, "owner": {"email": "%d@example.com" % i, "phone": "555"}}
+               for i in range(25)]
+
+    def setUp(self):
+        app = bottle.Bottle()
+
+        @app.get('/api/items', projection=True, page_size=10)
+        def items():
+            return self.records
+
+        @app.get('/api/generated', page_size=10)
+        def generated():
+            return iter(self.records)
+
+        @app.get('/api/own', projection=True, page_size=10)
+        def own():
+            page = bottle.request.page
+            page.applied = True
+            page.next = "later"
+            bottle.request.projection.applied = True
+            return [{"limit": page.limit, "cursor": page.cursor, "fields": bottle.request.projection.fields}]
+
+        @app.get('/api/plain')
+        def plain():
+            return self.records[:2]
+
+        app.install(restware.RestwarePlugin(logger=quietLogger(), maxPageSize=20))
+        self.app = app
+
+    def get(self, path, query=''):
+        responseHeaders = {}
+        status, body = call(self.app, 'GET', path, headers={'QUERY_STRING': query}, responseHeaders=responseHeaders)
+        return status, json.loads(body), responseHeaders.get('Link')
+
+    def test_projection_tree(self):
+        projection = restware.FieldProjection(["id", "owner.email", "owner", "tags.name"])
+        self.assertEqual(projection.tree, {"id": None, "owner": None, "tags": {"name": None}})
+        self.assertTrue(projection.includes("owner.phone"))
+        self.assertFalse(projection.includes("name"))
+        self.assertEqual(restware.FieldProjection(["a.b"]).apply([{"a": {"b": 1, "c": 2}}, {"d": 3}, 4]),
+                         [{"a": {"b": 1}}, {}, 4])
+
+    def test_fields(self):
+        status, body, link = self.get('/api/items', 'fields=id,owner.email&limit=2')
+        self.assertEqual(body, [{"id": 0, "owner": {"email": "0@example.com"}},
+                                {"id": 1, "owner": {"email": "1@example.com"}}])
+        # routes that don't allow it ignore the parameter
+        self.assertEqual(self.get('/api/plain', 'fields=id&limit=1')[1], self.records[:2])
+
+    def test_pages(self):
+        for path in ('/api/items', '/api/generated'):
+            seen, query = [], ''
+            while True:
+                status, body, link = self.get(path, query)
+                seen.extend(body)
+                if link is None:
+                    break
+                query = link[link.index("?") + 1:link.index(">")]
+            self.assertEqual(seen, self.records)
+            self.assertEqual(len(self.get(path)[1]), 10)
+
+    def test_limits(self):
+        self.assertEqual(len(self.get('/api/items', 'limit=100')[1]), 20)
+        self.assertEqual(self.get('/api/items', 'limit=0')[0], 400)
+        self.assertEqual(self.get('/api/items', 'limit=x')[0], 400)
+        status, body, link = self.get('/api/items', 'cursor=bogus')
+        self.assertEqual((status, body["message"]), (400, "Invalid cursor: bogus"))
+
+    def test_handler_applies_them(self):
+        status, body, link = self.get('/api/own', 'fields=id&limit=3&cursor=abc')
+        self.assertEqual(body, [{"limit": 3, "cursor": "abc", "fields": ["id"]}])
+        self.assertTrue("cursor=later" in link, link)
+
+
+class CoalescingTest(unittest.TestCase):
+    """
+    Identical concurrent GETs share one run of the handler, when its response can be replayed to all of them
+    """
+    def test_followers_share_the_outcome(self):
+        flights = restware.SingleFlight(timeout=5)
+        flight, leader = flights.join("key")
+        self.assertTrue(leader)
+        outcomes = []
+        followers = [threading.Thread(target=lambda joined: outcomes.append(flights.wait(joined[0])),
+                                      args=(flights.join("key"),)) for i in range(5)]
+        for thread in followers:
+            thread.start()
+        flights.land("key", flight, ("replay", "outcome"))
+        for thread in followers:
+            thread.join()
+        self.assertEqual(outcomes, [("replay", "outcome")] * 5)
+        self.assertEqual(flights.stats(), {"leaders": 1, "coalesced": 5, "inFlight": 0})
+        # the next one leads a flight of its own
+        self.assertTrue(flights.join("key")[1])
+
+    def test_unshared_and_expired(self):
+        flights = restware.SingleFlight(timeout=0.05)
+        flight, leader = flights.join("key")
+        self.assertEqual(flights.wait(flights.join("key")[0]), None)
+        flights.land("key", flight, None)
+        self.assertEqual(flights.wait(flight), None)
+        self.assertEqual((flights.stats()["expired"], flights.stats()["unshared"]), (1, 1))
+
+    def makeApp(self):
+        app = bottle.Bottle()
+        self.runs = []
+        self.entered, self.finish = threading.Event(), threading.Event()
+
+        @app.get('/api/item/<name>', coalesce=True)
+        def item(name):
+            self.runs.append(name)
+            self.entered.set()
+            self.finish.wait(5)
+            if name == "missing":
+                raise bottle.HTTPError(404, "No such item")
+            if name == "cookie":
+                bottle.response.set_cookie("seen", "yes")
+            return {"name": name, "query": bottle.request.query_string}
+
+        self.plugin = restware.RestwarePlugin(logger=quietLogger())
+        app.install(self.plugin)
+        # count the followers as they start waiting for the leader
+        self.waiting = []
+        wait = self.plugin.singleFlight.wait
+        self.plugin.singleFlight.wait = lambda flight: self.waiting.append(flight) or wait(flight)
+        return app
+
+    def concurrently(self, app, name, queries):
+        """
+        Requests /api/item/<name> with each query at once, the first one leading. Returns each (status, body)
+        """
+        results = {}
+
+        def get(query):
+            results[query] = call(app, 'GET', '/api/item/' + name, headers={'QUERY_STRING': query})
+
+        self.entered.clear()
+        self.finish.clear()
+        del self.waiting[:]
+        leader = threading.Thread(target=get, args=(queries[0],))
+        leader.start()
+        self.entered.wait(5)
+        others = [threading.Thread(target=get, args=(query,)) for query in queries[1:]]
+        for thread in others:
+            thread.start()
+        expected = len([query for query in queries[1:] if query == queries[0]])
+        while len(self.waiting) < expected:
+            time.sleep(0.001)
+        self.finish.set()
+        for thread in [leader] + others:
+            thread.join()
+        return [results[query] for query in queries]
+
+    def test_one_handler_run(self):
+        app = self.makeApp()
+        results = self.concurrently(app, "a", ["x=1"] * 4)
+        self.assertEqual([(status, json.loads(body)) for status, body in results],
+                         [(200, {"name": "a", "query": "x=1"})] * 4)
+        self.assertEqual(self.runs, ["a"])
+        self.assertEqual(self.plugin.coalesceStats()["coalesced"], 3)
+
+    def test_different_requests_not_coalesced(self):
+        app = self.makeApp()
+        results = self.concurrently(app, "a", ["x=1", "x=2"])
+        self.assertEqual(json.loads(results[1][1]), {"name": "a", "query": "x=2"})
+        self.assertEqual(self.runs, ["a", "a"])
+
+    def test_errors_shared(self):
+        app = self.makeApp()
+        results = self.concurrently(app, "missing", ["", ""])
+        self.assertEqual([status for status, body in results], [404, 404])
+        self.assertEqual(self.runs, ["missing"])
+
+    def test_cookies_not_shared(self):
+        app = self.makeApp()
+        self.concurrently(app, "cookie", ["", "", ""])
+        self.assertEqual(self.runs, ["cookie"] * 3)
+        self.assertEqual(self.plugin.coalesceStats()["unshared"], 2)
+
+
+class StreamedResponseTest(unittest.TestCase):
+    """
+    Generators (and lists on stream=True routes) go out as a JSON array encoded and compressed a batch at a time,
+    with exactly the text a list would have been encoded to in one go
+    """
+    def setUp(self):
+        app = bottle.Bottle()
+        self.closed = []
+
+        @app.get('/api/items/<count:int>')
+        def items(count):
+            try:
+                for i in xrange(count):
+                    yield {"id": i, "name": "item %d" % i, "tags": ["a", "b"]}
+            finally:
+                self.closed.append(count)
+
+        @app.get('/api/list/<count:int>', stream=True)
+        def itemList(count):
+            return [{"id": i} for i in xrange(count)]
+
+        self.plugin = restware.RestwarePlugin(logger=quietLogger())
+        app.install(self.plugin)
+        self.app = app
+
+    def get(self, path, query='', encoding='gzip'):
+        responseHeaders = {}
+        status, body = call(self.app, 'GET', path, headers={'QUERY_STRING': query, 'HTTP_ACCEPT_ENCODING': encoding},
+                            responseHeaders=responseHeaders)
+        if responseHeaders.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return status, body, responseHeaders
+
+    def test_same_text_as_a_list(self):
+        batch = restware.JSONArrayStream.batchSize
+        for count in (0, 1, batch, batch + 1, 3 * batch):
+            expected = [{"id": i, "name": "item %d" % i, "tags": ["a", "b"]} for i in range(count)]
+            for query, pretty in (('', False), ('pretty=true', True)):
+                status, body, responseHeaders = self.get('/api/items/%d' % count, query)
+                self.assertEqual(responseHeaders['Content-Encoding'], 'gzip')
+                self.assertFalse('Content-Length' in responseHeaders)
+                self.assertTrue(body == self.plugin.codec.dumps(expected, pretty), (count, query))
+
+    def test_stream_route_option(self):
+        status, body, responseHeaders = self.get('/api/list/1000', encoding='')
+        self.assertFalse('Content-Length' in responseHeaders)
+        self.assertEqual(json.loads(body), [{"id": i} for i in range(1000)])
+
+    def test_compressed_a_chunk_at_a_time(self):
+        items = ({"id": i, "text": "item %d" % i} for i in xrange(20000))
+        stream = restware.JSONArrayStream(items, encoding="gzip")
+        pieces = list(stream)
+        self.assertTrue(len(pieces) > 2, len(pieces))
+        self.assertEqual(json.loads(zlib.decompress("".join(pieces), 16 + zlib.MAX_WBITS)),
+                         [{"id": i, "text": "item %d" % i} for i in range(20000)])
+
+    def test_generator_closed(self):
+        # the client goes away after the first chunk: the handler's generator is closed all the same
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/api/items/100000', 'QUERY_STRING': '',
+                   'SERVER_NAME': 'localhost', 'SERVER_PORT': '8080', 'SERVER_PROTOCOL': 'HTTP/1.1',
+                   'wsgi.input': StringIO.StringIO(''), 'wsgi.url_scheme': 'http', 'wsgi.errors': StringIO.StringIO()}
+        result = self.app(environ, lambda status, headers, excInfo=None: None)
+        next(iter(result))
+        result.close()
+        self.assertEqual(self.closed, [100000])
+
+    def test_error_mid_stream_truncates(self):
+        def failing():
+            yield 1
+            raise ValueError("gone")
+        stream = restware.JSONArrayStream(failing(), logger=quietLogger())
+        self.assertRaises(ValueError, list, stream)
+
+
+class RecordFormatTest(unittest.TestCase):
+    """
+    Lists and generators go out as NDJSON or JSON text sequences to clients that ask for them in Accept, and as a
+    JSON array to everyone else
+    """
+    def setUp(self):
+        app = bottle.Bottle()
+
+        @app.get('/api/items')
+        def items():
+            return [{"id": i, "name": u"caf\xe9 %d" % i} for i in range(300)]
+
+        @app.get('/api/generated')
+        def generated():
+            return ({"id": i} for i in xrange(3))
+
+        @app.get('/api/one')
+        def one():
+            return {"id": 1}
+
+        app.install(restware.RestwarePlugin(logger=quietLogger()))
+        self.app = app
+
+    def get(self, path, accept, encoding=''):
+        responseHeaders = {}
+        status, body = call(self.app, 'GET', path, headers={'HTTP_ACCEPT': accept, 'HTTP_ACCEPT_ENCODING': encoding},
+                            responseHeaders=responseHeaders)
+        if responseHeaders.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return body, responseHeaders
+
+    def test_negotiation(self):
+        negotiate = restware.negotiateRecordFormat
+        self.assertEqual(negotiate(""), None)
+        self.assertEqual(negotiate("application/x-ndjson"), "application/x-ndjson")
+        self.assertEqual(negotiate("application/json-seq, application/json;q=0.5"), "application/json-seq")
+        self.assertEqual(negotiate("application/json, application/x-ndjson;q=0.5"), None)
+        self.assertEqual(negotiate("application/x-ndjson;q=0.2, application/json-seq;q=0.8"), "application/json-seq")
+        self.assertEqual(negotiate("*/*"), None)
+        self.assertEqual(negotiate("application/x-ndjson;q=0"), None)
+
+    def test_ndjson(self):
+        body, responseHeaders = self.get('/api/items', 'application/x-ndjson', 'gzip')
+        self.assertEqual(responseHeaders['Content-Type'], 'application/x-ndjson')
+        self.assertTrue('Accept' in responseHeaders['Vary'])
+        lines = body.split("\n")
+        self.assertEqual(lines[-1], "")
+        self.assertEqual([json.loads(line) for line in lines[:-1]],
+                         [{"id": i, "name": u"caf\xe9 %d" % i} for i in range(300)])
+
+    def test_json_seq(self):
+        body, responseHeaders = self.get('/api/generated', 'application/json-seq')
+        self.assertEqual(responseHeaders['Content-Type'], 'application/json-seq')
+        self.assertEqual(body, '\x1e{"id":0}\n\x1e{"id":1}\n\x1e{"id":2}\n')
+
+    def test_json_otherwise(self):
+        body, responseHeaders = self.get('/api/generated', 'application/json')
+        self.assertEqual((body, responseHeaders['Content-Type']), ('[{"id":0},{"id":1},{"id":2}]', 'application/json'))
+        # a dict is a single document, whatever the client asks for
+        body, responseHeaders = self.get('/api/one', 'application/x-ndjson')
+        self.assertEqual((body, responseHeaders['Content-Type']), ('{"id":1}', 'application/json'))
+
+
+class JSONItemReaderTest(unittest.TestCase):
+    """
+    Streamed request bodies decode to the same items however the body is split into chunks, and a large item is
+    read in a few growing chunks rather than many small ones
+    """
+    items = [{"text": 'a, "quoted" [string] {with} \\ escapes', "nested": [[1, 2], {"x": [3]}]}, -12.5e3, "}",
+             [], {}, None, True, 1234567890, u"caf\xe9"]
+
+    def reader(self, body, separator=None, readSize=7, **limits):
+        plugin = restware.RestwarePlugin(logger=quietLogger())
+        reader = restware.JSONItemReader(plugin, plugin.compilePolicy(None), ReadCounter(body), len(body),
+                                         separator)
+        reader.readSize = reader.readAhead = readSize
+        for name, value in limits.items():
+            setattr(reader, name, value)
+        return reader
+
+    def error(self, reader):
+        try:
+            list(reader)
+        except restware.RequestBodyError, e:
+            return e.status_code, e.body
+        self.fail("no RequestBodyError")
+
+    def test_split_items(self):
+        body = json.dumps(self.items, indent=1)
+        for readSize in range(1, 12):
+            self.assertEqual(list(self.reader(body, readSize=readSize)), self.items)
+
+    def test_records(self):
+        for separator, prefix in (("\n", ""), ("\x1e", "\x1e")):
+            body = "".join(prefix + json.dumps(item) + "\n" for item in self.items)
+            for readSize in (1, 5, 64):
+                self.assertEqual(list(self.reader(body, separator, readSize)), self.items)
+
+    def test_large_item_read_in_growing_chunks(self):
+        item = {"values": range(100000), "text": "x" * 100000}
+        for separator, body in ((None, json.dumps([item, 1])), ("\n", json.dumps(item) + "\n1\n")):
+            reader = self.reader(body, separator, readSize=1024, maxItemSize=None)
+            self.assertEqual(list(reader), [item, 1])
+            self.assertTrue(reader.source.reads < 15, reader.source.reads)
+
+    def test_over_limit(self):
+        body = json.dumps([1, "x" * 100, 2])
+        self.assertEqual(self.error(self.reader(body, maxItemSize=50)), (413, "Request body item 1 exceeds 50 bytes"))
+        body = "1\n" + json.dumps("x" * 100) + "\n"
+        self.assertEqual(self.error(self.reader(body, "\n", maxItemSize=50)),
+                         (413, "Request body item 1 exceeds 50 bytes"))
+
+    def test_malformed(self):
+        self.assertEqual(self.error(self.reader('[1, {"a": }, 2]'))[0], 400)
+        self.assertEqual(self.error(self.reader('[1, "cut off'))[0], 400)
+        self.assertEqual(self.error(self.reader('[1 2]')), (400, "Request body item 0 is not followed by a comma"))
+
+
+class StaticRangeTest(unittest.TestCase):
+    """
+    Range requests of static files get the bytes they asked for, uncompressed, as bottle.static_file sends them
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.content = "".join("line %d of the document\n" % i for i in range(1000))
+        with open(os.path.join(self.root, "doc.txt"), "wb") as fileobj:
+            fileobj.write(self.content)
+        app = bottle.Bottle()
+
+        @app.get('/doc.txt')
+        def doc():
+            return bottle.static_file("doc.txt", root=self.root)
+
+        app.install(restware.RestwarePlugin(logger=quietLogger()))
+        self.app = app
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_partial_content(self):
+        responseHeaders = {}
+        status, body = call(self.app, 'GET', '/doc.txt', headers={'HTTP_RANGE': 'bytes=100-299',
+                                                                   'HTTP_ACCEPT_ENCODING': 'gzip'},
+                            responseHeaders=responseHeaders)
+        self.assertEqual((status, body), (206, self.content[100:300]))
+        self.assertEqual(responseHeaders['Content-Range'], 'bytes 100-299/%d' % len(self.content))
+        self.assertFalse('Content-Encoding' in responseHeaders)
+
+    def test_etag_from_modification_time_and_size(self):
+        responseHeaders = {}
+        call(self.app, 'GET', '/doc.txt', responseHeaders=responseHeaders)
+        stats = os.stat(os.path.join(self.root, "doc.txt"))
+        version = u"%s:%r:%d" % (os.path.join(self.root, "doc.txt"), stats.st_mtime, stats.st_size)
+        self.assertEqual(responseHeaders['Etag'], '"%s"' % hashlib.sha1(version.encode("utf-8")).hexdigest())
+
+    def test_whole_file_still_compressed(self):
+        responseHeaders = {}
+        status, body = call(self.app, 'GET', '/doc.txt', headers={'HTTP_ACCEPT_ENCODING': 'gzip'},
+                            responseHeaders=responseHeaders)
+        self.assertEqual(responseHeaders.get('Content-Encoding'), 'gzip')
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), self.content)
+
+
+class LongListTest(unittest.TestCase):
+    """
+    Long lists are encoded a batch at a time, into the compressor when there is one, and come out the same
+    """
+    def setUp(self):
+        self.items = [{"id": i, "name": u"item \xe9 %d" % i, "tags": ["a", "b"], "score": i / 3.0} for i in range(1000)]
+        app = bottle.Bottle()
+
+        @app.get('/api/items')
+        def items():
+            return self.items
+
+        self.plugin = restware.RestwarePlugin(logger=quietLogger())
+        app.install(self.plugin)
+        self.app = app
+
+    def get(self, headers):
+        responseHeaders = {}
+        status, body = call(self.app, 'GET', '/api/items', headers=headers, responseHeaders=responseHeaders)
+        self.assertEqual(status, 200)
+        self.assertEqual(responseHeaders['Content-Length'], str(len(body)))
+        return body, responseHeaders
+
+    def test_same_text(self):
+        for query, pretty in (('', False), ('pretty=true', True)):
+            expected = self.plugin.codec.dumps(self.items, pretty)
+            self.assertEqual(self.get({'QUERY_STRING': query})[0], expected)
+            body, responseHeaders = self.get({'QUERY_STRING': query, 'HTTP_ACCEPT_ENCODING': 'gzip'})
+            self.assertEqual(responseHeaders['Content-Encoding'], 'gzip')
+            self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), expected)
+
+    def test_etag(self):
+        body, responseHeaders = self.get({'HTTP_ACCEPT_ENCODING': 'gzip', 'HTTP_IF_NONE_MATCH': '"stale"'})
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), self.plugin.codec.dumps(self.items))
+        status, body = call(self.app, 'GET', '/api/items', headers={'HTTP_ACCEPT_ENCODING': 'gzip',
+                                                                     'HTTP_IF_NONE_MATCH': responseHeaders['Etag']})
+        self.assertEqual((status, body), (304, ''))
+
+
+class SlowValue(object):
+    """
+    Takes a while to encode (see OffloadTest.test_json_timeout)
+    """
+    pass
+
+
+class OffloadTest(unittest.TestCase):
+    """
+    Compression threads and JSON processes produce exactly what the request thread would have, and the request
+    thread takes over whatever they can't do
+    """
+    document = json.dumps([{"id": i, "name": "item %d" % i, "tags": ["a", "b"]} for i in range(20000)])
+
+    def test_worker_pool(self):
+        pool = restware.WorkerPool(1, 1)
+        started, release = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+            return "unblocked"
+
+        blocker = pool.submit(block)
+        started.wait(5)
+        queued = pool.submit(lambda: 1 / 0)
+        self.assertTrue(queued is not None)
+        # the thread is busy and the queue is full: the caller has to do it itself
+        self.assertTrue(pool.submit(lambda: None) is None)
+        release.set()
+        self.assertEqual(blocker.result(), "unblocked")
+        self.assertRaises(ZeroDivisionError, queued.result)
+
+    def test_compress_in_parallel(self):
+        for encoding, wbits in (("gzip", 16 + zlib.MAX_WBITS), ("deflate", zlib.MAX_WBITS)):
+            for pool in (restware.WorkerPool(2, 64), restware.WorkerPool(1, 1)):
+                body, offloaded = restware.compressInParallel(self.document, encoding, 6, pool, 64 * 1024)
+                self.assertEqual(zlib.decompress(str(body), wbits), self.document)
+                self.assertTrue(0 < offloaded <= len(self.document) // (64 * 1024) + 1)
+
+    def test_compression_threads(self):
+        app = bottle.Bottle()
+
+        @app.get('/api/items')
+        def items():
+            return json.loads(self.document)
+
+        plugin = restware.RestwarePlugin(logger=quietLogger(), compressionThreads=2, offloadMinSize=1024)
+        app.install(plugin)
+        status, body = call(app, 'GET', '/api/items', headers={'HTTP_ACCEPT_ENCODING': 'gzip'})
+        self.assertEqual(zlib.decompress(body, 16 + zlib.MAX_WBITS), plugin.codec.dumps(json.loads(self.document)))
+        self.assertEqual(plugin.offloadStats()["offloadedBodies"], 1)
+
+    def makeApp(self, value, **kwargs):
+        app = bottle.Bottle()
+
+        @app.get('/api/value')
+        def getValue():
+            return value
+
+        plugin = restware.RestwarePlugin(logger=quietLogger(), jsonProcesses=1, jsonOffloadMinSize=0, **kwargs)
+        plugin.codec.register(SlowValue, lambda obj: time.sleep(1) or "slow")
+        app.install(plugin)
+        self.addCleanup(app.close)
+        return app, plugin
+
+    def test_json_processes(self):
+        value = {"items": json.loads(self.document), "total": 20000}
+        app, plugin = self.makeApp(value)
+        for query in ('', 'pretty=true'):
+            status, body = call(app, 'GET', '/api/value', headers={'QUERY_STRING': query})
+            self.assertTrue(body == plugin.codec.dumps(value, query == 'pretty=true'), query)
+        # compact JSON stays inline, where its key order is the dicts' own
+        self.assertEqual(plugin.offloadStats()["jsonOffloaded"], 1)
+
+    def test_json_unpicklable(self):
+        class Local(object):
+            pass
+
+        app, plugin = self.makeApp({"local": Local()})
+        plugin.codec.register(Local, lambda obj: "local")
+        self.assertEqual(call(app, 'GET', '/api/value', headers={'QUERY_STRING': 'pretty=true'}),
+                         (200, '{\n    "local": "local"\n}'))
+        self.assertEqual(plugin.offloadStats().get("jsonOffloaded"), None)
+        self.assertEqual(plugin.offloadStats()["jsonFailed"], 1)
+
+    def test_json_timeout(self):
+        app, plugin = self.makeApp({"slow": SlowValue()}, jsonTimeout=0.1)
+        self.assertEqual(call(app, 'GET', '/api/value', headers={'QUERY_STRING': 'pretty=true'}),
+                         (200, '{\n    "slow": "slow"\n}'))
+        self.assertEqual(plugin.offloadStats()["jsonTimeouts"], 1)
+
+    def test_json_pool_shut_down(self):
+        app, plugin = self.makeApp({})
+        self.assertEqual(len(multiprocessing.active_children()), 1)
+        app.close()
+        self.assertEqual(multiprocessing.active_children(), [])
+        self.assertTrue(plugin.jsonPool is None)
+
+    def test_size_estimate(self):
+        for value in (json.loads(self.document), {"items": json.loads(self.document)}, ["x" * 100] * 1000):
+            estimate, size = restware.estimateJSONSize(value), len(json.dumps(value, separators=(',', ':')))
+            self.assertTrue(size / 2 < estimate < size * 2, (estimate, size))
+
+
+class ETagTest(unittest.TestCase):
+    """
+    Bodies are only hashed into an ETag when the route asks for one or the client has one to check
+    """
+    def makeApp(self, **kwargs):
+        app = bottle.Bottle()
+
+        @app.get('/api/plain')
+        def plain():
+            return {"items": [1, 2, 3]}
+
+        @app.get('/api/tagged', etag=True)
+        def tagged():
+            return {"items": [1, 2, 3]}
+
+        app.install(restware.RestwarePlugin(logger=quietLogger(), **kwargs))
+        return app
+
+    def get(self, app, path, headers=None):
+        responseHeaders = {}
+        status, body = call(app, 'GET', path, headers=headers, responseHeaders=responseHeaders)
+        return status, responseHeaders.get('Etag')
+
+    def test_no_etag_by_default(self):
+        status, etag = self.get(self.makeApp(), '/api/plain')
+        self.assertEqual((status, etag), (200, None))
+
+    def test_validator_gets_etag_and_304(self):
+        app = self.makeApp()
+        status, etag = self.get(app, '/api/plain', {'HTTP_IF_NONE_MATCH': '"stale"'})
+        self.assertEqual(status, 200)
+        self.assertTrue(etag)
+        self.assertEqual(self.get(app, '/api/plain', {'HTTP_IF_NONE_MATCH': etag}), (304, etag))
+
+    def test_route_and_plugin_opt_in(self):
+        self.assertTrue(self.get(self.makeApp(), '/api/tagged')[1])
+        self.assertTrue(self.get(self.makeApp(etags=True), '/api/plain')[1])
+
+
+class StaticDocumentTest(unittest.TestCase):
+    """
+    Static routes that return documents rather than files neither hash them into an ETag nor reuse a compressed
+    variant of another document
+    """
+    def setUp(self):
+        self.pages = {"a": "page a " * 1000, "b": "page b " * 1000}
+        app = bottle.Bottle()
+
+        @app.get('/docs/<name>')
+        def docs(name):
+            return self.pages[name]
+
+        self.plugin = restware.RestwarePlugin(logger=quietLogger())
+        app.install(self.plugin)
+        self.app = app
+
+    def get(self, name, headers=None):
+        responseHeaders = {}
+        headers = dict(headers or {}, HTTP_ACCEPT_ENCODING='gzip')
+        status, body = call(self.app, 'GET', '/docs/' + name, headers=headers, responseHeaders=responseHeaders)
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS) if body else body, responseHeaders.get('Etag')
+
+    def test_no_etag_unless_asked(self):
+        self.assertEqual(self.get("a"), (self.pages["a"], None))
+        body, etag = self.get("a", {'HTTP_IF_NONE_MATCH': '"stale"'})
+        self.assertTrue(etag)
+        self.assertEqual(self.get("a", {'HTTP_IF_NONE_MATCH': etag}), ("", etag))
+
+    def test_variants_only_for_same_document(self):
+        # both pages are the same length, so they are kept under the same key
+        for name in ("a", "a", "b", "a"):
+            self.assertEqual(self.get(name)[0], self.pages[name])
+        self.assertEqual(self.plugin.staticCache.hits, 1)
+        self.assertEqual(self.plugin.staticCache.size, len(self.pages["a"]) + len(self.plugin.staticCache.entries.values()[0].body))
+
+
+class BinaryFormatTest(unittest.TestCase):
+    """
+    Only routes that turn binary formats on look at Accept for them
+    """
+    def setUp(self):
+        if not restware.loadBinaryFormats(["msgpack"]):
+            self.skipTest("msgpack is not installed")
+        app = bottle.Bottle()
+
+        @app.get('/api/json')
+        def jsonOnly():
+            return {"a": 1}
+
+        @app.get('/api/binary', binary_formats=["msgpack"])
+        def binary():
+            return {"a": 1}
+
+        app.install(restware.RestwarePlugin(logger=quietLogger()))
+        self.app = app
+
+    def get(self, path):
+        responseHeaders = {}
+        status, body = call(self.app, 'GET', path, headers={'HTTP_ACCEPT': 'application/msgpack'},
+                            responseHeaders=responseHeaders)
+        return responseHeaders['Content-Type'], [value.strip() for value in responseHeaders.get('Vary', '').split(',')]
+
+    def test_off_by_default(self):
+        contentType, vary = self.get('/api/json')
+        self.assertEqual(contentType, 'application/json')
+        self.assertFalse('Accept' in vary)
+
+    def test_route_opt_in(self):
+        contentType, vary = self.get('/api/binary')
+        self.assertEqual(contentType, 'application/msgpack')
+        self.assertTrue('Accept' in vary)
+
+
+class CBORFormatTest(unittest.TestCase):
+    """
+    CBOR carries what JSON would: types JSON doesn't have go through the codec's default(), str goes out as text
+    """
+    def test_json_types_only(self):
+        cbor = restware.loadBinaryFormats(["cbor"])
+        if not cbor:
+            self.skipTest("cbor2 is not installed")
+        codec = restware.JSONCodec()
+        codec.register(datetime.datetime, lambda value: value.isoformat())
+        data = {"when": datetime.datetime(2001, 2, 3), "name": "caf\xc3\xa9", "pair": (1, 2.5), "none": None}
+        self.assertEqual(cbor[0].loads(cbor[0].dumps(data, codec.default)), json.loads(codec.dumps(data)))
+        self.assertRaises(TypeError, cbor[0].dumps, {"set": set()}, codec.default)
+
+    def test_broken_library_left_out(self):
+        def broken():
+            raise AttributeError("'CBOREncoder' object has no attribute '_encoders'")
+        restware.BINARY_FORMAT_FACTORIES["broken"] = broken
+        self.addCleanup(restware.BINARY_FORMAT_FACTORIES.pop, "broken")
+        logger = logging.Logger("restware.tests.formats")
+        warnings = []
+        logger.warn = lambda message, *args: warnings.append(message % args)
+        self.assertEqual(restware.loadBinaryFormats(["broken"], logger), [])
+        self.assertTrue("broken" in warnings[0], warnings)
+
+
+class JSONCodecTest(unittest.TestCase):
+    """
+    Whichever backends are picked, the codec writes exactly what the stdlib json module does
+    """
+    def test_nonfinite_floats_and_keys(self):
+        codec = restware.JSONCodec()
+        for data in ([float("nan"), float("inf"), -float("inf")], {True: 1}, {None: 1, 1.5: 2, 3: 4}):
+            self.assertEqual(codec.dumps(data), json.dumps(data, separators=(',', ':')))
+            self.assertEqual(codec.dumps(data, True), json.dumps(data, indent=4, sort_keys=True))
+
+    def test_backend_refusing_nan_disagrees(self):
+        codec = restware.JSONCodec(["json"])
+        stdlib = restware._stdlibBackend()
+
+        def refuseNaN(obj, default):
+            return json.dumps(obj, separators=(',', ':'), default=default, allow_nan=False)
+        backend = restware.JSONBackend("strict", refuseNaN, stdlib.dumpsPretty, json.loads)
+        self.assertEqual(codec._agrees(backend), set(["pretty", "decode"]))
+
+    def test_register_does_not_time_again(self):
+        codec = restware.JSONCodec()
+        timings = dict(codec.timings)
+        repeat = restware.timeit.repeat
+
+        def refuse(*args, **kwargs):
+            raise AssertionError("backends timed again")
+        restware.timeit.repeat = refuse
+        try:
+            codec.register(datetime.datetime, lambda value: value.isoformat())
+        finally:
+            restware.timeit.repeat = repeat
+        self.assertEqual(codec.timings, timings)
+        self.assertEqual(codec.dumps([datetime.datetime(2001, 2, 3)]), '["2001-02-03T00:00:00"]')
+
+
+class ResponseSchemaTest(unittest.TestCase):
+    """
+    Schemas are compiled when their route is added, and their encoder is used whenever it agrees with the codec
+    """
+    def test_compiled_when_route_added(self):
+        app = bottle.Bottle()
+
+        @app.get('/api/before', schema={"id": int})
+        def before():
+            return {"id": 1}
+
+        plugin = restware.RestwarePlugin(logger=quietLogger())
+        app.install(plugin)
+
+        @app.get('/api/after', schema=[{"id": int, "name": str}])
+        def after():
+            return [{"id": 1, "name": "one"}, {"id": 2, "name": "two"}]
+
+        self.assertEqual(len(plugin.schemas), 2)
+        self.assertTrue(all(schema.stats()["compiled"] for schema in plugin.schemas.values()))
+        status, body = call(app, 'GET', '/api/after', headers={'QUERY_STRING': 'pretty=true'})
+        self.assertEqual(body, json.dumps(after(), indent=4, sort_keys=True))
+        self.assertEqual(plugin.schemaStats()[('GET', '/api/after')]["encoded"], 1)
+
+
+
+class BatchTest(unittest.TestCase):
+    """
+    Every operation of a batch gets its own status, whether it is dispatched on the request thread or by the batch
+    threads, and the batch request's own response is left as it was
+    """
+    def makeApp(self, **kwargs):
+        app = bottle.Bottle()
+
+        @app.get('/api/item/<name>')
+        def item(name):
+            bottle.response.set_header('X-Item', name)
+            bottle.response.set_cookie('item', name)
+            if name == "missing":
+                raise bottle.HTTPError(404, "No such item")
+            return {"name": name}
+
+        @app.post('/api/echo')
+        def echo():
+            return {"received": bottle.request.jsonData}
+
+        plugin = restware.RestwarePlugin(logger=quietLogger(), batchPath='/api/_batch', **kwargs)
+        app.install(plugin)
+        return app
+
+    def batch(self, app, operations):
+        responseHeaders = {}
+        status, body = call(app, 'POST', '/api/_batch', json.dumps(operations), {'CONTENT_TYPE': 'application/json'},
+                            responseHeaders)
+        return status, json.loads(body), responseHeaders
+
+    def test_partial_failure(self):
+        operations = [{"path": "/api/item/a"}, {"path": "/api/item/missing"}, {"path": "api/item/b"},
+                      {"method": "POST", "path": "/api/echo", "body": [1, 2]}, {"path": "/api/nothing"}]
+        for kwargs in ({}, {"batchThreads": 2}):
+            status, results, responseHeaders = self.batch(self.makeApp(**kwargs), operations)
+            self.assertEqual(status, 200)
+            self.assertEqual([result["status"] for result in results], [200, 404, 400, 200, 404])
+            self.assertEqual(results[0]["body"], {"name": "a"})
+            self.assertEqual(results[1]["body"], {"message": "No such item"})
+            self.assertEqual(results[3]["body"], {"received": [1, 2]})
+            # what the operations did to their responses stays with them
+            self.assertEqual(responseHeaders['Content-Type'], 'application/json')
+            self.assertFalse('X-Item' in responseHeaders or 'Set-Cookie' in responseHeaders, responseHeaders)
+
+    def test_nesting_refused(self):
+        status, results, responseHeaders = self.batch(self.makeApp(), [{"path": "/api/_batch"},
+                                                                       {"path": "/api/item/a"}])
+        self.assertEqual([result["status"] for result in results], [400, 200])
+        self.assertTrue("nested" in results[0]["body"]["message"])
+
+    def test_too_many_operations(self):
+        app = self.makeApp(batchMaxOperations=2)
+        status, body = call(app, 'POST', '/api/_batch', json.dumps([{"path": "/api/item/a"}] * 3),
+                            {'CONTENT_TYPE': 'application/json'})
+        self.assertEqual(status, 413)
+        self.assertEqual(self.batch(app, [{"path": "/api/item/a"}] * 2)[0], 200)
+
+
+if __name__ == '__main__':
+    unittest.main()